@@ -162,6 +162,8 @@ def import_all():
     import renpy.display.behavior # layout @UnresolvedImport
     import renpy.display.transition # core, layout @UnresolvedImport
     import renpy.display.im #@UnresolvedImport
+    import renpy.display.imarray # im @UnresolvedImport
+    import renpy.display.imfuse # im, imarray @UnresolvedImport
     import renpy.display.imagelike #@UnresolvedImport
     import renpy.display.image # core, behavior, im, imagelike @UnresolvedImport
     import renpy.display.video #@UnresolvedImport
@@ -188,6 +190,7 @@ def import_all():
 
     import renpy.lint #@UnresolvedImport
     import renpy.warp #@UnresolvedImport
+    import renpy.benchmark #@UnresolvedImport
 
     import renpy.editor #@UnresolvedImport
     import renpy.exports #@UnresolvedImport
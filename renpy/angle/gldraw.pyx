@@ -573,6 +573,12 @@ cdef class GLDraw:
             
         return rv
 
+    def texture_size(self, texture):
+        # Returns the number of bytes of texture memory used by a
+        # texture returned from load_texture.
+
+        return texture.get_bytes()
+    
     def solid_texture(self, w, h, color):
         surf = renpy.display.pgrender.surface((w + 4, h + 4), True)
         surf.fill(color)
@@ -0,0 +1,306 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This code benchmarks saving and loading. It runs the game without
+# a display, from a label or warp location, for a number of
+# interactions, and then times each stage of saving and loading the
+# game, and reports how big each part of the save is.
+
+import renpy
+import time
+import os
+import zipfile
+import cPickle
+import pickle
+import cStringIO
+
+# The name of the save slot used by the benchmark.
+BENCHMARK_SLOT = "_benchmark"
+
+class ByteCounter(object):
+    """
+    A file-like object that counts the bytes written to it.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, s):
+        self.count += len(s)
+
+def play(spec, interactions):
+    """
+    Starts the game at `spec`, which is either a label or a
+    filename:linenumber pair that's warped to, and runs it until
+    `interactions` interactions have occured, or the game ends.
+    Returns the number of interactions that occured, and the number of
+    statements that were executed.
+
+    There's no display, so say statements are marked as seen and
+    skipped, and menus take their first choice. Any other statement that
+    fails, usually because it tried to interact, is skipped and counted
+    as an interaction.
+    """
+
+    game = renpy.game
+
+    store = renpy.store.__dict__ #@UndefinedVariable
+    store.clear()
+    store.update(game.clean_store)
+
+    game.log = renpy.python.RollbackLog()
+    game.contexts = [ renpy.execution.Context(True) ]
+
+    context = game.context()
+
+    if ":" in spec:
+        renpy.config.developer = True
+
+        if game.script.has_label("_start"):
+            context.goto_label("_start")
+        else:
+            context.goto_label("start")
+
+        label = renpy.warp.warp(spec)
+
+        if not label:
+            raise Exception("Could not find line to warp to.")
+
+    else:
+        label = spec
+
+    node = game.script.lookup(label)
+
+    count = 0
+    statements = 0
+
+    while node and count < interactions:
+
+        context.current = node.name
+        game.log.begin()
+        context.seen = False
+        context.next_node = None
+
+        try:
+
+            if isinstance(node, renpy.ast.Say):
+                context.mark_seen()
+                game.log.checkpoint()
+                context.next_node = node.next
+                count += 1
+
+            elif isinstance(node, renpy.ast.With):
+                context.next_node = node.next
+
+            elif isinstance(node, renpy.ast.Menu):
+                game.log.checkpoint()
+                context.next_node = node.next
+
+                for _label, condition, block in node.items:
+                    if block is not None and renpy.python.py_eval(condition):
+                        context.next_node = block[0]
+                        break
+
+                count += 1
+
+            else:
+                node.execute()
+
+        except renpy.game.JumpException, e:
+            context.next_node = game.script.lookup(e.args[0])
+
+        except (renpy.game.QuitException, renpy.game.FullRestartException, renpy.game.UtterRestartException):
+            break
+
+        except Exception:
+            context.next_node = node.next
+            count += 1
+
+        if context.seen:
+            game.seen_ever[context.current] = True
+            game.seen_session[context.current] = True
+
+        game.log.complete()
+
+        node = context.next_node
+        statements += 1
+
+    return count, statements
+
+def pickle_sizes(objects):
+    """
+    Given a list of (name, object) pairs, returns a list of (name, size)
+    pairs, giving the number of bytes each object adds to a pickle that
+    contains the objects before it. Objects shared with an earlier object
+    are only counted once, so the sizes add up to about the size of the
+    pickle.
+    """
+
+    counter = ByteCounter()
+
+    if renpy.config.use_cpickle:
+        pickler = cPickle.Pickler(counter, cPickle.HIGHEST_PROTOCOL)
+    else:
+        pickler = pickle.Pickler(counter, pickle.HIGHEST_PROTOCOL)
+
+    rv = [ ]
+
+    for name, o in objects:
+        start = counter.count
+
+        try:
+            pickler.dump(o)
+        except Exception, e:
+            name = "%s (%s)" % (name, e)
+
+        rv.append((name, counter.count - start))
+
+    return rv
+
+def report_sizes(title, sizes, limit):
+    """
+    Prints the `limit` largest of `sizes`, a list of (name, size) pairs.
+    """
+
+    total = sum(size for _name, size in sizes)
+
+    print
+    print "%s: %d bytes in %d objects." % (title, total, len(sizes))
+
+    sizes = sorted(sizes, key=lambda i : -i[1])
+
+    for name, size in sizes[:limit]:
+        print "    %9d %s" % (size, name)
+
+def benchmark_saves(spec, interactions, limit=20):
+    """
+    Runs the game from `spec` for `interactions` interactions, then
+    benchmarks saving and loading it, printing the results. The store,
+    log, contexts, and seen statements are restored afterwards, and
+    the benchmark's save is removed, so the game that was running isn't
+    changed, and what the benchmark saw isn't saved to the persistent
+    data.
+    """
+
+    game = renpy.game
+
+    store = renpy.store.__dict__ #@UndefinedVariable
+    old_store = store.copy()
+    
+    old_state = (game.log, game.contexts, game.seen_ever, game.seen_session, renpy.config.developer)
+
+    game.seen_ever = { }
+    game.seen_session = { }
+    
+    try:
+        run_benchmark(spec, interactions, limit)
+
+    finally:
+        store.clear()
+        store.update(old_store)
+
+        game.log, game.contexts, game.seen_ever, game.seen_session, renpy.config.developer = old_state
+
+        # The delta session refers to the benchmark's log.
+        renpy.loadsave.reset_delta_session()
+        renpy.loadsave.unlink_save(BENCHMARK_SLOT)
+        
+def run_benchmark(spec, interactions, limit):
+    """
+    Does the work of benchmark_saves.
+    """
+    
+    loadsave = renpy.loadsave
+
+    start = time.time()
+    count, statements = play(spec, interactions)
+
+    times = [ ("play", time.time() - start) ]
+
+    def stage(name):
+        now = time.time()
+        times.append((name, now - stage.start))
+        stage.start = now
+
+    stage.start = time.time()
+
+    log = renpy.game.log
+    roots = log.freeze()
+    stage("freeze")
+
+    if renpy.config.save_deltas:
+        log_name = "delta_log"
+        log_data = loadsave.dump_delta(roots, log)
+    else:
+        logf = cStringIO.StringIO()
+        loadsave.dump((roots, log), logf)
+
+        log_name = "log"
+        log_data = logf.getvalue()
+
+    stage("pickle")
+
+    loadsave.write_save(BENCHMARK_SLOT, log_name, log_data, "", "Benchmark.")
+    stage("write")
+
+    with loadsave.save_index_lock:
+        loadsave.cache.pop(BENCHMARK_SLOT, None)
+        loadsave.save_index.pop(BENCHMARK_SLOT, None)
+
+    stage.start = time.time()
+    loadsave.scan_saved_game(BENCHMARK_SLOT)
+    stage("scan")
+
+    fn = renpy.config.savedir + "/" + BENCHMARK_SLOT + loadsave.savegame_suffix
+    save_size = os.path.getsize(fn)
+
+    zf = zipfile.ZipFile(fn, "r")
+
+    if log_name == "delta_log":
+        new_roots, new_log = loadsave.load_delta(zf.read(log_name))
+    else:
+        new_roots, new_log = loadsave.loads(zf.read(log_name))
+
+    zf.close()
+    stage("load")
+
+    try:
+        new_log.unfreeze(new_roots)
+    except renpy.game.RestartException:
+        pass
+
+    stage("unfreeze")
+
+    print "Save benchmark from %s: %d interactions, %d statements, %d rollbacks." % (
+        spec, count, statements, len(log.log))
+
+    print
+
+    for name, t in times:
+        print "    %-9s %9.3f ms" % (name, t * 1000)
+
+    print
+    print "Save is %d bytes, with a %s of %d bytes." % (save_size, log_name, len(log_data))
+
+    report_sizes("Roots", pickle_sizes(sorted(roots.items())), limit)
+
+    entries = [ ("log[%d] %s" % (i, rb.context.current), rb) for i, rb in enumerate(log.log) ]
+    report_sizes("Rollbacks", pickle_sizes(entries), limit)
@@ -159,6 +159,9 @@ def bootstrap(renpy_base):
     op.add_option('--compile', dest='compile', default=False, action='store_true',
                   help="Causes Ren'Py to compile all .rpy files to .rpyc files, and then quit.")
 
+    op.add_option('--verify-scripts', dest='verify_scripts', default=False, action='store_true',
+                  help="Causes Ren'Py to check that .rpyc files are up to date by digesting the .rpy files, even when their size and modification time are unchanged.")
+
     op.add_option('--lint', dest='lint', default=False, action='store_true',
                   help='Run a number of expensive tests, to try to detect errors in the script.')
 
@@ -174,6 +177,12 @@ def bootstrap(renpy_base):
     op.add_option('--warp', dest='warp', default=None,
                   help='This takes as an argument a filename:linenumber pair, and tries to warp to the statement before that line number.')
 
+    op.add_option('--benchmark-saves', dest='benchmark_saves', default=None,
+                  help="Runs the game without a display, starting at the given label or filename:linenumber pair, and then benchmarks saving and loading it.")
+
+    op.add_option('--benchmark-interactions', dest='benchmark_interactions', default=100, type='int',
+                  help="The number of interactions to run the game for before --benchmark-saves benchmarks it.")
+
     op.add_option('--remote', dest='remote', action='store_true',
                   help="Allows Ren'Py to be fed commands on stdin.")
 
@@ -251,7 +260,7 @@ def bootstrap(renpy_base):
         os.environ['SDL_VIDEODRIVER'] = 'windib'
 
     # Show the presplash.
-    if not options.lint and not options.compile and not options.version and not options.rmpersistent:
+    if not options.lint and not options.compile and not options.version and not options.rmpersistent and not options.benchmark_saves:
         import renpy.display.presplash #@Reimport
         renpy.display.presplash.start(gamedir)
 
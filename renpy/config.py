@@ -85,6 +85,35 @@ savedir = None
 # live in the image cache at once.
 image_cache_size = 8
 
+# If True, and NumPy is available, chains of color image manipulators
+# (like im.MatrixColor and im.Recolor) are applied to the source image
+# all at once, without loading the images in the middle of the chain.
+# Colors are still clamped after each manipulator, so the result only
+# differs from applying them one at a time by rounding.
+numpy_image_operations = True
+
+# If True, chains of image manipulators that crop, scale, flip, and
+# change the colors of an image are loaded as a single operation, and
+# only the image at the end of the chain is cached.
+fuse_image_operations = True
+
+# If True, an image manipulator that's in the middle of more than one
+# such chain is loaded and cached, rather than being fused into each
+# of them.
+cache_shared_image_operations = False
+
+# If not None, the number of bytes of surfaces and textures that are
+# allowed to live in the image cache at once.
+image_cache_bytes = None
+
+# The number of save thumbnails that are kept in memory, outside of
+# the image cache, so paging through the save slots is fast.
+thumbnail_cache_size = 30
+
+# The number of threads that load images in the background. If None,
+# one thread per processor is used, up to 4.
+preload_threads = None
+
 # The number of statements we will analyze when doing predictive
 # loading. Please note that this is a total number of statements in a
 # BFS along all paths, rather than the depth along any particular
@@ -114,6 +143,14 @@ archives = [ ]
 # Searchpath.
 searchpath = [ ]
 
+# The number of idle file objects that are kept open for each archive,
+# so they can be reused rather than reopened.
+archive_file_pool = 4
+
+# If True, the file index is written to file_index.txt each time it is
+# built, showing which copy of each file will be loaded.
+dump_file_index = False
+
 # If True, we will only try loading from archives.
 # Only useful for debugging Ren'Py, don't document.
 force_archives = False
@@ -354,6 +391,16 @@ autosave_slots = 10
 # How often do we autosave. (Number of interactions, sort of.)
 autosave_frequency = int(os.environ.get("RENPY_AUTOSAVE_FREQUENCY", "200"))
 
+# The number of threads used to read and decompress script files
+# while the script is being loaded. (This happens before any init
+# code runs, so it can only be set from the environment.)
+script_load_threads = int(os.environ.get("RENPY_SCRIPT_LOAD_THREADS", "4"))
+
+# If True, the label blocks in compiled script files are only loaded
+# when they are first used. (This can only be set from the environment,
+# for the same reason.)
+lazy_script_loading = os.environ.get("RENPY_LAZY_SCRIPT_LOADING", "1") != "0"
+
 # The callback that is used by the scene statement.
 scene = renpy.exports.scene
 
@@ -522,6 +569,17 @@ python_callbacks = [ ]
 # If true, we dump information about a save upon save.
 save_dump = False
 
+# If true, a save only contains the parts of the rollback log and store
+# that have changed since the previous save in this session, following
+# a copy of everything that was written earlier. Only changes to
+# objects that participate in rollback are noticed, so this shouldn't
+# be used if the game changes other objects in the store.
+save_deltas = False
+
+# The number of deltas that are written before a save is written from
+# scratch again.
+save_delta_limit = 20
+
 del renpy
 del os
 
@@ -979,6 +979,47 @@ def scene_lists(index=-1):
     return renpy.game.context(index).scene_lists
    
 
+class Screenshot(object):
+    """
+    A screenshot, which is encoded as a PNG in a background thread, so
+    taking it doesn't stall the main thread.
+    """
+
+    def __init__(self, surf):
+
+        # The surface being encoded. None once it has been.
+        self.surf = surf
+
+        # The encoded PNG, once it's ready.
+        self.data = None
+        
+        self.thread = threading.Thread(target=self.encode)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def encode(self):
+        try:
+            self.data = renpy.game.interface.encode_screenshot(self.surf)
+            self.surf = None
+        except:
+            pass
+            
+    def get(self):
+        """
+        Returns the PNG, waiting for it to be encoded if necessary.
+        """
+        
+        self.thread.join()
+
+        # If encoding failed in the thread, try again here, so the
+        # error is reported.
+        if self.data is None:
+            self.data = renpy.game.interface.encode_screenshot(self.surf)
+            self.surf = None
+            
+        return self.data
+
+    
 class Interface(object):
     """
     This represents the user interface that interacts with the user.
@@ -1407,6 +1448,15 @@ class Interface(object):
            until it can be handled by the main thread.
         """
 
+        self.screenshot = Screenshot(self.capture_screenshot(background, scale))
+
+    def capture_screenshot(self, background=False, scale=None):
+        """
+        Returns a copy of the current screen, as a surface. `background`
+        is as for take_screenshot. If `scale` is given, the copy is
+        scaled to that size, without making a full-size copy first.
+        """
+        
         if background:
             self.bgscreenshot_event.clear()
             self.bgscreenshot_needed = True
@@ -1418,15 +1468,30 @@ class Interface(object):
         else:
 
             window = renpy.display.draw.screenshot(self.surftree, self.fullscreen_video)
+
+        if scale is not None:
+            return renpy.display.scale.smoothscale(window, scale)
         
-        surf = renpy.display.pgrender.copy_surface(window, True)
-        surf = renpy.display.scale.smoothscale(surf, scale)
+        return renpy.display.pgrender.copy_surface(window, True)
+
+    def encode_screenshot(self, surf, scale=None):
+        """
+        Returns `surf`, a surface returned by capture_screenshot, as a
+        string containing a PNG. If `scale` is given, the surface is
+        scaled first. This can be called from a background thread.
+        """
+
+        if scale is not None:
+            surf = renpy.display.scale.smoothscale(surf, scale)
+            
         surf = surf.convert()
         
         sio = cStringIO.StringIO()
         renpy.display.module.save_png(surf, sio, 0)
-        self.screenshot = sio.getvalue()
+        rv = sio.getvalue()
         sio.close()
+
+        return rv
         
         
     def save_screenshot(self, filename):
@@ -1460,7 +1525,7 @@ class Interface(object):
             rv = self.screenshot
             self.lose_screenshot()
 
-        return rv
+        return rv.get()
 
     
     def lose_screenshot(self):
@@ -2368,9 +2433,6 @@ class Interface(object):
             for i in renpy.config.overlay_layers:
                 scene_lists.clear(i)
 
-            # Stop ongoing preloading.
-            renpy.display.im.cache.end_tick()
-                
             # We no longer disable periodic between interactions.
             # pygame.time.set_timer(PERIODIC, 0)
 
@@ -25,8 +25,10 @@
 
 import renpy.display
 
+import heapq
 import math
 import zipfile
+import zlib
 import cStringIO
 import threading
 
@@ -42,13 +44,153 @@ class CacheEntry(object):
         # The pygame surface corresponding to the cached object.
         self.surf = surf 
 
-        # The size of this image.
+        # The size of the surface, in bytes.
         w, h = surf.get_size()
-        self.size = w * h
+        self.size = surf.get_pitch() * h
 
+        # The size of the surface and its texture, in bytes. The
+        # texture is added in once it's been loaded.
+        self.bytes = self.size
+        
         # The time when this cache entry was last used.
         self.time = 0
 
+def texture_size(surf, texture):
+    """
+    Returns the number of bytes of memory used by `texture`, the texture
+    that was loaded from `surf`.
+    """
+
+    # Draw modules that were compiled before texture_size was added
+    # don't have it, so assume the texture is as big as the surface.
+    fn = getattr(renpy.display.draw, "texture_size", None)
+
+    if fn is None:
+        w, h = surf.get_size()
+        return w * h * 4
+
+    return fn(texture)
+
+class LRUMap(object):
+    """
+    A map that keeps track of the order its keys were last used in. A
+    key is used when it's added to the map, or when it's passed to
+    touch. This is a dict, along with a circular doubly-linked list
+    of [ prev, next, key, value ] links, least recently used first.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+
+        # A map from key to link.
+        self.map = { }
+
+        # The root of the linked list, which doesn't hold a key.
+        self.root = [ None, None, None, None ]
+        self.root[0] = self.root
+        self.root[1] = self.root
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def __getitem__(self, key):
+        return self.map[key][3]
+
+    def get(self, key, default=None):
+        link = self.map.get(key, None)
+
+        if link is None:
+            return default
+
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self.map.get(key, None)
+
+        if link is not None:
+            link[3] = value
+            self.touch(key)
+            return
+
+        root = self.root
+        last = root[0]
+
+        link = [ last, root, key, value ]
+        last[1] = link
+        root[0] = link
+
+        self.map[key] = link
+
+    def __delitem__(self, key):
+        link = self.map.pop(key)
+
+        prev, next, _key, _value = link #@ReservedAssignment
+        prev[1] = next
+        next[0] = prev
+
+    def pop(self, key, default=None):
+        if key not in self.map:
+            return default
+
+        rv = self.map[key][3]
+        del self[key]
+        return rv
+
+    def touch(self, key):
+        """
+        Makes `key` the most recently used key in the map.
+        """
+
+        link = self.map[key]
+        prev, next, _key, _value = link #@ReservedAssignment
+
+        # Unlink.
+        prev[1] = next
+        next[0] = prev
+
+        # Relink at the end.
+        root = self.root
+        last = root[0]
+
+        link[0] = last
+        link[1] = root
+        last[1] = link
+        root[0] = link
+
+    def oldest(self):
+        """
+        Returns a (key, value) tuple for the least recently used key in
+        the map. Raises KeyError if the map is empty.
+        """
+
+        link = self.root[1]
+
+        if link is self.root:
+            raise KeyError("oldest(): map is empty")
+
+        return link[2], link[3]
+
+    def iterkeys(self):
+        link = self.root[1]
+
+        while link is not self.root:
+            yield link[2]
+            link = link[1]
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        link = self.root[1]
+
+        while link is not self.root:
+            yield link[3]
+            link = link[1]
+
 # This is the singleton image cache.
 class Cache(object):
 
@@ -58,25 +200,51 @@ class Cache(object):
         # interaction.)
         self.time = 0
 
-        # A map from Image object to CacheEntry.
-        self.cache = { }
+        # A map from Image object to CacheEntry, which keeps track of
+        # the order the entries were last used in.
+        self.cache = LRUMap()
 
-        # A list of Image objects that we want to preload.
+        # A heap of [ priority, serial, image, time ] lists, giving the
+        # images we want to preload. Images with a lower priority are
+        # loaded first. A request is cancelled by setting its image to
+        # None.
         self.preloads = [ ]
 
+        # A map from image to the request in preloads that will load it.
+        self.preload_requests = { }
+
+        # The serial number of the next preload request, used to load
+        # requests with the same priority in the order they were made.
+        self.preload_serial = 0
+
         # False if this is not the first preload in this tick.
         self.first_preload_in_tick = True
 
         # The total size of the current generation of images.
         self.size_of_current_generation = 0
 
-        # The total size of everything in the cache.
+        # The total size of the surfaces in the cache, in bytes.
         self.total_cache_size = 0
 
-        # A lock that must be held when updating the above.
-        self.lock = threading.Condition()
+        # The total size of the surfaces and textures in the cache, in
+        # bytes.
+        self.total_cache_bytes = 0
+
+        # A lock that must be held when updating the above. This is
+        # also the condition that's notified when there are new images
+        # to preload.
+        rlock = threading.RLock()
+        self.lock = threading.Condition(rlock)
+
+        # A condition, sharing the lock, that's notified when an image
+        # has finished loading.
+        self.loaded = threading.Condition(rlock)
 
-        # Is the preload_thread alive?
+        # The set of images that are being loaded by some thread, but
+        # have not been added to the cache yet.
+        self.loading = set()
+        
+        # Are the preload threads alive?
         self.keep_preloading = True
 
         # A map from image object to surface, only for objects that have
@@ -86,16 +254,27 @@ class Cache(object):
         # Images that we tried, and failed, to preload.
         self.preload_blacklist = set()
 
-        # The size of the cache, in pixels.
+        # The size of the cache, in bytes of surface.
         self.cache_limit = 0
 
-        # The preload thread.
-        self.preload_thread = threading.Thread(target=self.preload_thread_main, name="preloader")
-        self.preload_thread.setDaemon(True)
-        self.preload_thread.start()
+        # If not None, the size of the cache, in bytes of surface and
+        # texture.
+        self.cache_bytes_limit = None
+
+        # The preload threads. The first thread also loads pinned
+        # images. The rest are started by init, once we know how many
+        # we want.
+        self.preload_threads = [ ]
+        self.start_preload_thread()
 
         # Have we been added this tick?
         self.added = set()
+
+        # A map from image object to surface, for the most recently
+        # loaded save thumbnails. This isn't cleaned out when the
+        # images leave the cache, so paging back and forth through the
+        # save slots doesn't need to decode the thumbnails again.
+        self.thumbnail_cache = LRUMap()
                 
     def init(self):
         """
@@ -103,19 +282,46 @@ class Cache(object):
         by the game-maker.
         """
         
-        self.cache_limit = renpy.config.image_cache_size * renpy.config.screen_width * renpy.config.screen_height
+        self.cache_limit = renpy.config.image_cache_size * renpy.config.screen_width * renpy.config.screen_height * 4
+        self.cache_bytes_limit = renpy.config.image_cache_bytes
         renpy.config.debug_image_cache = renpy.config.debug_image_cache or renpy.game.options.debug_image_cache #@UndefinedVariable
+
+        threads = renpy.config.preload_threads
+
+        if threads is None:
+            try:
+                import multiprocessing
+                threads = min(multiprocessing.cpu_count(), 4)
+            except (ImportError, NotImplementedError):
+                threads = 1
+
+        while self.keep_preloading and len(self.preload_threads) < threads:
+            self.start_preload_thread()
+
+    def start_preload_thread(self):
+        """
+        Starts a new preload thread.
+        """
+
+        pins = not self.preload_threads
+        name = "preloader-%d" % len(self.preload_threads)
+        
+        t = threading.Thread(target=self.preload_thread_main, args=(pins,), name=name)
+        t.setDaemon(True)
+        t.start()
+
+        self.preload_threads.append(t)
         
     def quit(self): #@ReservedAssignment
-        if not self.preload_thread.isAlive():
-            return
 
         self.lock.acquire()
         self.keep_preloading = False
-        self.lock.notify()
+        self.lock.notifyAll()
         self.lock.release()
 
-        self.preload_thread.join()
+        for t in self.preload_threads:
+            if t.isAlive():
+                t.join()
         
         
     # Clears out the cache.
@@ -123,23 +329,26 @@ class Cache(object):
         self.lock.acquire()
 
         self.preloads = [ ]
+        self.preload_requests = { }
         self.pin_cache = { }
-        self.cache = { }
+        self.thumbnail_cache.clear()
+        self.cache = LRUMap()
         self.first_preload_in_tick = True
         self.size_of_current_generation = 0
         self.total_cache_size = 0
+        self.total_cache_bytes = 0
 
         self.added.clear()
         
         self.lock.release()
     
-    # Increments time, and clears the list of images to be
-    # preloaded.
+    # Increments time, and cancels requests to preload images that
+    # weren't predicted by the last interaction.
     def tick(self):
 
         with self.lock:
             self.time += 1
-            self.preloads = [ ]
+            self.cancel_preloads(self.time - 1)
             self.first_preload_in_tick = True
             self.size_of_current_generation = 0
             self.added.clear()
@@ -149,11 +358,30 @@ class Cache(object):
             filename, line = renpy.exports.get_filename_line()
             renpy.display.ic_log.write("%s %d", filename, line)
             
-    # The preload thread can deal with this update, so we don't need
-    # to lock things. 
-    def end_tick(self):
-        self.preloads = [ ]
+    def cancel_preloads(self, time=None):
+        """
+        Cancels the requests to preload images that were last made
+        before `time`, or all requests if `time` is None. Requests that
+        were made again since then are kept, at their new priority.
+        Must be called with the lock held.
+        """
+
+        for image, request in self.preload_requests.items():
+            if time is None or request[3] < time:
+                request[2] = None
+                del self.preload_requests[image]
 
+        self.preloads = [ i for i in self.preloads if i[2] is not None ]
+        heapq.heapify(self.preloads)
+        
+    def end_prediction(self):
+        """
+        Called when prediction is complete, to cancel requests for the
+        images that are no longer predicted.
+        """
+
+        with self.lock:
+            self.cancel_preloads(self.time)
         
     # This returns the pygame surface corresponding to the provided
     # image. It also takes care of updating the age of images in the
@@ -169,66 +397,106 @@ class Cache(object):
             renpy.display.render.mutated_surface(surf)
             return surf
 
-        ce = None
-        
         # First try to grab the image out of the cache without locking it.
-        if image in self.cache:
-            ce = self.cache[image]
+        ce = self.cache.get(image, None)
 
-        # Now, grab the cache and try again. This deals with the case where the image
-        # was already in the middle of preloading.            
+        # Otherwise, load it, or wait for the thread that's loading it.
         if ce is None:
-            
-            self.lock.acquire()
-            ce = self.cache.get(image, None)
+            ce = self.load(image, predict)
+                        
+        # Move it into the current generation, which also makes it the
+        # most recently used entry in the cache.
+        if ce.time != self.time:
+            with self.lock:
+                if ce.time != self.time and image in self.cache:
+                    ce.time = self.time
+                    self.size_of_current_generation += ce.size
 
+                    self.cache.touch(image)
+
+        # Done... return the surface.
+        return ce.surf
+
+    def load(self, image, predict):
+        """
+        Loads `image` and adds it to the cache, returning the new
+        CacheEntry. The image is loaded without holding the lock, so
+        other threads can load images at the same time. If another
+        thread is already loading `image`, this waits for it to finish,
+        rather than loading the image a second time.
+        """
+
+        with self.lock:
+
+            while image in self.loading:
+                self.loaded.wait()
+
+            ce = self.cache.get(image, None)
             if ce is not None:
-                self.lock.release()
+                return ce
+
+            if image in self.pin_cache:
+                surf = self.pin_cache[image]
+            else:
+                surf = self.thumbnail_cache.pop(image, None)
+
+            self.loading.add(image)
+
+        try:
+            if surf is None:
+                surf = image.load()
                 
-        # Otherwise, we keep the lock, and load the image ourselves.
-        if ce is None:
-                        
-            try:
-                if image in self.pin_cache:
-                    surf = self.pin_cache[image]
-                else:
-                    surf = image.load()
-                    
-            except:
-                self.lock.release()
-                raise
+        except:
+            with self.lock:
+                self.loading.discard(image)
+                self.loaded.notifyAll()
+
+            raise
+
+        with self.lock:
+            
+            if image.thumbnail:
+                self.add_thumbnail(image, surf)
                 
             ce = CacheEntry(image, surf)
-            self.total_cache_size += ce.size
-            self.cache[image] = ce
 
             # Indicate that this surface had changed.
             renpy.display.render.mutated_surface(ce.surf)
 
+            # This only prepares the texture. It's uploaded to the GPU
+            # by the main thread, the first time it's drawn.
+            texture = renpy.display.draw.load_texture(ce.surf)
+            ce.bytes += texture_size(ce.surf, texture)
+            
+            self.total_cache_size += ce.size
+            self.total_cache_bytes += ce.bytes
+            self.cache[image] = ce
+
             if renpy.config.debug_image_cache:
 
                 if predict:
                     renpy.display.ic_log.write("Added %r (%.02f%%)", ce.what, 100.0 * self.total_cache_size / self.cache_limit)
                 else:
                     renpy.display.ic_log.write("Total Miss %r", ce.what)
-                    
-            renpy.display.draw.load_texture(ce.surf)
 
-            self.lock.release()
-                        
-        # Move it into the current generation. This isn't protected by
-        # a lock, so in certain circumstances we could have an
-        # inaccurate size. But that's pretty unlikely, as the
-        # preloading thread should never run at the same time as an
-        # actual load from the normal thread.
-            
-        if ce.time != self.time:
-            ce.time = self.time
-            self.size_of_current_generation += ce.size
+            self.loading.discard(image)
+            self.loaded.notifyAll()
 
-        # Done... return the surface.
-        return ce.surf
+        return ce
+    
+    
+    def add_thumbnail(self, image, surf):
+        """
+        Adds `surf` to the thumbnail cache, making it the most recently
+        used thumbnail, and removes the least recently used thumbnails
+        if there are too many. Must be called with the lock held.
+        """
 
+        self.thumbnail_cache[image] = surf
+
+        while len(self.thumbnail_cache) > renpy.config.thumbnail_cache_size:
+            image, _surf = self.thumbnail_cache.oldest()
+            del self.thumbnail_cache[image]
     
     # This kills off a given cache entry.
     def kill(self, ce):
@@ -238,6 +506,7 @@ class Cache(object):
             self.size_of_current_generation -= ce.size
 
         self.total_cache_size -= ce.size
+        self.total_cache_bytes -= ce.bytes
         del self.cache[ce.what]
 
         if renpy.config.debug_image_cache:
@@ -250,14 +519,12 @@ class Cache(object):
         bigger and we don't want to continue preloading.
         """
 
-        # If we're within the limit, return.
-        if self.total_cache_size <= self.cache_limit:
-            return True
-
         # If we're outside the cache limit, we need to go and start
-        # killing off some of the entries until we're back inside it.
-        
-        for ce in sorted(self.cache.itervalues(), key=lambda a : a.time):
+        # killing off the least recently used entries until we're back
+        # inside it.
+        while self.over_limit():
+
+            _image, ce = self.cache.oldest()
         
             if ce.time == self.time:
                 # If we're bigger than the limit, and there's nothing
@@ -267,22 +534,45 @@ class Cache(object):
             # Otherwise, kill off the given cache entry.
             self.kill(ce)
 
-            # If we're in the limit, we're done.
-            if self.total_cache_size <= self.cache_limit:
-                break
-
         return True
+
+    def over_limit(self):
+        """
+        Returns True if the cache is bigger than either of its limits.
+        """
+
+        if self.total_cache_size > self.cache_limit:
+            return True
+
+        if self.cache_bytes_limit is not None and self.total_cache_bytes > self.cache_bytes_limit:
+            return True
+
+        return False
             
 
     # Called to report that a given image would like to be preloaded.
-    def preload_image(self, im):
+    # `priority` is a tuple, and images with a lower priority are
+    # preloaded first.
+    def preload_image(self, im, priority=(0, 0)):
 
         if not isinstance(im, ImageBase):
             return
             
         with self.lock:
 
-            if im in self.added:
+            request = self.preload_requests.get(im, None)
+
+            if request is not None:
+                request[3] = self.time
+                
+                if request[0] <= priority:
+                    return
+
+                # Cancel the old request, and make a new one at the
+                # better priority.
+                request[2] = None
+
+            elif im in self.added:
                 return
 
             self.added.add(im)
@@ -290,54 +580,78 @@ class Cache(object):
             if im in self.cache:
                 self.get(im)
                 in_cache = True
+            elif im in self.loading:
+                in_cache = False
             else:
-                self.preloads.append(im)
+                request = [ priority, self.preload_serial, im, self.time ]
+                self.preload_serial += 1
+                
+                heapq.heappush(self.preloads, request)
+                self.preload_requests[im] = request
+
                 self.lock.notify()
                 in_cache = False
 
         if in_cache and renpy.config.debug_image_cache:
             renpy.display.ic_log.write("Kept %r", im)
 
-    def preload_thread_main(self):
-
+    def preload_thread_main(self, pins):
+        """
+        The main function of a preload thread. Each thread takes images
+        off the list of preloads, and loads them. If `pins` is true, this
+        thread also loads pinned images, when there's nothing else to do.
+        """
+        
         while self.keep_preloading:
 
-            self.lock.acquire()
-            self.lock.wait()
-            self.lock.release()
-
-            while self.preloads and self.keep_preloading:
-        
-                # If the size of the current generation is bigger than the
-                # total cache size, stop preloading.
-                if self.size_of_current_generation > self.cache_limit:
+            with self.lock:
+                if not self.preloads:
+                    self.lock.wait()
 
-                    if renpy.config.debug_image_cache:
-                        for i in self.preloads:
-                            renpy.display.ic_log.write("Overfull %r", i)
+            while self.keep_preloading:
 
-                    self.preloads = [ ]
-                    break
-                
                 with self.lock:
 
-                    try:
-                        image = self.preloads.pop(0)                    
+                    if not self.preloads:
+                        break
+                    
+                    # If the size of the current generation is bigger than the
+                    # total cache size, stop preloading.
+                    if self.size_of_current_generation > self.cache_limit:
 
-                        if image not in self.preload_blacklist:
-                            try:
-                                self.get(image, True)
-                            except:
-                                self.preload_blacklist.add(image)                        
+                        if renpy.config.debug_image_cache:
+                            for i in sorted(self.preloads):
+                                if i[2] is not None:
+                                    renpy.display.ic_log.write("Overfull %r", i[2])
 
-                    except:
-                        pass
+                        self.cancel_preloads()
+                        break
+
+                    image = heapq.heappop(self.preloads)[2]
 
+                    # Skip cancelled requests.
+                    if image is None:
+                        continue
+                    
+                    del self.preload_requests[image]
+
+                    if image in self.preload_blacklist:
+                        continue
+
+                # Load the image without the lock, so the other threads
+                # can load images at the same time.
+                try:
+                    self.get(image, True)
+                except:
+                    with self.lock:
+                        self.preload_blacklist.add(image)                        
+
+                with self.lock:
                     if not self.cleanout():
-                        self.preloads = [ ]
+                        self.cancel_preloads()
 
             # If we have time, preload pinned images.
-            if self.keep_preloading and not renpy.game.less_memory:
+            if pins and self.keep_preloading and not renpy.game.less_memory:
 
                 workset = set(renpy.store._cache_pin_set)
 
@@ -391,6 +705,10 @@ class ImageBase(renpy.display.core.Displayable):
 
     __version__ = 1
 
+    # True if this image is a save thumbnail, that should be kept in
+    # the thumbnail cache.
+    thumbnail = False
+    
     def after_upgrade(self, version):
         if version < 1:
             self.cache = True
@@ -448,6 +766,26 @@ class ImageBase(renpy.display.core.Displayable):
 
         return [ ]
 
+    def get_color_op(self):
+        """
+        If this image changes the colors of another image in a way
+        renpy.display.imarray knows how to do, returns a (child, kind,
+        data) tuple, where kind is one of "matrix", "linear", "map", or
+        "mask". Otherwise, returns None.
+        """
+
+        return None
+
+    def get_geometry_op(self):
+        """
+        If this image crops, scales, or flips another image in a way
+        renpy.display.imfuse knows how to do, returns a (child, kind,
+        data) tuple, where kind is one of "crop", "scale",
+        "factorscale", or "flip". Otherwise, returns None.
+        """
+
+        return None
+
 class Image(ImageBase):
     """
     This image manipulator loads an image from a file.
@@ -499,13 +837,63 @@ class Image(ImageBase):
 
 class ZipFileImage(ImageBase):
 
-    def __init__(self, zipfilename, filename, mtime=0, **properties):
+    thumbnail = True
+    
+    # If not None, an (offset, length, compress_type) tuple giving the
+    # location of the file's data inside the zip file, so it can be read
+    # without reading the zip file's directory.
+    member = None
+
+    # If not None, the contents of the file, when they're already known,
+    # so the zip file doesn't need to be read at all.
+    data = None
+    
+    def __init__(self, zipfilename, filename, mtime=0, member=None, data=None, **properties):
         super(ZipFileImage, self).__init__(zipfilename, filename, mtime, **properties)
 
         self.zipfilename = zipfilename
         self.filename = filename
+        self.member = member
+        self.data = data
+
+    def read_member(self):
+        """
+        Reads the file's data using self.member.
+        """
+
+        offset, length, compress_type = self.member
 
+        f = file(self.zipfilename, "rb")
+        f.seek(offset)
+        data = f.read(length)
+        f.close()
+
+        if len(data) != length:
+            raise Exception("Zip file member is truncated.")
+        
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompressobj(-15).decompress(data)
+        elif compress_type != zipfile.ZIP_STORED:
+            raise Exception("Unknown zip compression type.")
+                
+        return data
+        
     def load(self):
+
+        if self.data is not None:
+            try:
+                sio = cStringIO.StringIO(self.data)
+                return renpy.display.pgrender.load_image(sio, self.filename)
+            except:
+                pass
+        
+        if self.member is not None:
+            try:
+                sio = cStringIO.StringIO(self.read_member())
+                return renpy.display.pgrender.load_image(sio, self.filename)
+            except:
+                pass
+        
         try:
             zf = zipfile.ZipFile(self.zipfilename, 'r')
             data = zf.read(self.filename)
@@ -614,9 +1002,16 @@ class Scale(ImageBase):
 
     def get_mtime(self):
         return self.image.get_mtime()
-        
+
+    def get_geometry_op(self):
+        return self.image, "scale", (self.width, self.height, self.bilinear)
+    
     def load(self):
 
+        rv = renpy.display.imfuse.load(self)
+        if rv is not None:
+            return rv
+        
         child = cache.get(self.image)
         
         if self.bilinear:
@@ -670,8 +1065,15 @@ class FactorScale(ImageBase):
     def get_mtime(self):
         return self.image.get_mtime()
 
+    def get_geometry_op(self):
+        return self.image, "factorscale", (self.width, self.height, self.bilinear)
+    
     def load(self):
 
+        rv = renpy.display.imfuse.load(self)
+        if rv is not None:
+            return rv
+        
         surf = cache.get(self.image)
         width, height = surf.get_size()
 
@@ -726,9 +1128,16 @@ class Flip(ImageBase):
 
     def get_mtime(self):
         return self.image.get_mtime()
+
+    def get_geometry_op(self):
+        return self.image, "flip", (self.horizontal, self.vertical)
         
     def load(self):
 
+        rv = renpy.display.imfuse.load(self)
+        if rv is not None:
+            return rv
+        
         child = cache.get(self.image)
         
         try:
@@ -819,7 +1228,15 @@ class Crop(ImageBase):
     def get_mtime(self):
         return self.image.get_mtime()
 
+    def get_geometry_op(self):
+        return self.image, "crop", (self.x, self.y, self.w, self.h)
+    
     def load(self):
+
+        rv = renpy.display.imfuse.load(self)
+        if rv is not None:
+            return rv
+        
         return cache.get(self.image).subsurface((self.x, self.y,
                                                  self.w, self.h))
 
@@ -879,8 +1296,19 @@ class Map(ImageBase):
     def get_mtime(self):
         return self.image.get_mtime()
 
+    def get_color_op(self):
+        return self.image, "map", (self.rmap, self.gmap, self.bmap, self.amap)
+    
     def load(self):
 
+        rv = renpy.display.imfuse.load(self)
+        if rv is not None:
+            return rv
+
+        rv = renpy.display.imarray.load(self)
+        if rv is not None:
+            return rv
+        
         surf = cache.get(self.image)
 
         rv = renpy.display.pgrender.surface(surf.get_size(), True)
@@ -921,8 +1349,26 @@ class Twocolor(ImageBase):
     def get_mtime(self):
         return self.image.get_mtime()
 
+    def get_color_op(self):
+        wr, wg, wb, wa = self.white
+        br, bg, bb, _ba = self.black
+
+        # This matches what renpy.display.module.twomap does.
+        if br == 0 and bg == 0 and bb == 0:
+            return self.image, "linear", (wr + 1, wg + 1, wb + 1, wa + 1)
+        else:
+            return self.image, "map", (ramp(br, wr), ramp(bg, wg), ramp(bb, wb), ramp(0, wa))
+    
     def load(self):
 
+        rv = renpy.display.imfuse.load(self)
+        if rv is not None:
+            return rv
+
+        rv = renpy.display.imarray.load(self)
+        if rv is not None:
+            return rv
+        
         surf = cache.get(self.image)
 
         rv = renpy.display.pgrender.surface(surf.get_size(), True)
@@ -961,8 +1407,19 @@ class Recolor(ImageBase):
     def get_mtime(self):
         return self.image.get_mtime()
 
+    def get_color_op(self):
+        return self.image, "linear", (self.rmul, self.gmul, self.bmul, self.amul)
+    
     def load(self):
 
+        rv = renpy.display.imfuse.load(self)
+        if rv is not None:
+            return rv
+
+        rv = renpy.display.imarray.load(self)
+        if rv is not None:
+            return rv
+        
         surf = cache.get(self.image)
 
         rv = renpy.display.pgrender.surface(surf.get_size(), True)
@@ -1023,8 +1480,19 @@ class MatrixColor(ImageBase):
     def get_mtime(self):
         return self.image.get_mtime()
         
+    def get_color_op(self):
+        return self.image, "matrix", self.matrix
+    
     def load(self):
 
+        rv = renpy.display.imfuse.load(self)
+        if rv is not None:
+            return rv
+
+        rv = renpy.display.imarray.load(self)
+        if rv is not None:
+            return rv
+        
         surf = cache.get(self.image)
 
         rv = renpy.display.pgrender.surface(surf.get_size(), True)
@@ -1449,8 +1917,15 @@ class AlphaMask(ImageBase):
     def get_mtime(self):
         return max(self.base.get_mtime(), self.image.get_mtime())
 
+    def get_color_op(self):
+        return self.base, "mask", self.mask
+    
     def load(self):
 
+        rv = renpy.display.imarray.load(self)
+        if rv is not None:
+            return rv
+        
         basesurf = cache.get(self.base)
         masksurf = cache.get(self.mask)
 
@@ -0,0 +1,307 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file runs chains of color image manipulators (like
+# im.Recolor(im.MatrixColor(...))) using NumPy, if it's available. The
+# whole chain is applied to the pixels of the source image at once, so
+# the images in the middle of the chain never need to be loaded, or to
+# take up space in the image cache.
+
+import renpy.display
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def chain(im):
+    """
+    Finds the chain of color operations that ends with `im`. Returns a
+    (source, ops) tuple, where source is the image the chain starts
+    with, and ops is a list of (kind, data) tuples giving the
+    operations to apply to it, in order.
+
+    The chain stops at the first image that isn't a color operation,
+    or that's already in the image cache.
+    """
+
+    cache = renpy.display.im.cache.cache
+
+    ops = [ ]
+
+    while True:
+        op = im.get_color_op()
+
+        if op is None:
+            break
+
+        child, kind, data = op
+        ops.append((kind, data))
+
+        im = child
+
+        if im in cache:
+            break
+
+    ops.reverse()
+
+    return im, ops
+
+def clamps(m):
+    """
+    Returns True if the 5x5 color matrix `m` can produce a color outside
+    of the range 0.0 to 1.0, which would be clamped, from a color inside
+    that range.
+    """
+
+    m = m[:4]
+
+    lo = m[:, 4] + numpy.minimum(m[:, :4], 0).sum(axis=1)
+    hi = m[:, 4] + numpy.maximum(m[:, :4], 0).sum(axis=1)
+
+    # Allow for rounding error in matrices that keep colors in range.
+    return bool((lo < -1.0 / 512).any() or (hi > 1 + 1.0 / 512).any())
+
+def matrix(data):
+    """
+    Returns the color matrix `data` as a 5x5 array. Only the first 20
+    elements are used, as they're all that module.colormatrix uses, so
+    the last row is always the identity.
+    """
+
+    return numpy.array(tuple(data)[:20] + (0, 0, 0, 0, 1), numpy.float64).reshape((5, 5))
+
+def combine(ops):
+    """
+    Given a list of (kind, data) color operations, returns an
+    equivalent list that's ready to be applied to an array. Linear
+    operations are turned into matrices, and adjacent matrices and
+    adjacent maps are combined into a single operation.
+
+    A matrix is only combined with the one after it if it can't produce
+    colors that would be clamped, so the result is the same as applying
+    the matrices one at a time.
+    """
+
+    rv = [ ]
+
+    for kind, data in ops:
+
+        if kind == "linear":
+            kind = "matrix"
+            data = numpy.diag([ i / 256.0 for i in data ] + [ 1.0 ])
+
+        elif kind == "matrix":
+            data = matrix(data)
+
+        elif kind == "map":
+            data = [ numpy.fromstring(i, numpy.uint8) for i in data ]
+
+        if rv and rv[-1][0] == kind:
+
+            if kind == "matrix" and not clamps(rv[-1][1]):
+                rv[-1] = (kind, numpy.dot(data, rv[-1][1]))
+                continue
+
+            if kind == "map":
+                rv[-1] = (kind, [ b[a] for a, b in zip(rv[-1][1], data) ])
+                continue
+
+        rv.append((kind, data))
+
+    return rv
+
+def surface_array(surf):
+    """
+    Returns a (height, width, 4) array that's a view of the pixels of
+    `surf`, without copying them. The components of each pixel are in
+    the order they're stored in the surface. The surface is locked
+    until the array is freed.
+    """
+
+    w, h = surf.get_size()
+    pitch = surf.get_pitch()
+
+    rv = numpy.frombuffer(surf.get_buffer(), numpy.uint8, (h - 1) * pitch + w * 4)
+    return numpy.lib.stride_tricks.as_strided(rv, (h, w, 4), (pitch, 4, 1))
+
+def get_pixels(surf):
+    """
+    Returns a (height, width, 4) array containing the red, green, blue,
+    and alpha components of the pixels of `surf`.
+    """
+
+    return surface_array(surf)[:, :, renpy.display.module.byte_offset(surf)]
+
+def set_pixels(surf, pixels):
+    """
+    Sets the pixels of `surf` from `pixels`, an array like the ones
+    returned by get_pixels.
+    """
+
+    surface_array(surf)[:, :, renpy.display.module.byte_offset(surf)] = pixels
+
+def apply(pixels, kind, data):
+    """
+    Applies a single operation to `pixels`, which is an array of
+    float32 or uint8 values. Returns the new array, which may be of
+    either type.
+    """
+
+    if kind == "matrix":
+        m = numpy.asarray(data, numpy.float32)
+
+        # Multiplying a two-dimensional array is much faster.
+        h, w, _ = pixels.shape
+        pixels = pixels.astype(numpy.float32).reshape((h * w, 4))
+
+        pixels = numpy.dot(pixels, m[:4, :4].T)
+        pixels += m[:4, 4] * 255
+
+        return pixels.reshape((h, w, 4))
+
+    pixels = to_uint8(pixels)
+
+    if kind == "map":
+        rv = numpy.empty_like(pixels)
+
+        for i in range(4):
+            rv[:, :, i] = data[i][pixels[:, :, i]]
+
+        return rv
+
+    if kind == "mask":
+        mask = get_pixels(renpy.display.im.cache.get(data))
+
+        if mask.shape != pixels.shape:
+            raise Exception("AlphaMask surfaces must be the same size.")
+
+        pixels = pixels.copy()
+        pixels[:, :, 3] = mask[:, :, 0]
+        return pixels
+
+    raise Exception("Unknown color operation %r." % kind)
+
+def to_uint8(pixels):
+    """
+    Clamps `pixels` to the range 0-255, and converts it to uint8.
+    """
+
+    if pixels.dtype == numpy.uint8:
+        return pixels
+
+    numpy.clip(pixels, 0, 255, pixels)
+    return pixels.astype(numpy.uint8)
+
+def load(im):
+    """
+    Loads `im`, which is a color operation, by applying its chain of
+    color operations to the source image at once. Returns the new
+    surface, or None if NumPy isn't available or the chain is too short
+    to make it worthwhile, in which case the image should be loaded
+    normally.
+    """
+
+    if numpy is None or not renpy.config.numpy_image_operations:
+        return None
+
+    source, ops = chain(im)
+
+    # If the chain is just this operation, it's faster to load it
+    # normally.
+    if source is im.get_color_op()[0]:
+        return None
+
+    return run(renpy.display.im.cache.get(source), ops)
+
+def run(surf, ops):
+    """
+    Applies `ops`, a list of (kind, data) color operations, to the
+    surface `surf`, and returns a new surface.
+    """
+
+    pixels = get_pixels(surf)
+
+    # Colors are clamped after each operation, as they are when the
+    # operations are applied one at a time.
+    for kind, data in combine(ops):
+        pixels = to_uint8(apply(pixels, kind, data))
+
+    rv = renpy.display.pgrender.surface(surf.get_size(), True)
+    set_pixels(rv, pixels)
+
+    return rv
+
+def benchmark(im, repeat=10):
+    """
+    Prints how long it takes to load the color operation `im` with
+    NumPy, and without it. This can be called from the console, to find
+    out which is faster for a particular image.
+    """
+
+    cache = renpy.display.im.cache
+    old_config = renpy.config.numpy_image_operations
+
+    # The images in the chain that are loaded when NumPy isn't used.
+    chain_images = [ ]
+
+    if im.get_color_op() is None:
+        raise Exception("%r is not a color operation." % im)
+    
+    i = im
+    while i.get_color_op() is not None:
+        i = i.get_color_op()[0]
+        chain_images.append(i)
+
+    chain_images.pop()
+
+    def time_load(numpy_image_operations):
+        renpy.config.numpy_image_operations = numpy_image_operations
+
+        start = time.time()
+
+        for _i in range(repeat):
+
+            with cache.lock:
+                for i in chain_images:
+                    if i in cache.cache:
+                        cache.kill(cache.cache[i])
+
+            im.load()
+
+        return (time.time() - start) * 1000.0 / repeat
+
+    try:
+        without_numpy = time_load(False)
+
+        if numpy is not None:
+            with_numpy = time_load(True)
+        else:
+            with_numpy = None
+
+    finally:
+        renpy.config.numpy_image_operations = old_config
+
+    if with_numpy is None:
+        print "%r: %.3f ms per load, NumPy is not available." % (im, without_numpy)
+    else:
+        print "%r: %.3f ms per load with NumPy, %.3f ms without." % (im, with_numpy, without_numpy)
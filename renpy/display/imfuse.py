@@ -0,0 +1,314 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file loads chains of image manipulators, like
+# im.Scale(im.Crop(im.Flip(...))), as a single operation. The chain is
+# turned into a crop of the source image, followed by a scale, a flip,
+# and a series of color operations, so the images in the middle of the
+# chain are never loaded, and never take up space in the image cache.
+
+import renpy.display
+import weakref
+
+# A map from an image that's been found in the middle of a chain to a
+# weak reference to the image that it was found under. This is weakly
+# keyed, so it doesn't keep images that are no longer used alive.
+parents = weakref.WeakKeyDictionary()
+
+# A weakly-keyed map with the images that have been found in the middle
+# of more than one chain as its keys.
+shared = weakref.WeakKeyDictionary()
+
+def is_shared(child, parent):
+    """
+    Records that `child` was found under `parent` in a chain, and returns
+    True if it's been found under a different image before. Must be
+    called with the image cache lock held.
+    """
+
+    if child in shared:
+        return True
+
+    ref = parents.get(child, None)
+    old = ref and ref()
+
+    if old is None:
+        parents[child] = weakref.ref(parent)
+        return False
+
+    if old == parent:
+        return False
+
+    shared[child] = True
+    return True
+
+def chain(im):
+    """
+    Finds the chain of operations that ends with `im`. Returns a
+    (source, ops) tuple, where source is the image the chain starts
+    with, and ops is a list of (kind, data) tuples giving the operations
+    to apply to it, in order.
+
+    The chain stops at the first image that isn't an operation that can
+    be fused, that's already in the image cache, or that's shared with
+    another chain, if config.cache_shared_image_operations is true.
+    """
+
+    cache = renpy.display.im.cache
+
+    ops = [ ]
+
+    with cache.lock:
+
+        while True:
+            op = im.get_geometry_op() or im.get_color_op()
+
+            if op is None:
+                break
+
+            child, kind, data = op
+
+            if kind == "mask":
+                break
+
+            ops.append((kind, data))
+
+            if child in cache.cache:
+                im = child
+                break
+
+            child_shared = is_shared(child, im)
+
+            im = child
+
+            if child_shared and renpy.config.cache_shared_image_operations:
+                break
+
+    ops.reverse()
+
+    return im, ops
+
+class Plan(object):
+    """
+    This represents a chain of operations as a crop of the source image,
+    followed by a scale, a flip, and a list of color operations.
+    """
+
+    def __init__(self, width, height):
+
+        # The rectangle of the source image that's used.
+        self.rect = (0, 0, width, height)
+
+        # The size the image is scaled to.
+        self.size = (width, height)
+
+        # If the image is scaled, True if the scaling is bilinear, False
+        # if it's nearest-neighbor. None if it isn't scaled.
+        self.bilinear = None
+
+        # Is the image flipped?
+        self.horizontal = False
+        self.vertical = False
+
+        # The list of color operations, as (kind, data) tuples.
+        self.colors = [ ]
+
+    def add(self, kind, data):
+        """
+        Adds an operation to the plan. Returns False if the operation
+        can't be combined with the ones already in the plan.
+        """
+
+        if kind == "crop":
+            return self.crop(*data)
+
+        elif kind == "flip":
+            horizontal, vertical = data
+
+            self.horizontal = bool(horizontal) != self.horizontal
+            self.vertical = bool(vertical) != self.vertical
+
+            return True
+
+        elif kind == "scale":
+            return self.scale(*data)
+
+        elif kind == "factorscale":
+            width, height, bilinear = data
+            ow, oh = self.size
+
+            return self.scale(int(ow * width), int(oh * height), bilinear)
+
+        else:
+            self.colors.append((kind, data))
+            return True
+
+    def crop(self, x, y, w, h):
+
+        ow, oh = self.size
+        rx, ry, rw, rh = self.rect
+
+        if x < 0 or y < 0 or x + w > ow or y + h > oh:
+            raise ValueError("subsurface rectangle outside surface area")
+
+        # Crops commute with flips, once they're flipped themselves.
+        if self.horizontal:
+            x = ow - x - w
+
+        if self.vertical:
+            y = oh - y - h
+
+        # Bilinear scaling blends in the pixels just outside of the
+        # crop, so the crop can't be moved before it.
+        if self.bilinear:
+            return False
+
+        # A crop of a scaled image can only be done first if it's on a
+        # pixel boundary of the source image.
+        if (x * rw) % ow or (y * rh) % oh or (w * rw) % ow or (h * rh) % oh:
+            return False
+
+        self.rect = (rx + x * rw // ow, ry + y * rh // oh, w * rw // ow, h * rh // oh)
+        self.size = (w, h)
+
+        return True
+
+    def scale(self, width, height, bilinear):
+
+        # A second scale can't be combined with the first, as the result
+        # depends on the size of the image in between.
+        if self.bilinear is not None:
+            return False
+
+        # The flip is done after the scale, and with nearest-neighbor
+        # scaling, flipping first can sample different pixels.
+        if self.horizontal or self.vertical:
+            return False
+
+        # Maps don't commute with scaling, and matrices only do if they
+        # can't clamp. Bilinear scaling blends colors, and so gives
+        # different results when the colors have been rounded first.
+        for kind, data in self.colors:
+            if kind == "map" or bilinear:
+                return False
+
+            if kind == "matrix" and matrix_clamps(data):
+                return False
+
+        self.size = (width, height)
+        self.bilinear = bool(bilinear)
+
+        return True
+
+    def execute(self, surf):
+        """
+        Applies the plan to the source surface, and returns the result.
+        """
+
+        if self.rect != (0, 0) + surf.get_size():
+            surf = surf.subsurface(self.rect)
+
+        if self.size != surf.get_size():
+
+            try:
+                renpy.display.render.blit_lock.acquire()
+
+                if self.bilinear:
+                    surf = renpy.display.scale.smoothscale(surf, self.size)
+                else:
+                    surf = renpy.display.pgrender.transform_scale(surf, self.size)
+
+            finally:
+                renpy.display.render.blit_lock.release()
+
+        if self.horizontal or self.vertical:
+
+            try:
+                renpy.display.render.blit_lock.acquire()
+                surf = renpy.display.pgrender.flip(surf, self.horizontal, self.vertical)
+            finally:
+                renpy.display.render.blit_lock.release()
+
+        if not self.colors:
+            return surf
+
+        if renpy.display.imarray.numpy is not None and renpy.config.numpy_image_operations:
+            return renpy.display.imarray.run(surf, self.colors)
+
+        for kind, data in self.colors:
+
+            rv = renpy.display.pgrender.surface(surf.get_size(), True)
+
+            if kind == "matrix":
+                renpy.display.module.colormatrix(surf, rv, data)
+            elif kind == "linear":
+                renpy.display.module.linmap(surf, rv, *data)
+            elif kind == "map":
+                renpy.display.module.map(surf, rv, *data)
+
+            surf = rv
+
+        return surf
+
+def matrix_clamps(data):
+    """
+    Returns True if the color matrix `data` can clamp colors. Without
+    numpy, this can't be checked, and every matrix is assumed to clamp.
+    """
+
+    imarray = renpy.display.imarray
+
+    if imarray.numpy is None:
+        return True
+
+    return imarray.clamps(imarray.matrix(data))
+
+def load(im):
+    """
+    Loads `im` by applying its chain of operations to the source image
+    as a single operation. Returns the new surface, or None if the
+    chain can't be combined, or if it only contains color operations,
+    in which case the image should be loaded normally.
+    """
+
+    if not renpy.config.fuse_image_operations:
+        return None
+
+    source, ops = chain(im)
+
+    if len(ops) < 2:
+        return None
+
+    for kind, _data in ops:
+        if kind in ("crop", "flip", "scale", "factorscale"):
+            break
+    else:
+        return None
+
+    surf = renpy.display.im.cache.get(source)
+
+    plan = Plan(*surf.get_size())
+
+    for kind, data in ops:
+        if not plan.add(kind, data):
+            return None
+
+    return plan.execute(surf)
@@ -25,9 +25,21 @@ import renpy.display
 
 # Called to indicate an image should be loaded or preloaded. This is
 # a function that takes an image manipulator, set by reset and predict,
-# and winds up bound to either im.cache.get or im.cache.preload_image
+# and winds up bound to either im.cache.get or preload.
 image = None
 
+# The phases of prediction. Images predicted in an earlier phase are
+# preloaded before images predicted in a later phase.
+SCRIPT = 0
+RETURN = 1
+ACTION = 2
+SCREEN = 3
+
+# The priority that predicted images are preloaded with. This is a
+# (phase, distance) tuple, where distance is the distance from the
+# current statement, or the number of the screen being predicted.
+priority = (SCRIPT, 0)
+
 # The set of displayables we've predicted since reset was last called.
 predicted = set()
 
@@ -59,6 +71,13 @@ def screen(_screen_name, **kwargs):
     screens.append((_screen_name, kwargs))
 
     
+def preload(im):
+    """
+    Queues the image `im` up for preloading, at the current priority.
+    """
+
+    renpy.display.im.cache.preload_image(im, priority)
+    
 def reset():
     global image
     image = renpy.display.im.cache.get
@@ -74,14 +93,16 @@ def prediction_coroutine(root_widget):
     """
 
     global predicting
+    global priority
     
     # Set up the image prediction method.
     global image
-    image = renpy.display.im.cache.preload_image
+    image = preload
 
     # Predict images that are going to be reached in the next few
-    # clicks.
+    # clicks. The context sets the distance of each statement.
     predicting = True
+    priority = (SCRIPT, 0)
 
     renpy.game.context().predict()
 
@@ -92,6 +113,7 @@ def prediction_coroutine(root_widget):
     # shortly. Otherwise, call the functions in
     # config.predict_callbacks.
     predicting = True
+    priority = (RETURN, 0)
     
     if len(renpy.game.contexts) >= 2:
         sls = renpy.game.contexts[-2].scene_lists
@@ -114,6 +136,7 @@ def prediction_coroutine(root_widget):
     # Predict things (especially screens) that are reachable through
     # an action.
     predicting = True
+    priority = (ACTION, 0)
 
     try:
         root_widget.visit_all(lambda i : i.predict_one_action())
@@ -123,10 +146,11 @@ def prediction_coroutine(root_widget):
     predicting = False
 
     # Predict the screens themselves.
-    for name, kwargs in screens:
+    for i, (name, kwargs) in enumerate(screens):
         yield True
 
         predicting = True
+        priority = (SCREEN, i)
         
         try:
             renpy.display.screen.predict_screen(name, **kwargs)
@@ -136,6 +160,9 @@ def prediction_coroutine(root_widget):
                 renpy.display.ic_log.exception()
 
         predicting = False
-            
+
+    # Cancel the preloading of images that are no longer predicted.
+    renpy.display.im.cache.end_prediction()
+    
     yield False
                 
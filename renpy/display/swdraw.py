@@ -1049,6 +1049,15 @@ class SWDraw(object):
         
         return surf
 
+    def texture_size(self, texture):
+        """
+        Returns the number of bytes used by a texture returned from
+        load_texture, beyond those used by its surface. The software
+        renderer draws directly from surfaces, so this is 0.
+        """
+
+        return 0
+    
     def solid_texture(self, w, h, color):
         """
         Creates a texture filled to the edges with color.
@@ -367,7 +367,7 @@ class Context(renpy.object.Object):
 
         old_images = self.images
         
-        nodes = [ (renpy.game.script.lookup(self.current), self.images) ]
+        nodes = [ (renpy.game.script.lookup(self.current), self.images, 0) ]
         node_set = set()
         
         for i in range(0, renpy.config.predict_statements):
@@ -375,9 +375,12 @@ class Context(renpy.object.Object):
             if i >= len(nodes):
                 break
 
-            node, images = nodes[i]
+            node, images, distance = nodes[i]
 
             self.images = renpy.display.image.ShownImageInfo(images)
+
+            # Images closer to the current statement are preloaded first.
+            renpy.display.predict.priority = (renpy.display.predict.SCRIPT, distance)
             
             # Ignore exceptions in prediction, so long as
             # prediction is not needed.
@@ -388,7 +391,7 @@ class Context(renpy.object.Object):
                         continue
 
                     if n not in node_set:
-                        nodes.append((n, self.images))
+                        nodes.append((n, self.images, distance + 1))
                         node_set.add(n)
             except:
 
@@ -933,7 +933,7 @@ def has_label(name):
 def get_all_labels():
     rv = [ ]
 
-    for i in renpy.game.script.namemap.iterkeys():
+    for i in renpy.game.script.all_names():
         if isinstance(i, basestring):
             rv.append(i)
 
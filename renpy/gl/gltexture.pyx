@@ -562,6 +562,20 @@ cdef class TextureGrid(object):
                 
     def get_size(self):
         return self.width, self.height
+
+    def get_bytes(self):
+        """
+        Returns the number of bytes of texture memory used by the
+        tiles of this texture grid.
+        """
+
+        rv = 0
+
+        for row in self.tiles:
+            for t in row:
+                rv += t.width * t.height * 4
+
+        return rv
     
     def subsurface(self, rect):
         """
@@ -501,6 +501,8 @@ def lint():
 
     # Iterate through every statement in the program, processing
     # them. We sort them in filename, linenumber order.
+
+    renpy.game.script.load_all_chunks()
     
     all_stmts = [ (i.filename, i.linenumber, i) for i in renpy.game.script.all_stmts ]
     all_stmts.sort()
@@ -22,9 +22,15 @@
 import renpy
 import os.path
 from pickle import loads
+import cPickle
 from cStringIO import StringIO
 import sys
 import types
+import time
+import struct
+import stat
+import hashlib
+import threading
 
 try:
     import android.apk
@@ -46,28 +52,42 @@ old_config_archives = None
 # A map from lower-case filename to regular-case filename.
 lower_map = { }
 
+# A lock that's held while the indexes are being rebuilt, as a file can
+# be looked up (and the indexes found to be out of date) by the preload
+# threads.
+index_lock = threading.RLock()
+
 def index_archives():
     """
-    Loads in the indexes for the archive files. Also updates the lower_map.
+    Loads in the indexes for the archive files. Also updates the lower_map
+    and the file index.
     """
 
-    # Update lower_map.
-    lower_map.clear()
-    
-    for dir, fn in listdirfiles(): #@ReservedAssignment
-        lower_map[fn.lower()] = fn
+    with index_lock:
 
-    # Index the archives.
-    
-    global old_config_archives
+        # Index the archives.
+        if old_config_archives != renpy.config.archives:
+            load_archive_indexes()
 
-    if old_config_archives == renpy.config.archives:
-        return
+        index_files()
+
+        
+def load_archive_indexes():
+    """
+    Loads the indexes of the archives in config.archives into archives.
+    """
+
+    global old_config_archives
 
     old_config_archives = renpy.config.archives[:]
-    
-    global archives
-    archives = [ ]
+
+    # The new list of archives is built here, and only replaces the old
+    # one once it's complete.
+    new_archives = [ ]
+
+    # The index is out of date until index_files is called.
+    invalidate_file_index()
+    close_archive_files()
 
     for prefix in renpy.config.archives:
 
@@ -78,6 +98,20 @@ def index_archives():
             f = file(fn, "rb")
             l = f.readline()
 
+            # 4.0 Branch.
+            if l.startswith("RPA-4.0 "):
+                offset = int(l[8:24], 16)
+                count = int(l[25:33], 16)
+                key = int(l[34:42], 16)
+
+                f.seek(offset)
+                data = f.read()
+
+                new_archives.append((prefix, ArchiveTable(data, 0, count, key)))
+
+                f.close()
+                continue
+                
             # 3.0 Branch.
             if l.startswith("RPA-3.0 "):
                 offset = int(l[8:24], 16)
@@ -94,7 +128,7 @@ def index_archives():
                     else:
                         index[k] = [ (offset ^ key, dlen ^ key, start) for offset, dlen, start in index[k] ]
 
-                archives.append((prefix, index))
+                new_archives.append((prefix, index))
                 
                 f.close()
                 continue
@@ -104,7 +138,7 @@ def index_archives():
                 offset = int(l[8:], 16)
                 f.seek(offset)
                 index = loads(f.read().decode("zlib"))
-                archives.append((prefix, index))
+                new_archives.append((prefix, index))
                 f.close()
                 continue
 
@@ -114,24 +148,453 @@ def index_archives():
             
             fn = transfn(prefix + ".rpi")
             index = loads(file(fn, "rb").read().decode("zlib")) 
-            archives.append((prefix, index))
+            new_archives.append((prefix, index))
 
         except:
             if renpy.config.debug:
                 raise
 
-def walkdir(dir): #@ReservedAssignment
-    rv = [ ]
+    global archives
+    archives = new_archives
+
+def archive_name_hash(name):
+    """
+    Returns the hash that the name is stored under in an RPA-4.0 archive
+    table. As the name is lower-cased first, lookups in the table are
+    case-insensitive.
+    """
+
+    if isinstance(name, str):
+        name = name.decode("utf-8")
+
+    return hashlib.md5(name.lower().encode("utf-8")).digest()[:8]
+
+class ArchiveTable(object):
+    """
+    The index of an RPA-4.0 archive. This is a table of fixed-size
+    records, sorted by the hash of the filename, followed by the
+    utf-8 encoded filenames. Each record consists of:
+
+    * The first 8 bytes of the md5 of the lower-cased filename.
+    * The offset of the file's data in the archive, xored with the key.
+    * The length of the file's data, xored with the key.
+    * Flags. (Reserved, currently always 0.)
+    * The offset of the filename, from the start of the names.
+    * The length of the filename.
+    
+    Rather than loading the whole index, lookups binary search the table
+    in place. This acts enough like the dict used as the index of other
+    archive versions that the rest of the loader can use it the same way.
+    """
+
+    record = struct.Struct(">8sQQIII")
+    
+    def __init__(self, data, base, count, key):
+
+        # A string containing the table.
+        self.data = data
+
+        # The offset of the table in data.
+        self.base = base
+
+        # The number of records in the table.
+        self.count = count
+
+        self.key = key
+
+        self.names_base = base + count * self.record.size
+
+    def get_record(self, i):
+        return self.record.unpack_from(self.data, self.base + i * self.record.size)
+
+    def get_name(self, record):
+        start = self.names_base + record[4]
+        return self.data[start:start + record[5]].decode("utf-8")
+    
+    def get_entry(self, record):
+        return [ (record[1] ^ self.key, record[2] ^ self.key, '') ]
+
+    def find(self, name):
+        """
+        Returns the record for `name`, or None if it's not in the table.
+        """
+
+        h = archive_name_hash(name)
+
+        if isinstance(name, str):
+            name = name.decode("utf-8")
+
+        name = name.lower()
+        
+        data = self.data
+        base = self.base
+        size = self.record.size
+        
+        lo = 0
+        hi = self.count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + mid * size
+            
+            if data[start:start + 8] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        while lo < self.count:
+            record = self.get_record(lo)
+
+            if record[0] != h:
+                break
+
+            if self.get_name(record).lower() == name:
+                return record
+
+            lo += 1
+
+        return None
+    
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def __getitem__(self, name):
+        record = self.find(name)
+
+        if record is None:
+            raise KeyError(name)
+
+        return self.get_entry(record)
+
+    def get(self, name, default=None):
+        record = self.find(name)
+
+        if record is None:
+            return default
+
+        return self.get_entry(record)
+
+    def __len__(self):
+        return self.count
+    
+    def iteritems(self):
+        for i in xrange(self.count):
+            record = self.get_record(i)
+            yield self.get_name(record), self.get_entry(record)
+
+    def iterkeys(self):
+        for i in xrange(self.count):
+            yield self.get_name(self.get_record(i))
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+        
+        
+# A map from filename to the location that a load of that file will
+# come from, or None if the index hasn't been built yet. A location is
+# one of:
+#
+# ("apk", apk, prefixed_name)
+# ("dir", full_filename)
+# ("archive", prefix, archive_index_entry)
+file_index = None
+
+# A list of (prefix, index) pairs for archives that are searched when a
+# file isn't in file_index.
+late_archives = [ ]
+
+# The state of the configuration the last time file_index was built. If
+# this changes, the index is rebuilt.
+file_index_key = None
+
+def get_file_index_key():
+    return (tuple(renpy.config.searchpath), tuple(renpy.config.archives),
+            renpy.config.basedir, renpy.config.force_archives)
+
+def index_files():
+    """
+    Builds file_index, which maps each known file to the one location
+    that load will get it from, and lower_map.
+    """
+
+    global file_index
+    global file_index_key
+    
+    index = { }
+    
+    for apk in apks:
+        for f in apk.list():
+            
+            # Strip off the "x-" in front of each filename, which is there
+            # to ensure that aapt actually includes every file.
+            name = "/".join(i[2:] for i in f.split("/"))
+
+            if name not in index:
+                index[name] = ("apk", apk, f)
+
+    lower_map.clear()
+            
+    for i in renpy.config.searchpath:
+        i = os.path.join(renpy.config.basedir, i)
+        for j in walkdir(i):
+
+            # Files on disk are only loaded if we're not forcing
+            # archives, but they still go into lower_map.
+            lower_map[j.lower()] = j
+
+            if renpy.config.force_archives:
+                continue
+            
+            if j not in index:
+                index[j] = ("dir", os.path.join(i, j))
+
+    # RPA-4.0 archives aren't copied into the index, as that would mean
+    # reading every entry. Instead, they (and any archive that's searched
+    # after one of them) are searched when a file isn't in the index.
+    new_late_archives = [ ]
+    
+    for prefix, aindex in archives:
+
+        if new_late_archives or isinstance(aindex, ArchiveTable):
+            new_late_archives.append((prefix, aindex))
+            continue
+        
+        for j, entry in aindex.iteritems():
+            if j not in index:
+                index[j] = ("archive", prefix, entry)
+
+    save_scan_cache()
+
+    for fn in index:
+        lower_map[fn.lower()] = fn
+
+    global late_archives
+    late_archives = new_late_archives
+
+    file_index = index
+    file_index_key = get_file_index_key()
+
+    loadable_cache.clear()
+    
+    if renpy.config.dump_file_index:
+        dump_file_index()
+
+def invalidate_file_index():
+    """
+    Discards the file index, so that it will be rebuilt the next time
+    a file is looked up.
+    """
+
+    global file_index
+    global file_index_key
+
+    file_index = None
+    file_index_key = None
+
+def dump_file_index(filename="file_index.txt"):
+    """
+    Dumps the file index to `filename`, listing where each file will be
+    loaded from.
+    """
+
+    if file_index is None:
+        return
+
+    f = file(filename, "w")
+
+    for name in sorted(file_index):
+        loc = file_index[name]
+
+        if loc[0] == "apk":
+            where = "apk " + loc[2]
+        elif loc[0] == "dir":
+            where = loc[1]
+        else:
+            where = "archive %s.rpa" % loc[1]
+
+        f.write("%s = %s\n" % (name.encode("utf-8"), where.encode("utf-8")))
+
+    seen = set()
+        
+    for prefix, aindex in late_archives:
+        for name in sorted(aindex.iterkeys()):
+            if name in file_index or name.lower() in seen:
+                continue
 
-    if not os.path.exists(dir) and not renpy.config.developer:
+            seen.add(name.lower())
+            f.write("%s = archive %s.rpa\n" % (name.encode("utf-8"), prefix.encode("utf-8")))
+            
+    f.close()
+    
+def locate(name):
+    """
+    Returns the location `name` will be loaded from, or None if it's not
+    in the file index. (In which case, the file might still exist, if
+    it was created after the index was built.)
+    """
+
+    if file_index is None:
+        return None
+
+    if file_index_key != get_file_index_key():
+        with index_lock:
+            if file_index_key != get_file_index_key():
+                index_archives()
+    
+    if isinstance(name, str):
+        try:
+            name = name.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+
+    rv = file_index.get(name, None)
+
+    if rv is not None:
         return rv
 
+    for prefix, aindex in late_archives:
+        entry = aindex.get(name, None)
+        if entry is not None:
+            return ("archive", prefix, entry)
+
+    return None
+        
+# The version of the directory scan cache.
+SCAN_CACHE_VERSION = 1
+
+# A map from directory name to a (mtime, entries) tuple, where entries
+# is a list of (name, isdir) pairs found in that directory when it was
+# last scanned. None if the cache hasn't been loaded yet.
+scan_cache = None
+
+# True if scan_cache has changed since it was loaded.
+scan_cache_dirty = False
+
+def scan_cache_filename():
+    return os.path.join(renpy.config.basedir, renpy.config.searchpath[0], "dirscan.rpyb")
+
+def load_scan_cache():
+    global scan_cache
+
+    scan_cache = { }
+
+    fn = scan_cache_filename()
+    
+    try:
+        f = file(fn, "rb")
+        version, cache = cPickle.loads(f.read().decode("zlib"))
+        f.close()
+
+        if version == SCAN_CACHE_VERSION:
+            scan_cache = cache
+    except:
+        pass
+
+    # Creating the cache file changes the mtime of the directory it's
+    # in, which would make the scan of that directory out of date. So
+    # if it doesn't exist, it's created before anything is scanned.
+    # Later saves overwrite it, which doesn't change the mtime.
+    if not os.path.exists(fn):
+        try:
+            file(fn, "wb").close()
+        except:
+            pass
+
+def save_scan_cache():
+    """
+    Writes out the directory scan cache, if it has changed.
+    """
+
+    global scan_cache_dirty
+    
+    if not scan_cache_dirty:
+        return
+
+    scan_cache_dirty = False
+
+    try:
+        data = (SCAN_CACHE_VERSION, scan_cache)
+        f = file(scan_cache_filename(), "wb")
+        f.write(cPickle.dumps(data, 2).encode("zlib"))
+        f.close()
+    except:
+        pass
+    
+def scan_directory(dir, mtime=None): #@ReservedAssignment
+    """
+    Returns a list of (name, isdir, mtime) tuples for the entries in
+    `dir`. If the mtime of dir hasn't changed since the last time it
+    was scanned, the entries are taken from the scan cache.
+
+    `mtime` is the mtime of dir, if it's known. The mtime of an entry
+    that's a directory is returned if it was found while scanning, so
+    it doesn't need to be found again when that directory is scanned.
+    Otherwise, it's None.
+    """
+
+    global scan_cache_dirty
+    
+    if scan_cache is None:
+        load_scan_cache()
+
+    if mtime is None:
+        mtime = os.stat(dir).st_mtime
+    
+    cached = scan_cache.get(dir, None)
+
+    if cached is not None and cached[0] == mtime:
+        return [ (name, isdir, None) for name, isdir in cached[1] ]
+
+    rv = [ ]
+    entries = [ ]
+    
     for i in os.listdir(dir):
         if i[0] == ".":
             continue
 
-        if os.path.isdir(dir + "/" + i):
-            for fn in walkdir(dir + "/" + i):
+        # One stat per entry, which gives both whether it's a directory
+        # and, if it is, its mtime.
+        try:
+            st = os.stat(dir + "/" + i)
+        except OSError:
+            st = None
+
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            rv.append((i, True, st.st_mtime))
+            entries.append((i, True))
+        else:
+            rv.append((i, False, None))
+            entries.append((i, False))
+
+    # An mtime only has a granularity of a second or two, so if the
+    # directory changed very recently, it could change again without
+    # its mtime changing. Don't trust the entries in that case.
+    if time.time() - mtime < 2:
+        mtime = None
+        
+    if cached != (mtime, entries):
+        scan_cache_dirty = True
+
+    scan_cache[dir] = (mtime, entries)
+        
+    return rv
+        
+def walkdir(dir, mtime=None): #@ReservedAssignment
+    """
+    Returns a list of the files in `dir` and its subdirectories. `mtime`
+    is the mtime of dir, if it's known.
+    """
+
+    rv = [ ]
+
+    if mtime is None and not os.path.exists(dir) and not renpy.config.developer:
+        return rv
+
+    for i, isdir, sub_mtime in scan_directory(dir, mtime):
+        if isdir:
+            for fn in walkdir(dir + "/" + i, sub_mtime):
                 rv.append(i + "/" + fn)
         else:
             rv.append(i)
@@ -171,7 +634,8 @@ def listdirfiles():
             if j not in seen:            
                 rv.append((None, j))
                 seen.add(j)
-            
+
+    save_scan_cache()
             
     return rv
     
@@ -192,8 +656,14 @@ class SubFile(object):
             
         self.f.seek(self.base)
 
+    def check_open(self):
+        if self.f is None:
+            raise ValueError("I/O operation on closed file")
+
     def read(self, length=None):
 
+        self.check_open()
+
         maxlength = self.length - self.offset
 
         if length is not None:
@@ -215,6 +685,8 @@ class SubFile(object):
 
     def readline(self, length=None):
 
+        self.check_open()
+
         maxlength = self.length - self.offset
         if length is not None:
             length = min(length, maxlength)
@@ -279,6 +751,8 @@ class SubFile(object):
     
     def seek(self, offset, whence=0):
 
+        self.check_open()
+
         if whence == 0:
             offset = offset
         elif whence == 1:
@@ -298,15 +772,80 @@ class SubFile(object):
         self.f.seek(offset + self.base)
 
     def tell(self):
+        self.check_open()
         return self.offset
 
     def close(self):
-        self.f.close()
+
+        # The file may go back to a pool, and be used by another SubFile,
+        # so this one stops using it.
+        if self.f is not None:
+            self.f.close()
+            self.f = None
 
     def write(self, s):
         raise Exception("Write not supported by SubFile")
     
 
+# A map from archive prefix to a list of idle file objects that can be
+# reused to read from that archive.
+archive_pools = { }
+
+class PooledFile(file):
+    """
+    A file that, when closed, is returned to the pool of idle file
+    objects for the archive it came from, rather than being closed
+    outright.
+    """
+
+    pool = None
+    
+    def close(self):
+        pool = self.pool
+
+        if pool is None or len(pool) >= renpy.config.archive_file_pool:
+            return file.close(self)
+        
+        for i in pool:
+            if i is self:
+                return
+
+        pool.append(self)
+
+        
+def open_archive(prefix):
+    """
+    Returns a file object that reads from the start of the archive with
+    the given prefix. This is an idle file from the archive's pool, if
+    there is one, or a newly opened file.
+    """
+
+    pool = archive_pools.setdefault(prefix, [ ])
+
+    try:
+        f = pool.pop()
+        f.seek(0)
+        return f
+    except IndexError:
+        pass
+    
+    f = PooledFile(transfn(prefix + ".rpa"), "rb")
+    f.pool = pool
+    return f
+
+def close_archive_files():
+    """
+    Closes the pooled files that have been opened to read archives.
+    """
+
+    for pool in archive_pools.values():
+        for f in pool:
+            f.pool = None
+            f.close()
+
+    archive_pools.clear()
+
+    
 def load(name):
     """
     Returns an open python file object of the given type.
@@ -322,6 +861,27 @@ def load(name):
         if rv is not None:
             return rv
     
+    loc = locate(name)
+
+    if loc is not None:
+        if loc[0] == "apk":
+            try:
+                return loc[1].open(loc[2])
+            except IOError:
+                pass
+
+        elif loc[0] == "dir":
+            try:
+                return file(loc[1], "rb")
+            except IOError:
+                pass
+
+        else:
+
+            # Files on disk that override the archive were put in the
+            # index in its place when it was built.
+            return load_from_archive(loc[1], loc[2])
+    
     # Look for the file in the apk.
     for apk in apks:
         prefixed_name = "/".join("x-" + i for i in name.split("/"))
@@ -341,37 +901,41 @@ def load(name):
 
     # Look for it in archive files.
     for prefix, index in archives:
-        if not name in index:
-            continue
-
-        f = file(transfn(prefix + ".rpa"), "rb")
+        if name in index:
+            return load_from_archive(prefix, index[name])
 
-        data = [ ]
+    raise IOError("Couldn't find file '%s'." % name)
 
-        # Direct path.
-        if len(index[name]) == 1:
+def load_from_archive(prefix, entry):
+    """
+    Returns a file-like object that reads the file described by `entry`,
+    an entry in the index of the archive with `prefix`.
+    """
 
-            t = index[name][0]
-            if len(t) == 2:
-                offset, dlen = t
-                start = ''
-            else:
-                offset, dlen, start = t
+    f = open_archive(prefix)
 
-            rv = SubFile(f, offset, dlen, start)
+    # Direct path.
+    if len(entry) == 1:
 
-        # Compatability path.
+        t = entry[0]
+        if len(t) == 2:
+            offset, dlen = t
+            start = ''
         else:
-            for offset, dlen in index[name]:           
-                f.seek(offset)
-                data.append(f.read(dlen))
+            offset, dlen, start = t
 
-            rv = StringIO(''.join(data))
-            f.close()
-            
-        return rv
+        return SubFile(f, offset, dlen, start)
 
-    raise IOError("Couldn't find file '%s'." % name)
+    # Compatability path.
+    data = [ ]
+
+    for offset, dlen in entry:           
+        f.seek(offset)
+        data.append(f.read(dlen))
+
+    f.close()
+        
+    return StringIO(''.join(data))
 
 loadable_cache = { }
 
@@ -381,6 +945,9 @@ def loadable(name):
     """
 
     name = lower_map.get(name.lower(), name)
+
+    if locate(name) is not None:
+        return True
     
     if name in loadable_cache:
         return loadable_cache[name]
@@ -414,14 +981,37 @@ def transfn(name):
 
     if isinstance(name, str):
         name = name.decode("utf-8")
-    
+
+    loc = locate(name)
+
+    if loc is not None:
+        if loc[0] == "dir":
+            return loc[1]
+
+        raise Exception("Couldn't find file '%s'." % name)
+
+    # The file might have been created after the index was built, so
+    # check the disk.
+    fn = find_on_disk(name)
+
+    if fn is None:
+        raise Exception("Couldn't find file '%s'." % name)
+
+    return fn
+
+def find_on_disk(name):
+    """
+    Returns the full filename of `name` in the first of the searched
+    directories it's in, or None if it isn't in any of them.
+    """
+
     for d in renpy.config.searchpath:
         fn = os.path.join(renpy.config.basedir, d, name)
 
         if os.path.exists(fn):
             return fn
 
-    raise Exception("Couldn't find file '%s'." % name)
+    return None
 
 
 def get_mtime(name):
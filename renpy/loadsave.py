@@ -21,6 +21,7 @@
 
 # This file contains functions that load and save the game state.
 
+import copy
 import pickle
 import cPickle
 
@@ -28,18 +29,43 @@ import StringIO
 import cStringIO
 
 import zipfile
+import struct
 import os
 import re
 import threading
 import sys
 import platform
 import types
+import time
 
 import renpy.display
 
 # This is used to cache information about saved games.
 cache = { }
 
+# The version of the save index.
+SAVE_INDEX_VERSION = 1
+
+# The name of the save index file, in the save directory.
+save_index_filename = "saveindex"
+
+# The save index, a map from the name of a save to an (mtime, size,
+# extra_info, screenshot, offset, length, compress_type) tuple, where
+# screenshot is the name of the screenshot in the save file, and offset,
+# length and compress_type give the location of its data. None if it
+# hasn't been loaded yet.
+save_index = None
+
+# True if the save index has changed since it was written.
+save_index_dirty = False
+
+# Held while accessing the save index, which the autosave thread
+# updates.
+save_index_lock = threading.RLock()
+
+# The format of a zip file's local file header.
+zip_file_header = struct.Struct("<4s2B4HL2L2H")
+
 
 # Dump that choses which pickle to use:
 def dump(o, f):
@@ -144,6 +170,13 @@ def save_dump(roots, log):
             size = 1
 
             state = get(2, { })
+
+            # The state of a renpy.object.Object is a (version, names,
+            # values) tuple.
+            if isinstance(o, renpy.object.Object) and isinstance(state, tuple):
+                _version, names, values = state
+                state = dict(zip(names, values))
+
             if isinstance(state, dict):
                 for k, v in state.iteritems():
                     size += 2
@@ -190,6 +223,212 @@ class IdleStringIO(StringIO.StringIO):
 class SaveAbort(Exception):
     pass
 
+class DeltaSession(object):
+    """
+    Writes saves as a stream of pickles produced by a single pickler.
+    The first pickle is a base, containing the roots and the rollback
+    log. Each save after that adds a delta, containing the roots and
+    the Rollback entries added to the log since the previous save.
+    Since the pickler remembers what it has already pickled, a delta
+    only contains objects that weren't in an earlier pickle, and refers
+    to the rest.
+    """
+
+    def __init__(self, log):
+
+        if renpy.config.use_cpickle:
+            self.pickler = cPickle.Pickler(self, cPickle.HIGHEST_PROTOCOL)
+        else:
+            self.pickler = pickle.Pickler(self, pickle.HIGHEST_PROTOCOL)
+
+        # The log this session is saving.
+        self.log = log
+
+        # The entries in the log, as of the last save.
+        self.entries = [ ]
+
+        # The pickles written so far. The first is the base, the rest
+        # are deltas.
+        self.pieces = [ ]
+
+        # renpy.python.rollback_serial as of the last save.
+        self.rollback_serial = renpy.python.rollback_serial
+
+        # The data written by the pickler.
+        self.out = [ ]
+
+    def write(self, s):
+        self.out.append(s)
+
+    def dump(self, o):
+        self.out = [ ]
+        self.pickler.dump(o)
+
+        rv = "".join(self.out)
+        self.out = [ ]
+        
+        self.pieces.append(rv)
+        return rv
+        
+    def add_delta(self, roots):
+        """
+        Tries to add a delta to the stream. Returns False if that
+        isn't possible, and a base needs to be written instead.
+        """
+
+        if not self.pieces or len(self.pieces) > renpy.config.save_delta_limit:
+            return False
+
+        # Rolling back changes objects without logging it.
+        if self.rollback_serial != renpy.python.rollback_serial:
+            return False
+
+        # If the deltas are bigger than the base, it's better to start
+        # again.
+        if sum(len(i) for i in self.pieces[1:]) > len(self.pieces[0]):
+            return False
+        
+        log = self.log
+        entries = log.log
+        saved = self.entries
+
+        if not entries:
+            return False
+        
+        # Find the entries at the start of the log that have been
+        # removed since the last save.
+        for drop, rb in enumerate(saved):
+            if rb is entries[0]:
+                break
+        else:
+            return False
+
+        # The entries that haven't changed since the last save. The
+        # last entry that was saved may have, so it's saved again.
+        keep = len(saved) - drop - 1
+
+        if keep < 0 or len(entries) <= keep or entries[keep] is not saved[-1]:
+            return False
+
+        # If the log doesn't continue on from what was saved, we've
+        # rolled back.
+        for i in xrange(keep):
+            if entries[i] is not saved[drop + i]:
+                return False
+
+        new = entries[keep:]
+        memo = self.pickler.memo
+        
+        # Objects that have been changed since they were pickled would
+        # only be referred to by the delta, so we need a new base.
+        for rb in new:
+            for o, _roll in rb.objects:
+                if id(o) in memo:
+                    return False
+
+        # The last entry that was saved, and the lists inside it, may
+        # have changed. The pickler would refer to what it pickled
+        # before, so a copy of the entry is pickled instead.
+        rb = copy.copy(saved[-1])
+
+        for k, v in vars(rb).items():
+            if isinstance(v, (list, dict)):
+                setattr(rb, k, type(v)(v))
+
+        new[0] = rb
+                    
+        # The rest of the log's fields, copied so they're pickled as
+        # they are now.
+        state = { }
+
+        for k, v in vars(log).iteritems():
+            if k in ("log", "current") or k in log.nosave:
+                continue
+
+            if isinstance(v, (list, dict)):
+                v = type(v)(v)
+                
+            state[k] = v
+
+        self.dump(("delta", drop, keep, new, roots, state))
+        self.entries = list(entries)
+        self.rollback_serial = renpy.python.rollback_serial
+
+        return True
+
+    def add_base(self, roots):
+        """
+        Adds the base to the stream, which must be empty.
+        """
+
+        self.dump(("base", roots, self.log))
+        self.entries = list(self.log.log)
+        
+# The current DeltaSession, or None if there isn't one.
+delta_session = None
+
+# Held while using delta_session.
+delta_lock = threading.Lock()
+
+def dump_delta(roots, log):
+    """
+    Returns the roots and log as a stream of pickles, using
+    delta_session so that only what changed since the last save needs
+    to be pickled.
+    """
+
+    global delta_session
+
+    with delta_lock:
+
+        try:
+            if delta_session is None or delta_session.log is not log or not delta_session.add_delta(roots):
+                delta_session = DeltaSession(log)
+                delta_session.add_base(roots)
+
+        except:
+            # The pickler may remember objects that weren't written.
+            delta_session = None
+            raise
+            
+        return "".join(delta_session.pieces)
+
+def reset_delta_session():
+    """
+    Forgets the delta session, so the next save is written from
+    scratch.
+    """
+
+    global delta_session
+
+    with delta_lock:
+        delta_session = None
+    
+def load_delta(data):
+    """
+    Loads a stream of pickles written by dump_delta, and returns the
+    roots and log.
+    """
+
+    if renpy.config.use_cpickle:
+        unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    else:
+        unpickler = pickle.Unpickler(StringIO.StringIO(data))
+
+    _kind, roots, log = unpickler.load()
+
+    while True:
+        try:
+            _kind, drop, keep, new, roots, state = unpickler.load()
+        except EOFError:
+            break
+
+        log.log = log.log[drop:drop + keep] + new
+        log.current = log.log[-1]
+        vars(log).update(state)
+
+    return roots, log
+
 def save(filename, extra_info='',
          file=file, StringIO=cStringIO.StringIO, #@ReservedAssignment
          mutate_flag=False, wait=None):
@@ -203,33 +442,68 @@ def save(filename, extra_info='',
     """
 
     cache.pop(filename, None)
-    
-    filename = filename + savegame_suffix
-
-    try:
-        os.unlink(renpy.config.savedir + "/" + filename)
-    except:
-        pass
 
     if mutate_flag:
         renpy.python.mutate_flag = False
+
+    log_name, log_data = snapshot_log(StringIO=StringIO, wait=wait)
     
+    if mutate_flag and renpy.python.mutate_flag:
+
+        # The delta we wrote may not match what's saved next time.
+        if renpy.config.save_deltas:
+            reset_delta_session()
+            
+        raise SaveAbort()
+
+    write_save(filename, log_name, log_data, renpy.game.interface.get_screenshot(), extra_info, file=file)
+
+def snapshot_log(StringIO=cStringIO.StringIO, wait=None):
+    """
+    Freezes the rollback log, and returns a (name, data) tuple, where
+    data is the pickled log, and name is the name of the member of the
+    save file it goes in.
+    """
+
     roots = renpy.game.log.freeze(wait)
+    return pickle_log(roots, renpy.game.log, StringIO=StringIO)
 
-    logf = StringIO()
-    dump((roots, renpy.game.log), logf)
+def pickle_log(roots, log, StringIO=cStringIO.StringIO):
+    """
+    Pickles `roots` and `log`, which come from freezing the log, and
+    returns a (name, data) tuple like snapshot_log does.
+    """
+    
+    if renpy.config.save_deltas:
+        log_name = "delta_log"
+        log_data = dump_delta(roots, log)
+    else:
+        logf = StringIO()
+        dump((roots, log), logf)
 
-    if mutate_flag and renpy.python.mutate_flag:
-        raise SaveAbort()
+        log_name = "log"
+        log_data = logf.getvalue()
 
     if renpy.config.save_dump:
-        save_dump(roots, renpy.game.log)
+        save_dump(roots, log)
+
+    return log_name, log_data
+
+def write_save(name, log_name, log_data, screenshot, extra_info, file=file): #@ReservedAssignment
+    """
+    Writes the save file `name`, given the log produced by snapshot_log,
+    the screenshot as a PNG, and the extra_info. The file is written
+    under a temporary name, and then renamed into place, so an existing
+    save is never left half-written.
+    """
+
+    fn = renpy.config.savedir + "/" + name + savegame_suffix
 
-    rf = file(renpy.config.savedir + "/" + filename, "wb")
+    rf = file(fn + ".new", "wb")
     zf = zipfile.ZipFile(rf, "w", zipfile.ZIP_DEFLATED)
 
     # Screenshot.
-    zf.writestr("screenshot.png", renpy.game.interface.get_screenshot())
+    zf.writestr("screenshot.png", screenshot)
 
     # Extra info.
     zf.writestr("extra_info", extra_info.encode("utf-8"))
@@ -238,47 +512,176 @@ def save(filename, extra_info='',
     zf.writestr("renpy_version", renpy.version)
 
     # The actual game.
-    zf.writestr("log", logf.getvalue())
+    zf.writestr(log_name, log_data)
 
     zf.close()
     rf.close()
-    
 
-def scan_saved_game(name):
+    with save_index_lock:
 
-    if name in cache:
-        return cache[name]
+        try:
+            os.rename(fn + ".new", fn)
+        except:
+            os.unlink(fn)
+            os.rename(fn + ".new", fn)
             
+        cache.pop(name, None)
+        scan_saved_game_core(name, screenshot)
+        write_save_index()
+
+        
+def load_save_index():
+    """
+    Loads the save index, if it hasn't been loaded already.
+    """
+
+    global save_index
+
+    if save_index is not None:
+        return
+    
     try:
-        f = name + savegame_suffix
+        f = file(renpy.config.savedir + "/" + save_index_filename, "rb")
+        version, index = cPickle.loads(f.read())
+        f.close()
+
+        if version != SAVE_INDEX_VERSION:
+            index = { }
+            
+    except:
+        index = { }
+
+    save_index = index
+
+def write_save_index():
+    """
+    Writes the save index, if it has changed.
+    """
+
+    global save_index_dirty
+    
+    if not save_index_dirty:
+        return
+
+    save_index_dirty = False
     
-        zf = zipfile.ZipFile(renpy.config.savedir + "/" + f, "r")
+    fn = renpy.config.savedir + "/" + save_index_filename
+
+    try:
+        f = file(fn + ".new", "wb")
+        cPickle.dump((SAVE_INDEX_VERSION, save_index), f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
 
         try:
-            png = False
-            zf.getinfo('screenshot.tga')
+            os.rename(fn + ".new", fn)
         except:
-            png = True
-            zf.getinfo('screenshot.png')
-            
+            os.unlink(fn)
+            os.rename(fn + ".new", fn)
+
+    except:
+        pass
+
+def index_saved_game(name):
+    """
+    Returns the save index entry for the save with `name`, reading it
+    from the save file if the index doesn't have an entry for it, or
+    if the save file has changed since the entry was made. Returns None
+    if the save doesn't exist, or can't be read.
+    """
+
+    global save_index_dirty
+
+    load_save_index()
+
+    fn = renpy.config.savedir + "/" + name + savegame_suffix
+
+    try:
+        st = os.stat(fn)
+    except:
+        st = None
+
+    entry = save_index.get(name, None)
+
+    if st is None:
+        if entry is not None:
+            del save_index[name]
+            save_index_dirty = True
+
+        return None
+        
+    if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+        return entry
+
+    try:
+        zf = zipfile.ZipFile(fn, "r")
+
+        try:
+            screenshot = 'screenshot.tga'
+            info = zf.getinfo(screenshot)
+        except:
+            screenshot = 'screenshot.png'
+            info = zf.getinfo(screenshot)
             
         extra_info = zf.read("extra_info").decode("utf-8")
         zf.close()
-       
-        mtime = os.path.getmtime(renpy.config.savedir + "/" + f)
 
-        if png:
-            screenshot = renpy.display.im.ZipFileImage(renpy.config.savedir + '/' + f, "screenshot.png", mtime)
-        else:
-            screenshot = renpy.display.im.ZipFileImage(renpy.config.savedir + '/' + f, "screenshot.tga", mtime)
-                    
-        rv = extra_info, screenshot, mtime
+        # Find where the screenshot's data starts, which is after the
+        # local header, filename and extra field.
+        f = file(fn, "rb")
+        f.seek(info.header_offset)
+        header = zip_file_header.unpack(f.read(zip_file_header.size))
+        f.close()
+
+        offset = info.header_offset + zip_file_header.size + header[10] + header[11]
+
+        entry = (st.st_mtime, st.st_size, extra_info, screenshot, offset, info.compress_size, info.compress_type)
 
     except:
+        entry = None
+
+    if entry is not None:
+        save_index[name] = entry
+    else:
+        save_index.pop(name, None)
+        
+    save_index_dirty = True
+    
+    return entry
+
+def scan_saved_game_core(name, data=None):
+    """
+    Returns the (extra_info, screenshot, mtime) tuple for the save with
+    `name`, or None if it can't be read. If `data` is given, it's the
+    screenshot, as a PNG, which the displayable uses rather than reading
+    it from the save file.
+    """
+    
+    if name in cache:
+        return cache[name]
+
+    entry = index_saved_game(name)
+
+    if entry is not None:
+        mtime, _size, extra_info, screenshot, offset, length, compress_type = entry
+        
+        fn = renpy.config.savedir + "/" + name + savegame_suffix
+        screenshot = renpy.display.im.ZipFileImage(fn, screenshot, mtime, member=(offset, length, compress_type), data=data)
+        
+        rv = extra_info, screenshot, mtime
+
+    else:
         rv = None
 
     cache[name] = rv
     return rv
+        
+def scan_saved_game(name):
+
+    with save_index_lock:
+        rv = scan_saved_game_core(name)
+        write_save_index()
+        
+    return rv
     
     
 
@@ -308,14 +711,18 @@ def list_saved_games(regexp=r'.'):
 
     rv = [ ]
 
-    for f in files:
-
-        info = scan_saved_game(f)
-
-        if info is not None:
-            extra_info, screenshot, mtime = info        
-            rv.append((f, extra_info, screenshot, mtime))
+    with save_index_lock:
+        
+        for f in files:
+    
+            info = scan_saved_game_core(f)
+    
+            if info is not None:
+                extra_info, screenshot, mtime = info        
+                rv.append((f, extra_info, screenshot, mtime))
 
+        write_save_index()
+                
     return rv
 
 def can_load(filename):
@@ -337,24 +744,68 @@ def load(filename):
     """
     
     zf = zipfile.ZipFile(renpy.config.savedir + "/" + filename + savegame_suffix, "r")
-    roots, log = loads(zf.read("log"))
+
+    if "delta_log" in zf.namelist():
+        roots, log = load_delta(zf.read("delta_log"))
+    else:
+        roots, log = loads(zf.read("log"))
+        
     zf.close()
 
     log.unfreeze(roots, label="_after_load")
 
-def rename_save(old, new):
-    unlink_save(new)
+def rename_save_core(old, new):
+    """
+    Renames a save, updating the save index without writing it.
+    """
+
+    global save_index_dirty
+    
+    unlink_save_core(new)
     os.rename(renpy.config.savedir + "/" + old + savegame_suffix, 
               renpy.config.savedir + "/" + new + savegame_suffix)
     
     cache.pop(old, None)
     cache.pop(new, None)
 
-def unlink_save(filename):
+    # Renaming doesn't change the mtime, so the entry is still good.
+    load_save_index()
+
+    entry = save_index.pop(old, None)
+
+    if entry is not None:
+        save_index[new] = entry
+
+    save_index_dirty = True
+    
+def rename_save(old, new):
+
+    with save_index_lock:
+        rename_save_core(old, new)
+        write_save_index()
+
+def unlink_save_core(filename):
+    """
+    Deletes a save, updating the save index without writing it.
+    """
+    
+    global save_index_dirty
+    
     if os.path.exists(renpy.config.savedir + "/" + filename + savegame_suffix):
         os.unlink(renpy.config.savedir + "/" + filename + savegame_suffix)
 
     cache.pop(filename, None)
+
+    load_save_index()
+
+    if save_index.pop(filename, None) is not None:
+        save_index_dirty = True
+        
+def unlink_save(filename):
+
+    with save_index_lock:
+        unlink_save_core(filename)
+        write_save_index()
         
 
 def cycle_saves(name, count):
@@ -362,9 +813,13 @@ def cycle_saves(name, count):
     for count in range(1, count + 1):
         if not os.path.exists(renpy.config.savedir + "/" + name + str(count) + savegame_suffix):
             break
+
+    with save_index_lock:
         
-    for i in range(count - 1, 0, -1):
-        rename_save(name + str(i), name + str(i + 1))
+        for i in range(count - 1, 0, -1):
+            rename_save_core(name + str(i), name + str(i + 1))
+
+        write_save_index()
         
 
 # Flag that lets us know if an autosave is in progress.
@@ -373,36 +828,76 @@ autosave_not_running.set()
 
 # The number of times autosave has been called without a save occuring.
 autosave_counter = 0
-        
-def autosave_thread(take_screenshot):
 
-    global autosave_counter
+# A list of (stage, seconds) tuples, giving how long each stage of the
+# last autosave took.
+autosave_timings = [ ]
+
+def autosave_thread(extra_info, screenshot, roots, log, timings):
+    """
+    Writes out an autosave, given the roots and log frozen by
+    force_autosave. `screenshot` is a renpy.display.core.Screenshot.
+    """
 
+    global autosave_counter
+    global autosave_timings
+    
     try:
         
         try:
-    
+
+            start = time.time()
+
+            log_name, log_data = pickle_log(roots, log, StringIO=IdleStringIO)
+
+            # The game changed while it was being pickled, so what was
+            # pickled may not be consistent.
+            if renpy.python.mutate_flag:
+
+                if renpy.config.save_deltas:
+                    reset_delta_session()
+                    
+                raise SaveAbort()
+
+            now = time.time()
+            timings.append(("pickle", now - start))
+            start = now
+            
+            screenshot = screenshot.get()
+                
+            now = time.time()
+            timings.append(("screenshot", now - start))
+            start = now
+
             renpy.display.core.cpu_idle.wait()
             cycle_saves("auto-", renpy.config.autosave_slots)
-        
+
+            now = time.time()
+            timings.append(("cycle", now - start))
+            start = now
+            
             renpy.display.core.cpu_idle.wait()
-            if renpy.config.auto_save_extra_info:
-                extra_info = renpy.config.auto_save_extra_info()
-            else:
-                extra_info = ""
-    
-            if take_screenshot:
-                renpy.exports.take_screenshot(background=True)
-            save("auto-1", file=IdleFile, StringIO=IdleStringIO, mutate_flag=True, wait=renpy.display.core.cpu_idle.wait, extra_info=extra_info)
+            write_save("auto-1", log_name, log_data, screenshot, extra_info)
+            
+            now = time.time()
+            timings.append(("write", now - start))
+            
             autosave_counter = 0
+            autosave_timings = timings
                 
-        except:
+            if renpy.config.profile:
+                print "Profile: Autosave took %s." % ", ".join("%s %f seconds" % i for i in timings)
+
+        except SaveAbort:
             pass
+        
+        except:
+            renpy.display.log.write("While writing an autosave:")
+            renpy.display.log.exception()
 
     finally:
         autosave_not_running.set()
         
-    
 
 def autosave():
     global autosave_counter
@@ -429,15 +924,50 @@ def autosave():
     force_autosave(True)
 
 
-# This assumes a screenshot has already been taken.
+# This assumes a screenshot has already been taken, unless
+# take_screenshot is true.
 def force_autosave(take_screenshot=False):
 
     # That is, autosave is running.
     if not autosave_not_running.isSet():
         return
+
+    # The log is frozen here, on the main thread. The slow parts of
+    # saving - pickling, encoding the screenshot, compressing, and
+    # writing the file - happen in the autosave thread. If the game
+    # changes while the thread is pickling, the autosave is abandoned.
+    start = time.time()
+    
+    try:
+        
+        if renpy.config.auto_save_extra_info:
+            extra_info = renpy.config.auto_save_extra_info()
+        else:
+            extra_info = ""
+
+        screenshot = renpy.game.interface.screenshot
+
+        if take_screenshot or screenshot is None:
+            surf = renpy.game.interface.capture_screenshot(scale=(renpy.config.thumbnail_width, renpy.config.thumbnail_height))
+            screenshot = renpy.display.core.Screenshot(surf)
+
+        log = renpy.game.log
+        roots = log.freeze()
+
+    except:
+        if renpy.config.debug:
+            raise
+
+        renpy.display.log.write("While starting an autosave:")
+        renpy.display.log.exception()
+        return
+
+    timings = [ ("freeze", time.time() - start) ]
+
+    renpy.python.mutate_flag = False
     
     autosave_not_running.clear()
-    threading.Thread(target=autosave_thread, args=(take_screenshot,)).start()
+    threading.Thread(target=autosave_thread, args=(extra_info, screenshot, roots, log, timings)).start()
     
     
 class _MultiPersistent(object):
@@ -510,3 +1040,357 @@ def MultiPersistent(name):
 
     rv._filename = fn # W0201
     return rv
+
+
+# The fields of the persistent object that hold what the player has
+# seen. These only grow, and can get large, so rather than being part of
+# the persistent file, they're kept in the seen file, which is appended
+# to when they change.
+seen_fields = [ "_seen_ever", "_seen_images", "_chosen", "_seen_audio" ]
+
+# The magic that starts the seen file.
+SEEN_MAGIC = "RENPY-SEEN-1\n"
+
+# The length of a record in the seen file.
+seen_record_length = struct.Struct(">I")
+
+# The number of records in the seen file after which it is rewritten
+# as a single record.
+SEEN_COMPACT_RECORDS = 64
+
+# The length of the valid part of the seen file, and the number of
+# records in it.
+seen_file_length = 0
+seen_file_records = 0
+
+# A list of (field, SeenDict, old) tuples, giving the SeenDicts created
+# by load_seen that haven't been filled in from the seen file yet, and
+# the data from an older persistent file to merge into them. None once
+# the seen file has been read.
+seen_unread = None
+
+# Held while reading the seen file.
+seen_lock = threading.RLock()
+
+class SeenDict(dict):
+    """
+    A dict that remembers the items added to it since it was last
+    written to the seen file, so only those need to be appended. If an
+    item is removed, the seen file has to be rewritten.
+
+    Values like the sets of chosen menu items are changed in place,
+    without the dict knowing, so a copy of each mutable value is kept
+    as it was last written, and compared with it when saving.
+
+    The SeenDicts created by load_seen start out empty, and the seen
+    file is only read when one of them is first used.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+
+        # A list of (key, value) pairs that need to be written.
+        self.added = [ ]
+
+        # True if the whole dict needs to be written.
+        self.rewrite = False
+
+        # False if the contents of the seen file haven't been read
+        # into this dict yet.
+        self.loaded = True
+
+        # A map from the key of each mutable value to a copy of that
+        # value as it was last written, or None if it hasn't been.
+        self.written = { }
+        self.scan()
+        
+    def read_first(method): # E0213 @NoSelf
+        def newmethod(self, *args, **kwargs):
+            if not self.loaded:
+                read_seen()
+                
+            return method(self, *args, **kwargs) # E1102
+
+        return newmethod
+
+    def mark_rewrite(method): # E0213 @NoSelf
+        def newmethod(self, *args, **kwargs):
+            self.rewrite = True
+            return method(self, *args, **kwargs) # E1102
+        
+        return newmethod
+    
+    @read_first
+    def __reduce__(self):
+        return (SeenDict, (dict(self), ))
+
+    @read_first
+    def __setitem__(self, key, value):
+        if dict.get(self, key, seen_missing) is not value:
+            dict.__setitem__(self, key, value)
+            self.added.append((key, value))
+
+            if isinstance(value, seen_mutable_types):
+                self.written[key] = None
+
+    @read_first
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+
+        return dict.__getitem__(self, key)
+
+    @read_first
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            self[k] = v
+
+    __delitem__ = read_first(mark_rewrite(dict.__delitem__))
+    clear = read_first(mark_rewrite(dict.clear))
+    pop = read_first(mark_rewrite(dict.pop))
+    popitem = read_first(mark_rewrite(dict.popitem))
+
+    __contains__ = read_first(dict.__contains__)
+    __getitem__ = read_first(dict.__getitem__)
+    __iter__ = read_first(dict.__iter__)
+    __len__ = read_first(dict.__len__)
+    __repr__ = read_first(dict.__repr__)
+    __eq__ = read_first(dict.__eq__)
+    __ne__ = read_first(dict.__ne__)
+    copy = read_first(dict.copy)
+    get = read_first(dict.get)
+    has_key = read_first(dict.has_key)
+    items = read_first(dict.items)
+    iteritems = read_first(dict.iteritems)
+    iterkeys = read_first(dict.iterkeys)
+    itervalues = read_first(dict.itervalues)
+    keys = read_first(dict.keys)
+    values = read_first(dict.values)
+    
+    del read_first
+    del mark_rewrite
+
+    def scan(self):
+        """
+        Finds the mutable values in the dict, and records them as
+        having been written.
+        """
+
+        self.written = dict((k, copy.copy(v)) for k, v in dict.iteritems(self) if isinstance(v, seen_mutable_types))
+
+    def find_changed(self):
+        """
+        Adds the mutable values that have changed since they were last
+        written to the list of items to write.
+        """
+
+        for k, old in self.written.iteritems():
+            v = dict.get(self, k, seen_missing)
+
+            if v is not seen_missing and v != old:
+                self.added.append((k, v))
+
+    def mark_written(self):
+        """
+        Records the mutable values as having been written.
+        """
+
+        for k in self.written.keys():
+            v = dict.get(self, k, seen_missing)
+
+            if isinstance(v, seen_mutable_types):
+                self.written[k] = copy.copy(v)
+            else:
+                del self.written[k]
+                
+# The types of value in a SeenDict that may be changed in place.
+seen_mutable_types = (set, list, dict)
+    
+# Used by SeenDict to represent a missing key.
+seen_missing = object()
+
+def load_seen(persistent):
+    """
+    Replaces the seen fields of `persistent` with SeenDicts. These are
+    filled in from the seen file when one of them is first used, so
+    the file isn't read at startup. Data from an older persistent file,
+    which contained the seen fields, is merged in.
+    """
+
+    global seen_unread
+    global seen_file_length
+    global seen_file_records
+
+    with seen_lock:
+        seen_unread = [ ]
+
+        seen_file_length = 0
+        seen_file_records = 0
+
+        for field in seen_fields:
+            sd = SeenDict()
+            sd.loaded = False
+
+            seen_unread.append((field, sd, getattr(persistent, field)))
+            setattr(persistent, field, sd)
+
+def read_seen():
+    """
+    Reads the seen file into the SeenDicts created by load_seen, if it
+    hasn't been read already.
+    """
+
+    global seen_unread
+
+    with seen_lock:
+
+        if seen_unread is None:
+            return
+
+        read_seen_file(seen_unread)
+        seen_unread = None
+
+def read_seen_file(unread):
+    """
+    Does the work of read_seen, given the list of (field, SeenDict, old)
+    tuples to fill in.
+    """
+
+    global seen_file_length
+    global seen_file_records
+
+    seen = dict((field, sd) for field, sd, _old in unread)
+    
+    try:
+        f = file(renpy.config.savedir + "/persistent.seen", "rb")
+        data = f.read()
+        f.close()
+    except:
+        data = ""
+
+    if data.startswith(SEEN_MAGIC):
+        pos = len(SEEN_MAGIC)
+
+        # Records are read until the end of the file, or a record that
+        # was only partly written.
+        while True:
+            try:
+                length, = seen_record_length.unpack_from(data, pos)
+                start = pos + seen_record_length.size
+
+                if start + length > len(data):
+                    break
+
+                for field, items in loads(data[start:start + length].decode("zlib")):
+                    if field in seen:
+                        dict.update(seen[field], items)
+                    
+            except:
+                break
+
+            pos = start + length
+            seen_file_records += 1
+            
+        seen_file_length = pos
+        
+    for _field, sd, old in unread:
+        
+        if old:
+            dict.update(sd, old)
+            sd.rewrite = True
+            
+        sd.added = [ ]
+        sd.scan()
+
+    # This is done last, so other threads wait until everything has
+    # been read.
+    for _field, sd, _old in unread:
+        sd.loaded = True
+        
+def save_seen(persistent):
+    """
+    Writes the seen fields of `persistent` to the seen file. Usually,
+    this appends a record containing what was added since the last
+    time this was called. If that isn't possible, or the file has too
+    many records in it, the file is rewritten.
+    """
+
+    global seen_file_length
+    global seen_file_records
+
+    # If the seen file was never read, nothing can have been added.
+    if seen_unread is not None:
+        for field, sd, _old in seen_unread:
+            if getattr(persistent, field) is not sd:
+                break
+        else:
+            return
+
+        read_seen()
+        
+    seen = [ ]
+
+    for field in seen_fields:
+        sd = getattr(persistent, field)
+
+        # The field was replaced, so it has to be written out in full.
+        if not isinstance(sd, SeenDict):
+            sd = SeenDict(sd or { })
+            sd.rewrite = True
+            setattr(persistent, field, sd)
+
+        seen.append((field, sd))
+
+    fn = renpy.config.savedir + "/persistent.seen"
+    
+    rewrite = not seen_file_length or seen_file_records >= SEEN_COMPACT_RECORDS
+    
+    for _field, sd in seen:
+        if sd.rewrite:
+            rewrite = True
+
+    if rewrite:
+        record = [ (field, sd.items()) for field, sd in seen ]
+    else:
+        for _field, sd in seen:
+            sd.find_changed()
+            
+        record = [ (field, sd.added) for field, sd in seen if sd.added ]
+
+        if not record:
+            return
+
+    data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL).encode("zlib")
+    data = seen_record_length.pack(len(data)) + data
+        
+    if rewrite:
+        f = file(fn + ".new", "wb")
+        f.write(SEEN_MAGIC)
+        f.write(data)
+        f.close()
+
+        try:
+            os.rename(fn + ".new", fn)
+        except:
+            os.unlink(fn)
+            os.rename(fn + ".new", fn)
+
+        seen_file_length = len(SEEN_MAGIC) + len(data)
+        seen_file_records = 1
+            
+    else:
+        # Anything after the valid part of the file is the remains of
+        # a record that wasn't completely written.
+        f = file(fn, "r+b")
+        f.seek(seen_file_length)
+        f.truncate()
+        f.write(data)
+        f.close()
+
+        seen_file_length += len(data)
+        seen_file_records += 1
+        
+    for _field, sd in seen:
+        sd.added = [ ]
+        sd.rewrite = False
+        sd.mark_written()
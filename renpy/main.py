@@ -31,8 +31,19 @@ import __main__
 def save_persistent():
 
     try:
+        # The seen fields are written first, so they survive even if
+        # the persistent file is lost.
+        renpy.loadsave.save_seen(game.persistent)
+
+        # The persistent file contains everything else.
+        persistent = game.Persistent()
+        
+        for k, v in vars(game.persistent).iteritems():
+            if k not in renpy.loadsave.seen_fields:
+                setattr(persistent, k, v)
+        
         f = file(renpy.config.savedir + "/persistent", "wb")
-        f.write(dumps(game.persistent).encode("zlib"))
+        f.write(dumps(persistent).encode("zlib"))
         f.close()
     except:
         if renpy.config.debug:
@@ -242,10 +253,11 @@ def main():
 
     # Perhaps delete the persistent data and exit.
     if renpy.game.options.rmpersistent: #@UndefinedVariable
-        try:
-            os.unlink(renpy.config.savedir + "/persistent")
-        except:
-            pass
+        for fn in [ "persistent", "persistent.seen" ]:
+            try:
+                os.unlink(renpy.config.savedir + "/" + fn)
+            except:
+                pass
 
         return
     
@@ -258,23 +270,13 @@ def main():
     except:
         game.persistent = game.Persistent()
 
-    # Initialize the set of statements seen ever.
-    if not game.persistent._seen_ever:
-        game.persistent._seen_ever = { }
-
+    # Load the sets of statements and images seen ever, the set of
+    # chosen menu choices, and the set of audio files heard, which are
+    # kept in their own file.
+    renpy.loadsave.load_seen(game.persistent)
+    
     game.seen_ever = game.persistent._seen_ever
 
-    # Initialize the set of images seen ever.
-    if not game.persistent._seen_images:
-        game.persistent._seen_images = { }
-
-    # Initialize the set of chosen menu choices.
-    if not game.persistent._chosen:
-        game.persistent._chosen = { }
-
-    if not game.persistent._seen_audio:
-        game.persistent._seen_audio = { }
-        
     # Clear the list of seen statements in this game.
     game.seen_session = { }
 
@@ -335,6 +337,10 @@ def main():
         except:
             raise
 
+    if renpy.game.options.benchmark_saves: #@UndefinedVariable
+        renpy.benchmark.benchmark_saves(renpy.game.options.benchmark_saves, renpy.game.options.benchmark_interactions) #@UndefinedVariable
+        return
+    
     # Remove the list of all statements from the script.
     game.script.all_stmts = None
 
@@ -358,6 +364,10 @@ def main():
             finally:
                 restart = (renpy.config.end_game_transition, "_invoke_main_menu", "_main_menu")
                 save_persistent()
+
+                # Chunks loaded while the game ran compile code that
+                # isn't in the cache yet.
+                renpy.game.script.save_bytecode()
                 
         except game.QuitException, e:
             break
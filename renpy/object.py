@@ -19,6 +19,11 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+# A map from a tuple of field names to itself. Objects with the same
+# fields share the same tuple of names, so a pickle only needs to
+# contain it once.
+field_names = { }
+
 class Object(object):
     """
     Our own base class. Contains methods to simplify serialization.
@@ -29,16 +34,21 @@ class Object(object):
     nosave = [ ]
 
     def __getstate__(self):
-        rv = vars(self).copy()
+        """
+        Returns a (version, names, values) tuple, where names is a tuple
+        of field names, and values is a tuple of the corresponding
+        values.
+        """
         
-        for f in self.nosave:
-            if f in rv:
-                del rv[f]
-
-
-        rv["__version__"] = self.__version__
-                
-        return rv
+        d = vars(self)
+        nosave = self.nosave
+        
+        names = [ i for i in d if i not in nosave ]
+        names.sort()
+        names = tuple(names)
+        names = field_names.setdefault(names, names)
+        
+        return (self.__version__, names, tuple([ d[i] for i in names ]))
 
 
     # None, to prevent this from being called when unnecessary.
@@ -46,9 +56,14 @@ class Object(object):
 
     def __setstate__(self, new_dict):
 
-        version = new_dict.pop("__version__", 0)
-        
-        self.__dict__.update(new_dict)
+        if isinstance(new_dict, tuple):
+            version, names, values = new_dict
+            self.__dict__.update(zip(names, values))
+
+        else:
+            # A dict, from older saves.
+            version = new_dict.pop("__version__", 0)
+            self.__dict__.update(new_dict)
         
         if version != self.__version__:
             self.after_upgrade(version) # E1101
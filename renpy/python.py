@@ -28,9 +28,13 @@ ast = __import__("ast", { })
 
 import marshal
 import random
+import operator
+import itertools
+import copy_reg
 import weakref
 import re
 import sets
+import time
 
 import renpy.audio
 
@@ -45,60 +49,133 @@ class NoRollback(object):
     pass
 
 
-# parents = [ ]
+# Types that can't refer to other objects, and so are never walked or
+# placed in reachable.
+reached_leaf_types = set([ type(None), bool, int, long, float, complex, str, unicode ])
 
-def reached(obj, reachable, wait):
+# Types that are walked by iterating over them. Filled in once the
+# revertable types have been defined.
+reached_iterable_types = set([ list, tuple, set, frozenset ])
+
+# Types that are walked by iterating over their keys and values.
+reached_dict_types = set([ dict ])
+
+# Types that have a __dict__, which should be walked in addition to
+# iterating over them.
+reached_vars_types = set()
+
+# How many objects are reached between calls to wait.
+REACHED_WAIT_INTERVAL = 256
+
+# Statistics about the last call to RollbackLog.purge_unreachable, a
+# (objects, rollbacks, seconds) tuple, giving the number of objects that
+# were reached, the number of Rollback objects that were purged, and the
+# time it took.
+purge_stats = (0, 0, 0.0)
+
+def reached_many(objs, reachable, wait):
     """
-    @param obj: The object that was reached.
-    @param path: The path from the store via which it was reached.
+    Marks the objects in the list `objs`, and everything reachable from
+    them, as reachable. `objs` is consumed.
 
     `reachable`
         A map from id(obj) to int. The int is 1 if the object was reached
         normally, and 0 if it was reached, but inherits from NoRollback.
 
+    This walks the objects with an explicit stack, so deep structures
+    don't run into the recursion limit.
     """
 
-    if wait:
-        wait()
+    stack = objs
+    pop = stack.pop
+    push = stack.append
+    extend = stack.extend
+
+    leaf_types = reached_leaf_types
+    iterable_types = reached_iterable_types
+    dict_types = reached_dict_types
+    vars_types = reached_vars_types
+
+    count = 0
     
-    idobj = id(obj)
+    while stack:
+        obj = pop()
+        t = type(obj)
+
+        if t in leaf_types:
+            continue
+        
+        idobj = id(obj)
     
-    if idobj in reachable:
-        return
+        if idobj in reachable:
+            continue
+
+        if wait:
+            count += 1
+            if count >= REACHED_WAIT_INTERVAL:
+                count = 0
+                wait()
+        
+        if t in iterable_types:
+            reachable[idobj] = 1
+            extend(obj)
 
-    if isinstance(obj, NoRollback):
-        reachable[idobj] = 0
-        return
+            if t in vars_types:
+                extend(obj.__dict__.itervalues())
 
-    reachable[idobj] = 1
+            continue
 
-    # parents.append(obj)
-    
-    try:
-        # Treat as fields, indexed by strings.
-        for v in vars(obj).itervalues():
-            reached(v, reachable, wait)
-    except:
-        pass
+        if t in dict_types:
+            reachable[idobj] = 1
+            extend(obj)
+            extend(obj.itervalues())
 
-    try:
-        # Treat as iterable
-        if not isinstance(obj, basestring):
-            for v in obj.__iter__():
-                reached(v, reachable, wait)
-    except:
-        pass
+            if t in vars_types:
+                extend(obj.__dict__.itervalues())
+                
+            continue
         
-
-    try:
-        # Treat as dict.
-        for v in obj.itervalues():
-            reached(v, reachable, wait)
-    except:
-        pass
-            
-    # parents.pop()
+        if isinstance(obj, NoRollback):
+            reachable[idobj] = 0
+            continue
+
+        reachable[idobj] = 1
+
+        # Otherwise, probe the object to see how it can be walked.
+        try:
+            # Treat as fields, indexed by strings.
+            for v in vars(obj).itervalues():
+                push(v)
+        except:
+            pass
+    
+        try:
+            # Treat as iterable
+            if not isinstance(obj, basestring):
+                for v in obj.__iter__():
+                    push(v)
+        except:
+            pass
             
+        try:
+            # Treat as dict.
+            for v in obj.itervalues():
+                push(v)
+        except:
+            pass
+
+def reached(obj, reachable, wait):
+    """
+    @param obj: The object that was reached.
+
+    `reachable`
+        A map from id(obj) to int. The int is 1 if the object was reached
+        normally, and 0 if it was reached, but inherits from NoRollback.
+
+    """
+    
+    reached_many([ obj ], reachable, wait)
+    
 def reached_vars(store, reachable, wait):
     """
     Marks everything reachable from the variables in the store
@@ -109,15 +186,15 @@ def reached_vars(store, reachable, wait):
     the path by which the object was reached.
     """
 
-    for v in store.itervalues():
-        reached(v, reachable, wait)    
+    objs = store.values()
     
     for c in renpy.game.contexts:
-        reached(c.info, reachable, wait)
-        reached(c.music, reachable, wait)
+        objs.append(c.info)
+        objs.append(c.music)
         for d in c.dynamic_stack:
-            for v in d.itervalues():
-                reached(v, reachable, wait)
+            objs.extend(d.itervalues())
+
+    reached_many(objs, reachable, wait)
 
 
 ##### Code that replaces literals will calls to magic constructors.
@@ -277,6 +354,11 @@ def py_compile_eval_bytecode(source, **kwargs):
 # this to check to see if a background-save is valid.
 mutate_flag = True
 
+# This is incremented each time the game is rolled back. The save code
+# uses this to tell if objects may have been changed without the
+# changes being logged.
+rollback_serial = 0
+
 def mutator(method):
 
     def do_mutation(self, *args, **kwargs):
@@ -293,6 +375,25 @@ def mutator(method):
 
     return do_mutation
 
+def reduce_revertable(self, protocol):
+    """
+    The __reduce_ex__ method of RevertableList and RevertableDict. This
+    omits their __dict__ from the pickle when it's empty, as it almost
+    always is.
+    """
+
+    getstate = getattr(self, "__getstate__", None)
+
+    if getstate is not None:
+        state = getstate()
+    else:
+        state = vars(self) or None
+
+    if isinstance(self, dict):
+        return (copy_reg.__newobj__, (type(self), ), state, None, self.iteritems())
+    else:
+        return (copy_reg.__newobj__, (type(self), ), state, iter(self), None)
+
 class RevertableList(list):
 
     __delitem__ = mutator(list.__delitem__)
@@ -320,6 +421,8 @@ class RevertableList(list):
 
     del wrapper
     
+    __reduce_ex__ = reduce_revertable
+
     def get_rollback(self):
         return self[:]
 
@@ -358,6 +461,8 @@ class RevertableDict(dict):
         rv.update(self)
         return rv
 
+    __reduce_ex__ = reduce_revertable
+
     def get_rollback(self):
         return self.items()
 
@@ -434,6 +539,10 @@ class RevertableObject(object):
         self.__dict__.clear()
         self.__dict__.update(old)
 
+reached_iterable_types.update([ RevertableList, RevertableSet ])
+reached_dict_types.add(RevertableDict)
+reached_vars_types.update([ RevertableList, RevertableDict, RevertableSet ])
+
 
 ##### An object that handles deterministic randomness, or something.
 
@@ -533,22 +642,17 @@ class Rollback(renpy.object.Object):
         self.purged = True
 
         # Add objects reachable from the store.
-        for i in self.store:
-            if len(i) != 2:
-                continue
-
-            _k, v = i
-            reached(v, reachable, wait)
-
+        objs = [ i[1] for i in self.store if len(i) == 2 ]
 
         # Add in objects reachable through the context.
-        reached(self.context.info, reachable, wait)
+        objs.append(self.context.info)
         for d in self.context.dynamic_stack:
-            for v in d.itervalues():
-                reached(v, reachable, wait)
+            objs.extend(d.itervalues())
 
         # Add in objects reachable through displayables.
-        reached(self.context.scene_lists.get_all_displayables(), reachable, wait)
+        objs.extend(self.context.scene_lists.get_all_displayables())
+
+        reached_many(objs, reachable, wait)
             
         # Purge object update information for unreachable objects.
         new_objects = [ ]
@@ -607,14 +711,16 @@ class RollbackLog(renpy.object.Object):
 
     Not serialized:
     
-    @ivar old_store: A copy of the store as it was when begin was
-    last called.
+    @ivar old_keys: The names in the store when begin was last called.
+
+    @ivar old_values: The values in the store when begin was last
+    called, in the same order as old_keys.
 
     @ivar mutated: A dictionary that maps object ids to a tuple of
     (weakref to object, information needed to rollback that object)
     """
 
-    nosave = [ 'old_store', 'mutated' ]
+    nosave = [ 'old_keys', 'old_values', 'mutated' ]
 
     def __init__(self):
 
@@ -626,7 +732,8 @@ class RollbackLog(renpy.object.Object):
         self.ever_been_changed = { }
         self.rollback_limit = 0
         self.forward = [ ]
-        self.old_store = { }
+        self.old_keys = [ ]
+        self.old_values = [ ]
         
         # Did we just do a roll forward?
         self.rolled_forward = False
@@ -659,7 +766,12 @@ class RollbackLog(renpy.object.Object):
         self.log.append(self.current)
 
         self.mutated = { }
-        self.old_store = renpy.store.__dict__.copy() #@UndefinedVariable
+
+        # This still copies the names and values in the store, but
+        # doing it as two lists lets complete compare them in C.
+        store = renpy.store.__dict__ #@UndefinedVariable
+        self.old_keys = store.keys()
+        self.old_values = store.values()
 
         # Flag a mutation as having happened. This is used by the
         # save code.
@@ -678,33 +790,60 @@ class RollbackLog(renpy.object.Object):
         """
 
         new_store = renpy.store.__dict__ #@UndefinedVariable
-        store = [ ]
+        old_keys = self.old_keys
+        old_values = self.old_values
         
         # Find store values that have changed since the last call to
         # begin, and use them to update the store. Also, update the
         # list of store keys that have ever been changed.
 
-        for k, v in self.old_store.iteritems():
-            if k not in new_store or new_store[k] is not v:
-                store.append((k, v))
-                self.ever_been_changed[k] = True
+        # Most statements don't add or remove names from the store. When
+        # the names haven't changed, the values are in the same order
+        # as when begin was called, so they can be compared by identity
+        # in C, and only the changed names are handled in python.
+        if new_store.keys() == old_keys:
 
-        for _ in range(4):
+            changed = map(operator.is_not, old_values, new_store.values())
+
+            store = [ ]
+            i = -1
 
             try:
-            
-                for k in new_store:
-                    if k not in self.old_store:
-                        store.append((k, ))
-                        self.ever_been_changed[k] = True
+                while True:
+                    i = changed.index(True, i + 1)
 
-                break
-                        
-            except RuntimeError:
-                # This can occur when new_store is updated as we're
-                # iterating over it.
+                    k = old_keys[i]
+                    store.append((k, old_values[i]))
+                    self.ever_been_changed[k] = True
+
+            except ValueError:
                 pass
-                        
+
+        else:
+
+            old_store = dict(itertools.izip(old_keys, old_values))
+            store = [ ]
+            
+            for k, v in old_store.iteritems():
+                if k not in new_store or new_store[k] is not v:
+                    store.append((k, v))
+                    self.ever_been_changed[k] = True
+    
+            for _ in range(4):
+    
+                try:
+                
+                    for k in new_store:
+                        if k not in old_store:
+                            store.append((k, ))
+                            self.ever_been_changed[k] = True
+    
+                    break
+                            
+                except RuntimeError:
+                    # This can occur when new_store is updated as we're
+                    # iterating over it.
+                    pass
                         
         self.current.store = store
 
@@ -758,6 +897,10 @@ class RollbackLog(renpy.object.Object):
         are no changes queued up.
         """
 
+        global purge_stats
+        
+        start = time.time()
+        
         reachable = { }
 
         reached_vars(roots, reachable, wait)
@@ -765,10 +908,19 @@ class RollbackLog(renpy.object.Object):
         revlog = self.log[:]
         revlog.reverse()
 
+        purged = 0
+        
         for i in revlog:
             if not i.purge_unreachable(reachable, wait):
                 break
 
+            purged += 1
+
+        purge_stats = (len(reachable), purged, time.time() - start)
+        
+        if renpy.config.profile:
+            print "Profile: Reached %d objects from %d rollbacks in %f seconds." % purge_stats
+
     def in_rollback(self):
         if self.forward:
             return True
@@ -882,13 +1034,17 @@ class RollbackLog(renpy.object.Object):
             self.log = self.log + revlog
             return
 
+        global rollback_serial
+        rollback_serial += 1
+        
         for rb in revlog:
             rb.rollback()
             if rb.forward is not None:
                 self.forward.insert(0, (rb.context.current, rb.forward))
             
         # Disable the next transition, as it's pointless. (Only when not used with a label.)
-        renpy.game.interface.suppress_transition = True
+        if renpy.game.interface:
+            renpy.game.interface.suppress_transition = True
             
         # If necessary, reset the RNG.
         if force:
@@ -30,6 +30,15 @@ import difflib
 import md5
 import time
 import marshal
+import threading
+import Queue
+import struct
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
 
 from cPickle import loads, dumps
 
@@ -37,10 +46,50 @@ from cPickle import loads, dumps
 script_version = renpy.script_version
 
 # The version of the bytecode cache.
-BYTECODE_VERSION = 1
+BYTECODE_VERSION = 2
+
+# The bytecode cache begins with this header, which contains the size
+# of the file when it was last written from scratch.
+BYTECODE_HEADER = "RPYB-%d %%016x\n" % BYTECODE_VERSION
+BYTECODE_HEADER_SIZE = len(BYTECODE_HEADER % 0)
+
+# Each record in the bytecode cache starts with this, giving the length
+# of the key and of the marshalled code that follow it.
+BYTECODE_RECORD = struct.Struct(">HI")
+
+# The bytecode cache is rewritten from scratch when it grows to twice
+# the size it was last rewritten at, or twice this, whichever is larger.
+BYTECODE_COMPACT_SIZE = 512 * 1024
+
+# The script prefetcher reads at most this many files ahead of the one
+# that's being loaded.
+PREFETCH_AHEAD = 8
+
 
 # The python magic code.
 MAGIC = imp.get_magic()
+
+# A compiled script file ends with the digest of its source file. That
+# may be followed by RPYC_INFO, which gives the size and mtime of the
+# source file when it was compiled, and then RPYC_INFO_MAGIC.
+RPYC_INFO = struct.Struct(">Qd8s")
+RPYC_INFO_MAGIC = "RPYCINFO"
+
+# A chunked compiled script file begins with CHUNKED_MAGIC, followed by
+# the length of the header, packed with CHUNKED_LENGTH. The header is a
+# zlib-compressed pickle of a (data, layout, table) tuple, and is
+# followed by the chunks. Each chunk is a zlib-compressed pickle of a
+# run of top-level statements that starts with a label, and can be
+# loaded on its own when one of the statements in it is looked up.
+#
+# layout is the list of top-level statements in the file, with each
+# chunk replaced by its index in table. table is a list of (offset,
+# length, names, next_name) tuples, where offset is relative to the end
+# of the header, names is the name of every statement in the chunk
+# (with the first statement first), and next_name is the name of the
+# statement that follows the chunk, or None if it ends the file.
+CHUNKED_MAGIC = "RPYC-CHUNKED-1\n"
+CHUNKED_LENGTH = struct.Struct(">Q")
         
 class ScriptError(Exception):
     """
@@ -64,7 +113,394 @@ def collapse_stmts(stmts):
     extend_all(stmts)
 
     return all_stmts
+
+
+def chunk_stmts(stmts):
+    """
+    Splits the top-level statements `stmts` into a layout and a list of
+    chunks, as described at CHUNKED_MAGIC. A chunk is a run of
+    statements starting with a label. Statements that contain init code
+    are never part of a chunk, as they always need to be loaded.
+    """
+
+    layout = [ ]
+    chunks = [ ]
+
+    current = None
+    
+    for i in stmts:
+
+        lazy = True
+        
+        for j in collapse_stmts([ i ]):
+            if j.get_init() or isinstance(j, renpy.ast.EarlyPython):
+                lazy = False
+                break
+
+        if not lazy:
+            current = None
+            layout.append(i)
+            continue
+            
+        if isinstance(i, renpy.ast.Label):
+            current = [ ]
+            layout.append(len(chunks))
+            chunks.append(current)
+
+        if current is not None:
+            current.append(i)
+        else:
+            layout.append(i)
+
+    return layout, chunks
+
+
+class ChunkLink(renpy.ast.Node):
+    """
+    Stands in for the first statement of a chunk that hasn't been loaded
+    yet, when that statement is the next statement of something that
+    has been. Executing or predicting this loads the chunk. Once the
+    chunk is loaded, every node that links to this is changed to point
+    to the real statement.
+    """
+
+    __slots__ = [ ]
+    
+    def __init__(self, name):
+        super(ChunkLink, self).__init__(("<chunk link>", 0))
+        self.name = name
+
+    def execute(self):
+        renpy.ast.next_node(renpy.game.script.lookup(self.name))
+
+    def predict(self):
+        return [ renpy.game.script.lookup(self.name) ]
+
     
+def compile_pycode(args):
+    """
+    Compiles a python block. `args` is a (mode, source, filename,
+    lineno) tuple. This returns a (code, error) tuple rather than
+    raising a SyntaxError, so the errors in every block can be reported
+    as parse errors. code is the marshalled code, or None if there was
+    a syntax error. error is None, or a (filename, lineno, msg, text,
+    offset) tuple giving the error.
+    """
+
+    mode, source, filename, lineno = args
+
+    old_ei = renpy.game.exception_info
+    renpy.game.exception_info = "While compiling python block starting at line %d of %s." % (lineno, filename)
+
+    try:
+        if mode == 'exec':
+            code = renpy.python.py_compile_exec_bytecode(source, filename=filename, lineno=lineno)
+        elif mode == 'eval':
+            code = renpy.python.py_compile_eval_bytecode(source, filename=filename, lineno=lineno)
+            
+    except SyntaxError, e:
+        return None, (e.filename, e.lineno, e.msg, e.text, e.offset)
+
+    renpy.game.exception_info = old_ei
+
+    return code, None
+
+    
+class BytecodeCache(object):
+    """
+    The bytecode cache, a file that maps the hash of a python block to
+    the marshalled code for that block. New code is appended to the end
+    of the file, so saving the cache never rewrites what's already
+    there, and the file is memory-mapped so code is only read when a
+    block that uses it is loaded.
+    """
+
+    def __init__(self, fn):
+
+        # The filename the cache is written to.
+        self.fn = fn
+
+        # The contents of the cache file, a string or an mmap.
+        self.data = ""
+
+        # The mmap data comes from, if any.
+        self.mmap = None
+        
+        # A map from key to the (offset, length) of its code in data.
+        self.index = { }
+
+        # The size of the file the last time it was written from
+        # scratch.
+        self.compacted = 0
+
+        # The offset of the end of the last complete record in the file,
+        # or None if the file needs to be written from scratch.
+        self.end = None
+
+    def load(self):
+        """
+        Loads the cache file, and indexes the records in it.
+        """
+
+        self.close()
+        
+        writable = True
+        
+        try:
+            f = file(self.fn, "rb")
+
+            data = None
+            
+            if mmap is not None and os.fstat(f.fileno()).st_size:
+                try:
+                    self.mmap = data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except:
+                    pass
+
+            if data is None:
+                data = f.read()
+
+            f.close()
+            
+        except EnvironmentError:
+
+            # The cache may be in an archive, in which case it can be
+            # read, but has to be written from scratch.
+            writable = False
+
+            try:
+                f = renpy.loader.load("bytecode.rpyb")
+                data = f.read()
+                f.close()
+            except:
+                data = ""
+
+        self.data = data
+                
+        header = data[:BYTECODE_HEADER_SIZE]
+
+        if len(header) != BYTECODE_HEADER_SIZE or header[:-17] != BYTECODE_HEADER[:-6]:
+            return
+
+        try:
+            compacted = int(header[-17:-1], 16)
+        except ValueError:
+            return
+
+        pos = BYTECODE_HEADER_SIZE
+        
+        while pos + BYTECODE_RECORD.size <= len(data):
+            keylen, codelen = BYTECODE_RECORD.unpack(data[pos:pos + BYTECODE_RECORD.size])
+
+            start = pos + BYTECODE_RECORD.size + keylen
+
+            # A record that was only partly written.
+            if start + codelen > len(data):
+                break
+
+            key = data[pos + BYTECODE_RECORD.size:start]
+            self.index[key] = (start, codelen)
+
+            pos = start + codelen
+
+        self.compacted = compacted
+
+        if writable:
+            self.end = pos
+            
+    def close(self):
+        """
+        Closes the cache file. The cache is empty until it's loaded
+        again.
+        """
+
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+        self.data = ""
+        self.index = { }
+        self.end = None
+
+    def get(self, key):
+        """
+        Returns the marshalled code for `key`, or None if it isn't in
+        the cache.
+        """
+
+        loc = self.index.get(key, None)
+
+        if loc is None:
+            return None
+
+        start, length = loc
+        return self.data[start:start + length]
+
+    def needs_rewrite(self, new):
+        """
+        Returns True if the cache should be written from scratch, rather
+        than having the code in `new` appended to it.
+        """
+
+        if self.end is None:
+            return True
+
+        size = self.end
+        
+        for key, code in new.iteritems():
+            size += BYTECODE_RECORD.size + len(key) + len(code)
+
+        return size > 2 * max(self.compacted, BYTECODE_COMPACT_SIZE)
+            
+    def write_records(self, f, entries):
+
+        for key in sorted(entries):
+            code = entries[key]
+            f.write(BYTECODE_RECORD.pack(len(key), len(code)))
+            f.write(key)
+            f.write(code)
+    
+    def append(self, new):
+        """
+        Appends the code in `new`, a map from key to marshalled code, to
+        the cache file.
+        """
+
+        end = self.end
+        self.close()
+
+        f = file(self.fn, "r+b")
+
+        # Get rid of any partly-written record.
+        f.seek(end)
+        f.truncate()
+
+        self.write_records(f, new)
+        f.close()
+
+        self.load()
+        
+    def rewrite(self, entries):
+        """
+        Writes the cache file from scratch, containing only the code in
+        `entries`, a map from key to marshalled code.
+        """
+
+        # The file can't be replaced while it's mapped.
+        self.close()
+
+        tmp = self.fn + ".new"
+        
+        f = file(tmp, "wb")
+        f.write(BYTECODE_HEADER % 0)
+        self.write_records(f, entries)
+        size = f.tell()
+        f.seek(0)
+        f.write(BYTECODE_HEADER % size)
+        f.close()
+
+        if os.path.exists(self.fn):
+            os.unlink(self.fn)
+
+        os.rename(tmp, self.fn)
+
+        self.load()
+        
+
+class ScriptPrefetcher(object):
+    """
+    Does the I/O, digesting and decompression needed to load a list of
+    script files on a pool of threads, so the main thread only has to
+    wait for each file when it gets to it.
+    """
+
+    def __init__(self, script, items, threads):
+
+        self.script = script
+
+        # The (compiled, source, dir, fn) tuples to prefetch, and the
+        # index of the first one that hasn't been queued yet.
+        self.items = list(items)
+        self.next_item = 0
+        
+        # A queue of items that have yet to be prefetched, or None to
+        # tell a worker thread to exit.
+        self.queue = Queue.Queue()
+
+        # A map from (compiled, source, dir, fn) to the result of
+        # Script.prefetch_file, or None if that raised an exception.
+        self.results = { }
+
+        # Held when accessing results.
+        self.condition = threading.Condition()
+
+        # Only PREFETCH_AHEAD files are queued at first. Another is
+        # queued each time a file is taken by get, so the results that
+        # are waiting to be used don't take up too much memory.
+        for _i in range(PREFETCH_AHEAD):
+            self.queue_next()
+
+        # The worker threads.
+        self.threads = [ ]
+            
+        for _i in range(min(threads, PREFETCH_AHEAD, len(self.items))):
+            t = threading.Thread(target=self.worker, name="script prefetch")
+            t.setDaemon(True)
+            t.start()
+
+            self.threads.append(t)
+
+    def queue_next(self):
+        """
+        Queues the next item to be prefetched, if there is one.
+        """
+
+        if self.next_item < len(self.items):
+            self.queue.put(self.items[self.next_item])
+            self.next_item += 1
+            
+    def worker(self):
+
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                return
+
+            try:
+                rv = self.script.prefetch_file(*item)
+            except:
+                rv = None
+
+            with self.condition:
+                self.results[item] = rv
+                self.condition.notifyAll()
+
+    def get(self, item):
+        """
+        Waits for `item` to be prefetched, and returns the result.
+        """
+
+        self.queue_next()
+        
+        with self.condition:
+            while item not in self.results:
+                self.condition.wait()
+
+            return self.results.pop(item)
+
+    def close(self):
+        """
+        Tells the worker threads to exit once the items that have been
+        queued are prefetched, and waits for them to do so.
+        """
+
+        for _t in self.threads:
+            self.queue.put(None)
+
+        for t in self.threads:
+            t.join()
+
 
 class Script(object):
     """
@@ -86,6 +522,12 @@ class Script(object):
     in every file. Useful for lint, but tossed if lint is not performed
     to save memory.
 
+    @ivar chunks: A list of (filename, offset, length, names, next_name)
+    tuples, giving the chunks of compiled script files that have not
+    been loaded yet. A chunk is replaced with None once it's loaded.
+
+    @ivar chunk_names: A map from the name of each statement in a chunk
+    that hasn't been loaded, to the index of that chunk in chunks.
     """
 
     def __init__(self):
@@ -107,14 +549,30 @@ class Script(object):
                 self.key = file(renpy.config.renpy_base + "/lock.txt", "rb").read()
 
         self.namemap = { }
+        self.chunks = [ ]
+        self.chunk_names = { }
+
+        # A map from the name of the first statement in a chunk to a
+        # list of nodes whose next is a ChunkLink to that statement.
+        self.chunk_links = { }
+        
         self.all_stmts = [ ]
         self.all_pycode = [ ]
         self.record_pycode = True
         
-        # Bytecode caches.
-        self.bytecode_oldcache = { }
+        # A map from source filename to the digest of that file, for
+        # source files that have been digested and found to have changed.
+        self.source_digests = { }
+        
+        # The bytecode cache.
+        self.bytecode_cache = BytecodeCache(os.path.join(renpy.config.searchpath[0], "bytecode.rpyb"))
+
+        # A map from key to marshalled code, for code that has been
+        # compiled, and isn't in the bytecode cache yet.
         self.bytecode_newcache = { }
-        self.bytecode_dirty = False
+
+        # The keys of all the code that has been loaded.
+        self.bytecode_used = set()
 
         self.init_bytecode()
         self.scan_script_files()
@@ -168,10 +626,33 @@ class Script(object):
         script_files.sort()
 
         initcode = [ ]
+
+        items = [ (".rpyc", ".rpy", dir, fn) for fn, dir in script_files ] #@ReservedAssignment
+
+        if renpy.config.script_load_threads > 1 and len(items) > 1:
+            prefetcher = ScriptPrefetcher(self, items, renpy.config.script_load_threads)
+        else:
+            prefetcher = None
         
-        for fn, dir in script_files: #@ReservedAssignment
-            self.load_appropriate_file(".rpyc", ".rpy", dir, fn, initcode)
+        try:
+            for item in items:
+
+                if prefetcher is not None:
+                    prefetched = prefetcher.get(item)
+                else:
+                    prefetched = None
+
+                compiled, source, dir, fn = item #@ReservedAssignment
+                self.load_appropriate_file(compiled, source, dir, fn, initcode, prefetched)
 
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            
+        # Compile the bytecode that hasn't been compiled while loading
+        # the files.
+        self.update_bytecode()
+        
         # Make the sort stable.
         initcode = [ (prio, index, code) for index, (prio, code) in
                      enumerate(initcode) ]
@@ -195,7 +676,8 @@ class Script(object):
         initcode = [ ]
 
         self.load_appropriate_file(".rpymc", ".rpym", dir, fn, initcode)
-
+        self.update_bytecode()
+        
         if renpy.parser.report_parse_errors():
             raise SystemExit(-1)
         
@@ -233,7 +715,97 @@ class Script(object):
                 if new.name is None:
                     new.name = old.name
 
-    def load_file_core(self, dir, fn): #@ReservedAssignment
+    def read_compiled(self, fn):
+        """
+        Reads the compiled script file `fn`. Returns a (data, base)
+        tuple, where data is the decompressed pickle at the start of the
+        file. If the file is chunked, that's the header, and base is the
+        offset of the first chunk. Otherwise, base is None.
+        """
+
+        f = renpy.loader.load(fn)
+        magic = f.read(len(CHUNKED_MAGIC))
+        
+        if magic == CHUNKED_MAGIC:
+            length, = CHUNKED_LENGTH.unpack(f.read(CHUNKED_LENGTH.size))
+            data = f.read(length).decode('zlib')
+            base = len(CHUNKED_MAGIC) + CHUNKED_LENGTH.size + length
+        else:
+            data = (magic + f.read()).decode('zlib')
+            base = None
+
+        f.close()
+
+        return data, base
+    
+    def write_compiled(self, f, data, stmts):
+        """
+        Writes `data` and `stmts` to `f` as a chunked compiled script
+        file, not including the digest.
+        """
+
+        layout, chunks = chunk_stmts(stmts)
+
+        table = [ ]
+        blobs = [ ]
+        offset = 0
+        
+        for pos, i in enumerate(layout):
+            if not isinstance(i, int):
+                continue
+
+            chunk = chunks[i]
+            blob = dumps(chunk, 2).encode('zlib')
+            names = [ j.name for j in collapse_stmts(chunk) ]
+
+            if pos + 1 < len(layout):
+                next_stmt = layout[pos + 1]
+            else:
+                next_stmt = None
+
+            if isinstance(next_stmt, int):
+                next_name = chunks[next_stmt][0].name
+            elif next_stmt is not None:
+                next_name = next_stmt.name
+            else:
+                next_name = None
+                
+            table.append((offset, len(blob), names, next_name))
+            blobs.append(blob)
+            offset += len(blob)
+
+        header = dumps((data, layout, table), 2).encode('zlib')
+
+        f.write(CHUNKED_MAGIC)
+        f.write(CHUNKED_LENGTH.pack(len(header)))
+        f.write(header)
+
+        for i in blobs:
+            f.write(i)
+
+    def read_chunk(self, fn, offset, length):
+        """
+        Reads and returns the list of statements in a chunk.
+        """
+
+        f = renpy.loader.load(fn)
+        f.seek(offset)
+        data = f.read(length)
+        f.close()
+
+        return loads(data.decode('zlib'))
+            
+    def load_file_core(self, dir, fn, data=None, lazy=False): #@ReservedAssignment
+        """
+        Loads the script file `fn`. If `data` is given, it's the result
+        of calling read_compiled on `fn`, which must be a compiled file.
+
+        Returns a (data, stmts, chunks) tuple. If `lazy` is true and
+        the file is chunked, the chunks aren't loaded. Instead, stmts
+        contains the index of each chunk in chunks, a list of (filename,
+        offset, length, names, next_name) tuples. Otherwise, chunks is
+        empty.
+        """
         
         if fn.endswith(".rpy") or fn.endswith(".rpym"):
 
@@ -249,13 +821,13 @@ class Script(object):
             data['key'] = self.key or 'unlocked'
 
             if stmts is None:
-                return data, [ ]
+                return data, [ ], [ ]
 
             # See if we have a corresponding .rpyc file. If so, then
             # we want to try to upgrade our .rpy file with it.
             try:
                 self.record_pycode = False
-                old_data, old_stmts = self.load_file_core(dir, fn + "c")
+                old_data, old_stmts, _old_chunks = self.load_file_core(dir, fn + "c")
                 self.merge_names(old_stmts, stmts)
                 del old_data
                 del old_stmts
@@ -267,42 +839,113 @@ class Script(object):
             self.assign_names(stmts, fullfn)
 
             try:
-                rpydigest = md5.md5(file(fullfn, "rU").read()).digest()
+                rpydigest = self.source_digests.pop(fullfn, None)
+
+                if rpydigest is None:
+                    rpydigest = md5.md5(file(fullfn, "rU").read()).digest()
+
+                st = os.stat(fullfn)
+                    
                 f = file(dir + "/" + fn + "c", "wb")
-                f.write(dumps((data, stmts), 2).encode('zlib'))
+                self.write_compiled(f, data, stmts)
                 f.write(rpydigest)
+                f.write(RPYC_INFO.pack(st.st_size, st.st_mtime, RPYC_INFO_MAGIC))
                 f.close()
             except:
                 pass
 
+            return data, stmts, [ ]
+        
         elif fn.endswith(".rpyc") or fn.endswith(".rpymc"):
 
-            f = renpy.loader.load(fn)
+            if data is None:
+                data = self.read_compiled(fn)
 
-            try:
-                data, stmts = loads(f.read().decode('zlib'))
-            except:
-                raise
+            data, base = data
+            
+            if base is None:
+                data, stmts = loads(data)
+                table = [ ]
+            else:
+                data, stmts, table = loads(data)
             
             if not isinstance(data, dict):
-                return None, None
+                return None, None, None
 
             if self.key and data.get('key', 'unlocked') != self.key:
-                return None, None
+                return None, None, None
             
             if data['version'] != script_version:
-                return None, None
+                return None, None, None
 
-            f.close()
+            chunks = [ (fn, base + offset, length, names, next_name)
+                       for offset, length, names, next_name in table ]
+            
+            if lazy or not chunks:
+                return data, stmts, chunks
+
+            rv = [ ]
+            
+            for i in stmts:
+                if isinstance(i, int):
+                    _fn, offset, length, _names, _next_name = chunks[i]
+                    rv.extend(self.read_chunk(fn, offset, length))
+                else:
+                    rv.append(i)
+                    
+            return data, rv, [ ]
+            
         else:
-            return None, None
+            return None, None, None
 
-        return data, stmts
-    
-    def load_file(self, dir, fn, initcode): #@ReservedAssignment
+    def link_to(self, name):
+        """
+        Returns the node with `name` if it's loaded, or a ChunkLink to
+        it if it isn't.
+        """
+
+        if name is None:
+            return None
+        
+        rv = self.namemap.get(name, None)
+
+        if rv is None:
+            rv = ChunkLink(name)
+            
+        return rv
+
+    def record_links(self, nodes):
+        """
+        Records the nodes in `nodes` that are linked to a statement that
+        hasn't been loaded yet, so they can be updated when it is.
+        """
+
+        for i in nodes:
+            if isinstance(i.next, ChunkLink):
+                self.chunk_links.setdefault(i.next.name, [ ]).append(i)
+        
+    def check_name(self, name, where):
+        """
+        Raises a ScriptError if a statement named `name` has already
+        been loaded, or is in a chunk that hasn't been. `where` is the
+        location of the new statement.
+        """
+
+        if name in self.namemap:
+            old = self.namemap[name]
+            old = "%s:%d" % (old.filename, old.linenumber)
+        elif name in self.chunk_names:
+            old = self.chunks[self.chunk_names[name]][0]
+        else:
+            return
+
+        raise ScriptError("Name %s is defined twice: at %s and %s." %
+                          (repr(name), old, where))
+        
+    def load_file(self, dir, fn, initcode, data=None): #@ReservedAssignment
 
         # Actually do the loading.
-        data, stmts = self.load_file_core(dir, fn)
+        data, stmts, chunks = self.load_file_core(dir, fn, data, renpy.config.lazy_script_loading)
         if data is None:
             return False
 
@@ -312,13 +955,35 @@ class Script(object):
         elif self.key != data['key']:
             raise Exception( fn + " does not share a key with at least one .rpyc file. To fix, delete all .rpyc files, or rerun Ren'Py with the --lock option.")
             
+        # The chunks of this file, and so the statements in them, are
+        # left unloaded until they're looked up.
+        for chunk in chunks:
+            for name in chunk[3]:
+                self.check_name(name, chunk[0])
+                self.chunk_names[name] = len(self.chunks)
+
+            self.chunks.append(chunk)
 
         # All of the statements found in file, regardless of nesting
         # depth.
-        all_stmts = collapse_stmts(stmts)
+        all_stmts = collapse_stmts([ i for i in stmts if not isinstance(i, int) ])
 
         # Chain together the statements in the file.
-        renpy.ast.chain_block(stmts, None)
+        for i, node in enumerate(stmts):
+            if isinstance(node, int):
+                continue
+
+            if i + 1 < len(stmts):
+                next_stmt = stmts[i + 1]
+
+                if isinstance(next_stmt, int):
+                    next_stmt = self.link_to(chunks[next_stmt][3][0])
+            else:
+                next_stmt = None
+
+            node.chain(next_stmt)
+
+        self.record_links(all_stmts)
 
         early = [ ]
         
@@ -328,13 +993,7 @@ class Script(object):
             # Check to see if the name is defined twice. If it is,
             # report the error.
             name = node.name
-            if name in self.namemap:
-                old = self.namemap[name]
-
-                raise ScriptError("Name %s is defined twice: at %s:%d and %s:%d." %
-                                  (repr(name),
-                                   old.filename, old.linenumber,
-                                   node.filename, node.linenumber))
+            self.check_name(name, "%s:%d" % (node.filename, node.linenumber))
 
             # Otherwise, add the name to the namemap. 
             self.namemap[name] = node
@@ -346,9 +1005,12 @@ class Script(object):
 
             if isinstance(node, renpy.ast.EarlyPython):
                 early.append(node)
-            
-        # Compile bytecode from the file.
-        self.update_bytecode()
+
+        # Early python needs its bytecode now. Otherwise, compiling the
+        # bytecode is left until every file has been loaded, so code
+        # that isn't in the bytecode cache can be compiled all at once.
+        if early:
+            self.update_bytecode()
 
         # Exec early python.
         for node in early:
@@ -358,12 +1020,179 @@ class Script(object):
 
         return True
 
+    def load_chunk(self, index):
+        """
+        Loads the chunk with `index` in self.chunks.
+        """
+
+        fn, offset, length, names, next_name = self.chunks[index]
+        self.chunks[index] = None
+
+        for name in names:
+            del self.chunk_names[name]
+
+        stmts = self.read_chunk(fn, offset, length)
+
+        all_stmts = collapse_stmts(stmts)
+
+        for node in all_stmts:
+            self.namemap[node.name] = node
+
+        renpy.ast.chain_block(stmts, self.link_to(next_name))
+        self.record_links(all_stmts)
+        
+        # Update the nodes that were linked to this chunk before it was
+        # loaded.
+        for node in all_stmts:
+            for i in self.chunk_links.pop(node.name, [ ]):
+                i.next = node
+        
+        self.update_bytecode()
+
+        if self.all_stmts is not None:
+            self.all_stmts.extend(all_stmts)
+
+    def load_all_chunks(self):
+        """
+        Loads every chunk that hasn't been loaded yet. This is used by
+        things, like lint and warp, that need to see every statement.
+        """
+
+        for i, chunk in enumerate(self.chunks):
+            if chunk is not None:
+                self.load_chunk(i)
+
+    def prefetch_file(self, compiled, source, dir, fn): #@ReservedAssignment
+        """
+        Does the work of load_appropriate_file that doesn't involve
+        changing the script, so that it can be run in a thread ahead
+        of time. Returns a dict that may contain:
+
+        `current`
+            The result of check_current, if both the compiled and
+            source files exist.
+
+        `data`
+            The result of read_compiled on the compiled file, if that's
+            what will be loaded.
+        """
+
+        rv = { }
+        
+        if dir is not None:
+            rpyfn = dir + "/" + fn + source
+            rpycfn = dir + "/" + fn + compiled
+
+            if os.path.exists(rpyfn) and os.path.exists(rpycfn):
+                rv['current'] = self.check_current(rpyfn, rpycfn)
+
+                if not rv['current'][0] or renpy.game.options.compile: #@UndefinedVariable
+                    return rv
+
+            elif not os.path.exists(rpycfn):
+                return rv
+
+        rv['data'] = self.read_compiled(fn + compiled)
+
+        return rv
+
+    def is_current(self, rpyfn, rpycfn):
+        """
+        Returns True if the compiled file `rpycfn` was compiled from the
+        current version of the source file `rpyfn`.
+        """
+
+        return self.record_current(rpyfn, rpycfn, self.check_current(rpyfn, rpycfn))
+    
+    def check_current(self, rpyfn, rpycfn):
+        """
+        Does the work of is_current that only reads files, so it can be
+        run in a thread. Returns a (current, info, digest) tuple, which
+        should be passed to record_current on the main thread.
+
+        If the size and mtime of the source file match those stored in
+        the compiled file, it's assumed to be current without reading the
+        source, unless the --verify-scripts option was given. Otherwise,
+        the source is digested, and the digest compared with the one
+        stored in the compiled file.
+
+        `info` is None, or a (has_info, size, mtime) tuple giving the size
+        and mtime that should be stored in the compiled file. `digest` is
+        the digest of the source, if it was computed.
+        """
+
+        f = file(rpycfn, "rb")
+        f.seek(0, 2)
+        trailer_size = min(f.tell(), md5.digest_size + RPYC_INFO.size)
+        f.seek(-trailer_size, 2)
+        trailer = f.read(trailer_size)
+        f.close()
+
+        st = os.stat(rpyfn)
+        
+        if trailer.endswith(RPYC_INFO_MAGIC) and len(trailer) == md5.digest_size + RPYC_INFO.size:
+            has_info = True
+            rpycdigest = trailer[:md5.digest_size]
+            size, mtime, _magic = RPYC_INFO.unpack(trailer[md5.digest_size:])
+
+            if st.st_size == size and st.st_mtime == mtime and not renpy.game.options.verify_scripts: #@UndefinedVariable
+                return True, None, None
+            
+        else:
+            has_info = False
+            rpycdigest = trailer[-md5.digest_size:]
+        
+        rpydigest = md5.md5(file(rpyfn, "rU").read()).digest()
+
+        if rpydigest == rpycdigest:
+            return True, (has_info, st.st_size, st.st_mtime), rpydigest
+
+        return False, None, rpydigest
+
+    def record_current(self, rpyfn, rpycfn, result):
+        """
+        Takes the result of check_current, and does the writing that
+        goes with it. Returns True if the compiled file is current.
+        """
+
+        current, info, rpydigest = result
+        
+        if info is not None:
+            has_info, size, mtime = info
+            
+            # The source was touched, but not changed. Update the size
+            # and mtime, so we don't need to digest it next time.
+            try:
+                f = file(rpycfn, "r+b")
+
+                if has_info:
+                    f.seek(-RPYC_INFO.size, 2)
+                else:
+                    f.seek(0, 2)
+
+                f.write(RPYC_INFO.pack(size, mtime, RPYC_INFO_MAGIC))
+                f.close()
+            except:
+                pass
+
+        # Save the digest, so we don't compute it again when we compile
+        # the file.
+        if not current and rpydigest is not None:
+            self.source_digests[rpyfn] = rpydigest
+
+        return current
     
-    def load_appropriate_file(self, compiled, source, dir, fn, initcode): #@ReservedAssignment
+    def load_appropriate_file(self, compiled, source, dir, fn, initcode, prefetched=None): #@ReservedAssignment
+
+        if prefetched is None:
+            prefetched = { }
+
+        data = prefetched.get('data', None)
+            
         # This can only be a .rpyc file, since we're loading it
         # from an archive.
         if dir is None:
-            if not self.load_file(dir, fn + compiled, initcode):
+            if not self.load_file(dir, fn + compiled, initcode, data):
                 raise Exception("Could not load from archive %s.%s" % (fn, compiled))
             return
             
@@ -373,15 +1202,15 @@ class Script(object):
         rpycfn = dir + "/" + fn + compiled
 
         if os.path.exists(rpyfn) and os.path.exists(rpycfn):
-            rpydigest = md5.md5(file(rpyfn, "rU").read()).digest()
-            f = file(rpycfn, "rb")
-            f.seek(-md5.digest_size, 2)
-            rpycdigest = f.read(md5.digest_size)
-            f.close()
 
-            if rpydigest == rpycdigest and not renpy.game.options.compile: #@UndefinedVariable
+            if 'current' in prefetched:
+                current = self.record_current(rpyfn, rpycfn, prefetched['current'])
+            else:
+                current = self.is_current(rpyfn, rpycfn)
+
+            if current and not renpy.game.options.compile: #@UndefinedVariable
 
-                if self.load_file(dir, fn + compiled, initcode):
+                if self.load_file(dir, fn + compiled, initcode, data):
                     return
 
                 print "Could not load " + rpycfn
@@ -390,7 +1219,7 @@ class Script(object):
                 raise Exception("Could not load file %s." % rpyfn) 
 
         elif os.path.exists(rpycfn):
-            if not self.load_file(dir, fn + compiled, initcode):
+            if not self.load_file(dir, fn + compiled, initcode, data):
                 raise Exception("Could not load file %s." % rpycfn) 
 
         elif os.path.exists(rpyfn):
@@ -403,13 +1232,10 @@ class Script(object):
         Init/Loads the bytecode cache.
         """
 
-        # Load the oldcache.
         try:
-            version, cache = loads(renpy.loader.load("bytecode.rpyb").read().decode("zlib"))
-            if version == BYTECODE_VERSION:
-                self.bytecode_oldcache = cache
+            self.bytecode_cache.load()
         except:
-            pass
+            self.bytecode_cache.close()
         
     def update_bytecode(self):
         """
@@ -417,60 +1243,99 @@ class Script(object):
         cache. Clears out self.all_pycode.
         """
 
+        # PyCode objects that aren't in the cache, and their keys.
+        misses = [ ]
+        
         # Update all of the PyCode objects in the system with the loaded
         # bytecode.
         for i in self.all_pycode:
 
             key = i.get_hash() + MAGIC
 
-            code = self.bytecode_oldcache.get(key, None)
+            code = self.bytecode_newcache.get(key, None)
 
             if code is None:
-                                              
-                self.bytecode_dirty = True
-                
-                old_ei = renpy.game.exception_info
-                renpy.game.exception_info = "While compiling python block starting at line %d of %s." % (i.location[1], i.location[0])
+                code = self.bytecode_cache.get(key)
 
-                try:
+            if code is None:
+                misses.append((i, key))
+                continue
                 
-                    if i.mode == 'exec':
-                        code = renpy.python.py_compile_exec_bytecode(i.source, filename=i.location[0], lineno=i.location[1])
-                    elif i.mode == 'eval':
-                        code = renpy.python.py_compile_eval_bytecode(i.source, filename=i.location[0], lineno=i.location[1])
+            i.source = None
+            self.bytecode_used.add(key)
+            i.bytecode = marshal.loads(code)
 
-                except SyntaxError, e:
+        self.all_pycode = [ ]
 
-                    pem = renpy.parser.ParseError(
-                        filename = e.filename,
-                        number = e.lineno,
-                        msg = e.msg,
-                        line = e.text,
-                        pos = e.offset)
+        args = [ (i.mode, i.source, i.location[0], i.location[1]) for i, _key in misses ]
 
-                    renpy.parser.parse_errors.append(pem.message)
-                    
-                    continue
-                        
-                renpy.game.exception_info = old_ei
+        for (i, key), (code, error) in zip(misses, [ compile_pycode(j) for j in args ]):
 
-            i.source = None
-            self.bytecode_newcache[key] = code
-            i.bytecode = marshal.loads(code)
+            if error is not None:
+                filename, lineno, msg, text, offset = error
 
-        self.all_pycode = [ ]
+                pem = renpy.parser.ParseError(
+                    filename = filename,
+                    number = lineno,
+                    msg = msg,
+                    line = text,
+                    pos = offset)
 
+                renpy.parser.parse_errors.append(pem.message)
+                
+                continue
+
+            self.bytecode_newcache[key] = code
+            
+            i.source = None
+            self.bytecode_used.add(key)
+            i.bytecode = marshal.loads(code)
 
     def save_bytecode(self):
+        """
+        Adds newly-compiled code to the bytecode cache. When the cache
+        has grown enough, or can't be appended to, it's rewritten from
+        scratch. The code is copied from the old file as it is, without
+        being loaded.
+        """
+
+        cache = self.bytecode_cache
         
-        if self.bytecode_dirty:
-            try:
-                data = (BYTECODE_VERSION, self.bytecode_newcache)
-                f = file(os.path.join(renpy.config.searchpath[0], "bytecode.rpyb"), "wb")
-                f.write(dumps(data, 2).encode("zlib"))
-                f.close()
-            except:
-                pass
+        if not self.bytecode_newcache:
+            return
+        
+        try:
+            if cache.needs_rewrite(self.bytecode_newcache):
+
+                # Only when every chunk has been loaded (by lint or
+                # warp, say) do we know which of the old code is no
+                # longer used. Otherwise, all of the code compiled by
+                # this version of python is kept.
+                if [ i for i in self.chunks if i is not None ]:
+                    keys = [ i for i in cache.index if i.endswith(MAGIC) ]
+                else:
+                    keys = list(self.bytecode_used)
+
+                entries = { }
+
+                for key in keys:
+                    code = cache.get(key)
+
+                    if code is not None:
+                        entries[key] = code
+
+                entries.update(self.bytecode_newcache)
+
+                cache.rewrite(entries)
+
+            else:
+                cache.append(self.bytecode_newcache)
+
+            self.bytecode_newcache = { }
+                
+        except:
+            renpy.display.log.write("While saving the bytecode cache:")
+            renpy.display.log.exception()
         
 
     def lookup(self, label):
@@ -482,8 +1347,11 @@ class Script(object):
         label = renpy.config.label_overrides.get(label, label)
         
         if label not in self.namemap:
-            raise ScriptError("could not find label '%s'." % str(label))
+            if label not in self.chunk_names:
+                raise ScriptError("could not find label '%s'." % str(label))
 
+            self.load_chunk(self.chunk_names[label])
+            
         return self.namemap[label]
 
     def has_label(self, label):
@@ -493,7 +1361,15 @@ class Script(object):
 
         label = renpy.config.label_overrides.get(label, label)
 
-        return label in self.namemap
+        return label in self.namemap or label in self.chunk_names
+
+    def all_names(self):
+        """
+        Returns a list of the names of all statements, including those
+        in chunks that haven't been loaded.
+        """
+
+        return self.namemap.keys() + self.chunk_names.keys()
 
     
 
@@ -26,111 +26,398 @@
 # but are probably better than nothing.
 
 import sys
+import os
 import encodings.zlib_codec; encodings.zlib_codec # E0601
 import random
 import glob
+import time
+import optparse
+import hashlib
+import struct
 
-from cPickle import dumps, HIGHEST_PROTOCOL
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 # The amount of padding we will add.
 padding_max = 64
 
-def randpadding():
+# The size of the chunks files are copied in.
+chunk_size = 1024 * 1024
 
-    plen = random.randint(1, padding_max)
+# The version of the manifest file.
+MANIFEST_VERSION = 2
 
-    rv = ""
+# If more than this fraction of an archive is taken up by members that
+# have been replaced or removed, an incremental build rebuilds the whole
+# archive instead.
+max_dead_fraction = 0.5
 
-    for _i in xrange(0, plen):
-        rv += chr(random.randint(1, 255))
+def randpadding(rng=random):
 
-    return rv
+    plen = rng.randint(1, padding_max)
 
+    return "".join([ chr(rng.randint(1, 255)) for _i in xrange(0, plen) ])
 
-# prefix is the path to the archive file, without the trailing .rpa.
-# files is a list of (full filename, inside-archive filename) pairs.
-def archive(prefix, files):
+
+def hash_file(fn):
+    """
+    Returns the md5 digest of the file `fn`, reading it a chunk at a time.
+    """
+
+    digest = hashlib.md5()
     
-    # Archive file.
-    archivef = file(prefix + ".rpa", "wb")
+    f = file(fn, "rb")
+
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+
+        digest.update(data)
+
+    f.close()
+
+    return digest.digest()
+
+def hash_files(filenames, jobs):
+    """
+    Hashes each of `filenames`, using a pool of `jobs` processes if
+    we can. Returns a list of digests, in the same order as filenames.
+    """
+
+    if multiprocessing is None or jobs <= 1 or len(filenames) <= 1:
+        return [ hash_file(i) for i in filenames ]
 
-    index = { }
+    pool = multiprocessing.Pool(jobs)
 
-    random.seed()
+    try:
+        return pool.map(hash_file, filenames)
+    finally:
+        pool.close()
+        pool.join()
 
-    key = random.randint(0, 0x7ffffffe)
     
-    padding = "RPA-3.0 XXXXXXXXXXXXXXXX XXXXXXXX\n" # W0511
+def load_manifest(prefix):
+    """
+    Loads the manifest that was written alongside the archive with
+    `prefix`. Returns None if it doesn't exist or doesn't match the
+    archive.
+    """
+
+    try:
+        f = file(prefix + ".rpa.manifest", "rb")
+        manifest = loads(f.read().decode("zlib"))
+        f.close()
+
+        if manifest["version"] != MANIFEST_VERSION:
+            return None
+        
+        f = file(prefix + ".rpa", "rb")
+        header = f.readline()
+        f.close()
 
-    archivef.write(padding)
-    offset = len(padding)
+        if header != manifest["header"]:
+            return None
+        
+        return manifest
 
-    # Needed because windows sucks. It doesn't do globbing on the
-    # command line.
+    except:
+        return None
+        
 
-    for fullfn, shortfn in files:
+def rpa4_name_hash(name):
+    """
+    The hash of a filename in an RPA-4.0 archive. This must match
+    renpy.loader.archive_name_hash.
+    """
+
+    if isinstance(name, str):
+        name = name.decode("utf-8")
+
+    return hashlib.md5(name.lower().encode("utf-8")).digest()[:8]
+    
+def write_index(archivef, entries, key, version):
+    """
+    Writes the index of the archive to archivef, at the current
+    position. Returns the header line of the archive, which needs
+    to be written to its start.
+
+    `entries` is a map from inside-archive filename to a (size, mtime,
+    digest, offset, dlen) tuple.
+    """
+
+    indexoff = archivef.tell()
+    
+    if version == 3:
+        index = { }
+
+        for shortfn, (_size, _mtime, _digest, moff, mlen) in entries.iteritems():
+            index[shortfn] = [ (moff ^ key, mlen ^ key, "") ]
+
+        archivef.write(dumps(index, HIGHEST_PROTOCOL).encode("zlib"))
+
+        return "RPA-3.0 %016x %08x\n" % (indexoff, key)
+
+    # RPA-4.0. A table of fixed-size records sorted by name hash,
+    # followed by the names. See renpy.loader.ArchiveTable.
+    record = struct.Struct(">8sQQIII")
+    
+    records = [ ]
+    
+    for shortfn, (_size, _mtime, _digest, moff, mlen) in entries.iteritems():
+        if isinstance(shortfn, unicode):
+            name = shortfn.encode("utf-8")
+        else:
+            name = shortfn
+            
+        records.append((rpa4_name_hash(shortfn), name, moff, mlen))
+
+    records.sort()
+
+    names = [ ]
+    namelen = 0
+    
+    for h, name, moff, mlen in records:
+        archivef.write(record.pack(h, moff ^ key, mlen ^ key, 0, namelen, len(name)))
+        names.append(name)
+        namelen += len(name)
+
+    archivef.write("".join(names))
+        
+    return "RPA-4.0 %016x %08x %08x\n" % (indexoff, len(records), key)
+    
+def copy_member(archivef, fullfn, digest=None):
+    """
+    Copies the file `fullfn` to the end of `archivef`, a chunk at a
+    time. Returns the number of bytes copied. If `digest` is given, it's
+    updated with the data that was copied.
+    """
+
+    dlen = 0
+    
+    datafile = file(fullfn, "rb")
+
+    while True:
+        data = datafile.read(chunk_size)
+
+        if not data:
+            break
+
+        if digest is not None:
+            digest.update(data)
+        
+        archivef.write(data)
+        dlen += len(data)
 
+    datafile.close()
+        
+    return dlen
+        
+# prefix is the path to the archive file, without the trailing .rpa.
+# files is a list of (full filename, inside-archive filename) pairs.
+#
+# If seed is not None, the key and padding are generated from it, so
+# that building the same files gives the same archive. If incremental
+# is true, only files that have changed since the last build are
+# written, at the end of the existing archive. jobs is the number of
+# processes used to hash the files that have been touched, to check if
+# they changed. Files that are written are hashed as they're copied, so
+# they're only read once. version is the archive format version, 3 or 4.
+def archive(prefix, files, seed=None, incremental=False, jobs=1, version=3):
+
+    start_time = time.time()
+
+    rng = random.Random(seed)
+
+    # Sort the files, so the layout of the archive doesn't depend on the
+    # order they were given in.
+    members = { }
+    
+    for fullfn, shortfn in files:
         # if shortfn.lower().endswith(".ttf"):
         #    continue
-        
-        shortfn = shortfn.replace("\\", "/")
 
-        index[shortfn] = [ ]
+        members[shortfn.replace("\\", "/")] = fullfn
 
-        print "Adding %s..." % shortfn
+    names = sorted(members)
 
-        datafile = file(fullfn, "rb")
+    manifest = None
+    
+    if incremental:
+        manifest = load_manifest(prefix)
 
-        while True:
+        if manifest is not None and manifest["format"] != version:
+            manifest = None
 
-            # Pad with junk.
-            padding = randpadding()
-            archivef.write(padding)
-            offset += len(padding)
+    # A map from inside-archive filename to a (size, mtime, digest,
+    # offset, dlen) tuple.
+    entries = { }
+    
+    # The names of the files that need to be written to the archive.
+    changed = [ ]
+    
+    if manifest is not None:
 
-            data = datafile.read()
-            
-            if not data:
-                break
+        old_entries = manifest["entries"]
+        dead = manifest["dead"]
 
-            dlen = len(data)
-            start = ""
-            rest = data
+        # The files that have been touched, and so need to be hashed to
+        # see if they really changed.
+        touched = [ ]
+        
+        for shortfn in names:
+            st = os.stat(members[shortfn])
+            old = old_entries.get(shortfn, None)
+
+            if old is None:
+                changed.append(shortfn)
+            elif old[0] == st.st_size and old[1] == st.st_mtime:
+                entries[shortfn] = old
+            else:
+                touched.append(shortfn)
+
+        digests = hash_files([ members[i] for i in touched ], jobs)
+        
+        for shortfn, digest in zip(touched, digests):
+            old = old_entries[shortfn]
             
-            archivef.write(rest)
+            if old[2] == digest:
+                st = os.stat(members[shortfn])
+                entries[shortfn] = (st.st_size, st.st_mtime, digest, old[3], old[4])
+            else:
+                changed.append(shortfn)
+
+        changed.sort()
+                
+        # Everything that's no longer referenced is dead space.
+        for shortfn, old in old_entries.iteritems():
+            if shortfn not in entries:
+                dead += old[4]
+
+        key = manifest["key"]
+        offset = manifest["indexoff"]
+                
+        if dead > os.path.getsize(prefix + ".rpa") * max_dead_fraction:
+            print "Compacting %s.rpa..." % prefix
+            manifest = None
+
+    if manifest is None:
+        entries = { }
+        changed = names
+        dead = 0
+        key = rng.randint(0, 0x7ffffffe)
+        
+    if manifest is not None:
+        archivef = file(prefix + ".rpa", "r+b")
 
-            index[shortfn].append((offset ^ key, dlen ^ key, start))
-            offset += len(rest)
-                      
-        datafile.close()
+        # The new members (and index) overwrite the old index.
+        archivef.seek(offset)
+        archivef.truncate()
 
-    indexoff = offset
+    else:
+        archivef = file(prefix + ".rpa", "wb")
+        
+        if version == 3:
+            padding = "RPA-3.0 XXXXXXXXXXXXXXXX XXXXXXXX\n" # W0511
+        else:
+            padding = "RPA-4.0 XXXXXXXXXXXXXXXX XXXXXXXX XXXXXXXX\n" # W0511
 
-    archivef.write(dumps(index, HIGHEST_PROTOCOL).encode("zlib"))
+        archivef.write(padding)
+        offset = len(padding)
 
+    written = 0
+        
+    for shortfn in changed:
+
+        print "Adding %s..." % shortfn
+
+        fullfn = members[shortfn]
+        st = os.stat(fullfn)
+        
+        # Pad with junk.
+        padding = randpadding(rng)
+        archivef.write(padding)
+        offset += len(padding)
+
+        digest = hashlib.md5()
+        dlen = copy_member(archivef, fullfn, digest)
+
+        entries[shortfn] = (st.st_size, st.st_mtime, digest.digest(), offset, dlen)
+        
+        offset += dlen
+        written += dlen
+
+    # Pad with junk.
+    padding = randpadding(rng)
+    archivef.write(padding)
+    offset += len(padding)
+
+    indexoff = offset
+
+    header = write_index(archivef, entries, key, version)
+    
     archivef.seek(0)
-    archivef.write("RPA-3.0 %016x %08x\n" % (indexoff, key))
+    archivef.write(header)
 
     archivef.close()
+
+    manifest = dict(
+        version=MANIFEST_VERSION,
+        format=version,
+        header=header,
+        key=key,
+        indexoff=indexoff,
+        dead=dead,
+        entries=entries)
+
+    f = file(prefix + ".rpa.manifest", "wb")
+    f.write(dumps(manifest, HIGHEST_PROTOCOL).encode("zlib"))
+    f.close()
+    
+    elapsed = max(time.time() - start_time, 0.001)
+    mb = written / 1048576.0
+        
+    print "Wrote %d of %d files, %.1f MB in %.2f s (%.1f MB/s)." % (
+        len(changed), len(names), mb, elapsed, mb / elapsed)
     
     
 def main():
 
-    if len(sys.argv) < 3:
-        print "Usage: %s <file-prefix> <files ...>" % sys.argv[0]
+    op = optparse.OptionParser(usage="%prog [options] <file-prefix> <files ...>")
+
+    op.add_option("--seed", dest="seed", default=None, type="int",
+                  help="Generate the key and padding from this seed, so the archive is reproducible.")
+
+    op.add_option("--incremental", dest="incremental", default=False, action="store_true",
+                  help="Only write files that have changed since the archive was last built.")
+
+    op.add_option("--jobs", dest="jobs", default=1, type="int",
+                  help="The number of processes used to hash files.")
+
+    op.add_option("--rpa4", dest="version", default=3, action="store_const", const=4,
+                  help="Write an RPA-4.0 archive, which has an index that can be searched without loading it.")
+
+    options, args = op.parse_args()
+    
+    if len(args) < 2:
+        op.print_usage()
         return
 
-    prefix = sys.argv[1]
+    prefix = args[0]
 
     # Needed because windows sucks. It doesn't do globbing on the
     # command line.
     files = [ ]
-    for i in sys.argv[2:]:
+    for i in args[1:]:
         files.extend(glob.glob(i))
 
     files = [ (i, i) for i in files ]
 
-    archive(prefix, files)
+    archive(prefix, files, seed=options.seed, incremental=options.incremental, jobs=options.jobs, version=options.version)
      
 if __name__ == "__main__":
     main()
@@ -41,6 +41,7 @@ def warp(spec):
     if not renpy.config.developer:
         raise Exception("Can't warp, developer mode disabled.")
 
+    renpy.game.script.load_all_chunks()
     
     # First, compute for each statement reachable from a scene statement,
     # one statement that reaches that statement.
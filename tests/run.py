@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Runs the checks in this directory. Each test_*.py file is run in its
+# own process, as the checks replace parts of the renpy package. This
+# should be run with the python that ships with Ren'Py:
+#
+#     lib/python tests/run.py [test_file.py ...]
+
+import sys
+import os
+import subprocess
+
+def main():
+
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+    files = sys.argv[1:]
+
+    if not files:
+        files = [ i for i in sorted(os.listdir(tests_dir)) if i.startswith("test_") and i.endswith(".py") ]
+
+    failed = [ ]
+
+    for fn in files:
+        print "=====", fn
+        sys.stdout.flush()
+
+        if subprocess.call([ sys.executable, os.path.join(tests_dir, os.path.basename(fn)) ]):
+            failed.append(fn)
+
+    if failed:
+        print
+        print "Failed:", " ".join(failed)
+        sys.exit(1)
+
+    print
+    print "All checks passed."
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains code that's shared by the checks in this directory.
+# The checks need to run on the Python 2.6 that ships with Ren'Py, which
+# doesn't have unittest, so each check is a script containing test_
+# functions that's run by run.py.
+#
+# Rather than importing all of Ren'Py (which needs pygame and a display),
+# a check creates a stand-in renpy package containing only what the
+# modules it tests use, and then loads those modules into it.
+
+import sys
+import os
+import imp
+import types
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The directory containing the standard library that ships with Ren'Py.
+RUNTIME_LIB = os.path.join(ROOT, "lib", "linux-x86", "lib", "python2.6")
+
+# Modules that are built into the python binary that ships with Ren'Py,
+# rather than being in RUNTIME_LIB.
+RUNTIME_BUILTINS = [
+    "__builtin__", "__main__", "_ast", "_codecs", "_sre", "_symtable",
+    "_warnings", "errno", "exceptions", "gc", "imp", "marshal", "posix",
+    "pwd", "signal", "sys", "thread", "xxsubtype", "zipimport",
+    ]
+
+# Attributes of runtime modules that were added in Python 2.7, and so
+# can't be used.
+NEW_IN_27 = {
+    "collections" : [ "OrderedDict", "Counter" ],
+    "itertools" : [ "compress", "combinations_with_replacement" ],
+    "functools" : [ "total_ordering", "cmp_to_key" ],
+    "subprocess" : [ "check_output" ],
+    "weakref" : [ "WeakSet" ],
+    }
+
+class Namespace(object):
+    """
+    An object that attributes can be set on.
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def runtime_modules():
+    """
+    Returns the set of the names of the top-level modules that ship with
+    Ren'Py.
+    """
+
+    rv = set(RUNTIME_BUILTINS)
+
+    for fn in os.listdir(RUNTIME_LIB):
+        rv.add(fn.split(".")[0])
+
+    return rv
+
+class RuntimeImporter(object):
+    """
+    An import hook that makes modules that don't ship with Ren'Py
+    unimportable from the renpy package, as they would be when running
+    on the shipped Python.
+    """
+
+    def __init__(self):
+        self.modules = runtime_modules()
+
+    def find_module(self, fullname, path=None):
+
+        if fullname.split(".")[0] in self.modules:
+            return None
+
+        importer = sys._getframe(1).f_globals.get("__name__", "")
+
+        if importer.split(".")[0] != "renpy":
+            return None
+
+        return self
+
+    def load_module(self, fullname):
+        raise ImportError("No module named %s (emulating the Ren'Py runtime)" % fullname)
+
+class emulate_runtime(object):
+    """
+    A context manager that, while active, makes the standard library look
+    like the one that ships with Ren'Py, by hiding modules that don't
+    ship with it, and attributes that were added in Python 2.7.
+    """
+
+    def __enter__(self):
+        self.importer = RuntimeImporter()
+        sys.meta_path.insert(0, self.importer)
+
+        self.hidden = [ ]
+
+        for modname, attrs in NEW_IN_27.items():
+            mod = __import__(modname)
+
+            for attr in attrs:
+                if attr in mod.__dict__:
+                    self.hidden.append((mod, attr, mod.__dict__[attr]))
+                    delattr(mod, attr)
+
+        return self
+
+    def __exit__(self, type, value, tb): #@ReservedAssignment
+        sys.meta_path.remove(self.importer)
+
+        for mod, attr, v in self.hidden:
+            setattr(mod, attr, v)
+
+def package(name):
+    """
+    Creates an empty stand-in for the package `name`, and its parents.
+    Returns the package.
+    """
+
+    parent = None
+    rv = None
+
+    parts = name.split(".")
+
+    for i in range(len(parts)):
+        fullname = ".".join(parts[:i + 1])
+
+        rv = sys.modules.get(fullname, None)
+
+        if rv is None:
+            rv = types.ModuleType(fullname)
+            rv.__path__ = [ ]
+            sys.modules[fullname] = rv
+
+            if parent is not None:
+                setattr(parent, parts[i], rv)
+
+        parent = rv
+
+    return rv
+
+def load(name):
+    """
+    Loads the Ren'Py module `name` (like "renpy.display.im") from the
+    source tree, into the stand-in renpy package. Returns the module.
+    """
+
+    parent, _, child = name.rpartition(".")
+    pkg = package(parent)
+
+    fn = os.path.join(ROOT, *name.split(".")) + ".py"
+    mod = imp.load_source(name, fn)
+    setattr(pkg, child, mod)
+
+    return mod
+
+class Surface(object):
+    """
+    A stand-in for a pygame surface, that stores its pixels as a list of
+    rows of (r, g, b, a) tuples.
+    """
+
+    def __init__(self, size, pixels=None):
+        self.width, self.height = size
+
+        if pixels is None:
+            pixels = [ [ (0, 0, 0, 0) ] * self.width for _i in range(self.height) ]
+
+        self.pixels = pixels
+
+    def get_size(self):
+        return (self.width, self.height)
+
+    def get_pitch(self):
+        return self.width * 4
+
+    def subsurface(self, rect):
+        x, y, w, h = rect
+
+        if x < 0 or y < 0 or x + w > self.width or y + h > self.height:
+            raise ValueError("subsurface rectangle outside surface area")
+
+        return Surface((w, h), [ row[x:x + w] for row in self.pixels[y:y + h] ])
+
+def pattern(size, seed):
+    """
+    Returns a Surface of `size`, filled with a pattern of pixels that
+    depends on `seed`.
+    """
+
+    w, h = size
+
+    pixels = [ ]
+
+    for y in range(h):
+        row = [ ]
+
+        for x in range(w):
+            n = (x * 7919 + y * 104729 + seed * 1299709) * 2654435761
+            row.append(((n >> 8) & 255, (n >> 16) & 255, (n >> 24) & 255, (n >> 32) & 255))
+
+        pixels.append(row)
+
+    return Surface(size, pixels)
+
+def transform_scale(surf, size):
+    """
+    Scales `surf` to `size`, using the nearest pixel.
+    """
+
+    w, h = size
+    ow, oh = surf.get_size()
+
+    pixels = [ ]
+
+    for y in range(h):
+        row = surf.pixels[y * oh // h]
+        pixels.append([ row[x * ow // w] for x in range(w) ])
+
+    return Surface(size, pixels)
+
+def smoothscale(surf, size):
+    """
+    Scales `surf` to `size`, blending the four nearest pixels.
+    """
+
+    w, h = size
+    ow, oh = surf.get_size()
+
+    def sample(i, n, on):
+        # Returns the two source pixels around i, and the weight of the
+        # second, out of 256.
+        pos = max(0, ((2 * i + 1) * on * 256 // n - 256) // 2)
+        lo = min(pos >> 8, on - 1)
+        return lo, min(lo + 1, on - 1), pos & 255
+
+    pixels = [ ]
+
+    for y in range(h):
+        y0, y1, fy = sample(y, h, oh)
+        row = [ ]
+
+        for x in range(w):
+            x0, x1, fx = sample(x, w, ow)
+
+            p00 = surf.pixels[y0][x0]
+            p01 = surf.pixels[y0][x1]
+            p10 = surf.pixels[y1][x0]
+            p11 = surf.pixels[y1][x1]
+
+            row.append(tuple(
+                ((p00[i] * (256 - fx) + p01[i] * fx) * (256 - fy) + (p10[i] * (256 - fx) + p11[i] * fx) * fy) >> 16
+                for i in range(4)))
+
+        pixels.append(row)
+
+    return Surface(size, pixels)
+
+def flip(surf, horizontal, vertical):
+
+    pixels = [ list(row) for row in surf.pixels ]
+
+    if horizontal:
+        for row in pixels:
+            row.reverse()
+
+    if vertical:
+        pixels.reverse()
+
+    return Surface(surf.get_size(), pixels)
+
+def clamp(v):
+    return min(255, max(0, int(v)))
+
+def apply_pixels(src, dst, fn):
+    dst.pixels = [ [ fn(p) for p in row ] for row in src.pixels ]
+
+def colormatrix(src, dst, m):
+
+    def fn(p):
+        return tuple(clamp(sum(m[i * 5 + j] * p[j] for j in range(4)) + m[i * 5 + 4] * 255) for i in range(4))
+
+    apply_pixels(src, dst, fn)
+
+def linmap(src, dst, *maps):
+
+    def fn(p):
+        return tuple(clamp(p[i] * maps[i] >> 8) for i in range(4))
+
+    apply_pixels(src, dst, fn)
+
+def map(src, dst, *maps): #@ReservedAssignment
+
+    def fn(p):
+        return tuple(ord(maps[i][p[i]]) for i in range(4))
+
+    apply_pixels(src, dst, fn)
+
+def fake_display(**config):
+    """
+    Creates stand-ins for the parts of Ren'Py that the image manipulators
+    use, and loads renpy.display.im, imarray and imfuse. `config` gives
+    values of renpy.config to change from their defaults. Returns the
+    renpy package.
+    """
+
+    import threading
+
+    renpy = package("renpy")
+
+    renpy.config = Namespace(
+        debug=False,
+        debug_image_cache=False,
+        image_cache_size=8,
+        image_cache_bytes=None,
+        screen_width=100,
+        screen_height=100,
+        preload_threads=1,
+        thumbnail_cache_size=30,
+        numpy_image_operations=False,
+        fuse_image_operations=True,
+        cache_shared_image_operations=False,
+        )
+
+    renpy.config.__dict__.update(config)
+
+    renpy.game = Namespace(less_memory=False, options=Namespace(debug_image_cache=False))
+    renpy.store = Namespace(_cache_pin_set=set())
+
+    display = package("renpy.display")
+
+    class Displayable(object):
+        def __init__(self, **properties):
+            return
+
+    display.core = Namespace(Displayable=Displayable)
+    display.render = Namespace(mutated_surface=lambda surf : None, blit_lock=threading.Lock())
+    display.draw = Namespace(load_texture=lambda surf : surf)
+    display.scale = Namespace(smoothscale=smoothscale)
+    display.pgrender = Namespace(
+        transform_scale=transform_scale,
+        flip=flip,
+        surface=lambda size, alpha : Surface(size))
+    display.module = Namespace(colormatrix=colormatrix, linmap=linmap, map=map)
+
+    im = load("renpy.display.im")
+    load("renpy.display.imarray")
+    load("renpy.display.imfuse")
+
+    im.cache.init()
+
+    return renpy
+
+def fake_python(**config):
+    """
+    Creates stand-ins for the parts of Ren'Py that renpy.python uses, and
+    loads it. Returns the renpy package.
+    """
+
+    renpy = package("renpy")
+
+    renpy.config = Namespace(
+        debug=False,
+        profile=False,
+        rollback_length=128,
+        hard_rollback_limit=100,
+        )
+
+    renpy.config.__dict__.update(config)
+
+    package("renpy.audio")
+    load("renpy.object")
+
+    renpy.store = types.ModuleType("store")
+    sys.modules["store"] = renpy.store
+
+    scene_lists = Namespace(transient_is_empty=lambda : True)
+
+    context = Namespace(
+        scene_lists=scene_lists,
+        rollback_copy=lambda : None)
+
+    renpy.game = Namespace(contexts=[ context ])
+
+    load("renpy.python")
+
+    return renpy
+
+def main(namespace):
+    """
+    Runs the test_ functions in `namespace`, in the order they appear
+    in the file. Exits with a non-zero status if any fail.
+    """
+
+    tests = [ (v.func_code.co_firstlineno, k, v) for k, v in namespace.items() if k.startswith("test_") and callable(v) ]
+    tests.sort()
+
+    failed = 0
+
+    for _line, name, fn in tests:
+
+        try:
+            fn()
+            print "ok", name
+        except:
+            failed += 1
+            print "FAIL", name
+            traceback.print_exc()
+
+    sys.stdout.flush()
+
+    if failed:
+        sys.exit(1)
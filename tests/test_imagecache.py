@@ -0,0 +1,193 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Checks the image cache's eviction order and size accounting.
+
+import support
+
+renpy = support.fake_display(image_cache_size=1, screen_width=10, screen_height=10)
+im = renpy.display.im
+
+class Solid(im.ImageBase):
+    """
+    An image of the given size, distinguished by `n`.
+    """
+
+    def __init__(self, n, width, height):
+        super(Solid, self).__init__(n, width, height)
+        self.size = (width, height)
+
+    def load(self):
+        return support.Surface(self.size)
+
+def reset():
+    im.cache.clear()
+    im.cache.cache_limit = 400
+    im.cache.cache_bytes_limit = None
+
+def cached():
+    return [ i.identity[1] for i in im.cache.cache ]
+
+def test_lrumap():
+    m = im.LRUMap()
+
+    for i in range(5):
+        m[i] = str(i)
+
+    m.touch(1)
+    m[3] = "three"
+    del m[0]
+
+    assert list(m) == [ 2, 4, 1, 3 ]
+    assert list(m.itervalues()) == [ "2", "4", "1", "three" ]
+    assert m.oldest() == (2, "2")
+    assert len(m) == 4
+    assert 4 in m and 0 not in m
+    assert m.pop(4) == "4"
+    assert m.pop(4, None) is None
+    assert list(m) == [ 2, 1, 3 ]
+
+    m.clear()
+    assert len(m) == 0
+
+    try:
+        m.oldest()
+    except KeyError:
+        pass
+    else:
+        assert False, "oldest() of an empty map should raise KeyError"
+
+def test_eviction_order():
+    reset()
+
+    images = [ Solid(i, 5, 5) for i in range(4) ]
+
+    with im.cache.lock:
+
+        for i in images:
+            im.cache.get(i)
+
+        im.cache.tick()
+
+        # Using an image makes it the most recently used.
+        im.cache.get(images[0])
+        assert cached() == [ 1, 2, 3, 0 ]
+
+        im.cache.tick()
+
+        # Each image is 100 bytes, so adding two more evicts the two least
+        # recently used.
+        im.cache.get(Solid(4, 5, 5))
+        im.cache.get(Solid(5, 5, 5))
+        assert im.cache.cleanout()
+
+        assert cached() == [ 3, 0, 4, 5 ]
+        assert im.cache.total_cache_size == 400
+
+def test_current_generation_is_kept():
+    reset()
+
+    with im.cache.lock:
+        for i in range(6):
+            im.cache.get(Solid(i, 5, 5))
+
+        # Everything was used this tick, so nothing can be removed.
+        assert not im.cache.cleanout()
+        assert len(im.cache.cache) == 6
+
+def test_byte_limit():
+    reset()
+
+    im.cache.cache_limit = 10000
+    im.cache.cache_bytes_limit = 250
+
+    with im.cache.lock:
+        im.cache.get(Solid(0, 5, 5))
+        im.cache.get(Solid(1, 5, 5))
+        im.cache.tick()
+
+        im.cache.get(Solid(2, 5, 5))
+
+        assert im.cache.total_cache_bytes == 600
+
+        # The draw module doesn't have texture_size, so each texture is
+        # assumed to be as big as its surface.
+        for ce in im.cache.cache.itervalues():
+            assert ce.bytes == 2 * ce.size
+
+        assert im.cache.cleanout()
+        assert cached() == [ 2 ]
+        assert im.cache.total_cache_bytes == 200
+
+def test_texture_size():
+    reset()
+
+    renpy.display.draw.texture_size = lambda texture : 1000
+
+    try:
+        with im.cache.lock:
+            im.cache.get(Solid(0, 5, 5))
+            assert im.cache.total_cache_size == 100
+            assert im.cache.total_cache_bytes == 1100
+    finally:
+        del renpy.display.draw.texture_size
+
+class Thumbnail(Solid):
+
+    thumbnail = True
+
+    loads = 0
+
+    def load(self):
+        Thumbnail.loads += 1
+        return Solid.load(self)
+
+def test_thumbnail_cache():
+    reset()
+
+    renpy.config.thumbnail_cache_size = 2
+
+    with im.cache.lock:
+        a = Thumbnail("a", 5, 5)
+        b = Thumbnail("b", 5, 5)
+        c = Thumbnail("c", 5, 5)
+
+        for i in (a, b, c):
+            im.cache.get(i)
+
+        assert Thumbnail.loads == 3
+        assert [ i.identity[1] for i in im.cache.thumbnail_cache ] == [ "b", "c" ]
+
+        # Once they leave the image cache, thumbnails are taken from the
+        # thumbnail cache rather than being loaded again.
+        for ce in list(im.cache.cache.itervalues()):
+            im.cache.kill(ce)
+
+        im.cache.get(b)
+        im.cache.get(c)
+        assert Thumbnail.loads == 3
+
+        im.cache.get(a)
+        assert Thumbnail.loads == 4
+        assert [ i.identity[1] for i in im.cache.thumbnail_cache ] == [ "c", "a" ]
+
+if __name__ == "__main__":
+    support.main(globals())
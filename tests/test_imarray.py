@@ -0,0 +1,130 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Checks that applying a chain of color image manipulators with NumPy
+# gives the same result as applying them one at a time. NumPy doesn't
+# ship with Ren'Py, so these checks do nothing without it.
+
+import support
+
+renpy = support.fake_display(image_cache_size=1000)
+im = renpy.display.im
+imarray = renpy.display.imarray
+numpy = imarray.numpy
+
+def get_pixels(surf):
+    return numpy.array(surf.pixels, numpy.uint8)
+
+def set_pixels(surf, pixels):
+    surf.pixels = [ [ tuple(p) for p in row ] for row in pixels.tolist() ]
+
+imarray.get_pixels = get_pixels
+imarray.set_pixels = set_pixels
+
+class Source(im.ImageBase):
+
+    def __init__(self, n, width, height):
+        super(Source, self).__init__(n, width, height)
+        self.n = n
+        self.size = (width, height)
+
+    def load(self):
+        return support.pattern(self.size, self.n)
+
+def load(image, use_numpy):
+    """
+    Returns the pixels of `image`, loaded with or without NumPy.
+    """
+
+    renpy.config.numpy_image_operations = use_numpy
+    renpy.config.fuse_image_operations = False
+    im.cache.clear()
+
+    try:
+        return get_pixels(im.cache.get(image)).astype(int)
+    finally:
+        renpy.config.numpy_image_operations = False
+        renpy.config.fuse_image_operations = True
+        im.cache.clear()
+
+def check(image):
+    """
+    Checks that loading `image` with NumPy gives the same pixels as
+    loading it without, apart from rounding.
+    """
+
+    if numpy is None:
+        return
+
+    a = load(image, True)
+    b = load(image, False)
+
+    assert abs(a - b).max() <= 1, "%r differs with NumPy." % (image, )
+
+def test_clamped_between_matrices():
+    src = Source(1, 16, 16)
+
+    # The first matrix makes most colors brighter than white, which
+    # must be clamped before the second matrix darkens them.
+    image = im.MatrixColor(im.MatrixColor(src, im.matrix.brightness(.6)), im.matrix.brightness(-.6))
+    check(image)
+
+    image = im.MatrixColor(im.MatrixColor(src, im.matrix.contrast(3)), im.matrix.invert())
+    check(image)
+
+    image = im.MatrixColor(im.Recolor(im.MatrixColor(src, im.matrix.saturation(2)), 255, 255, 128, 255), im.matrix.saturation(.5))
+    check(image)
+
+def test_combined_matrices():
+    src = Source(2, 16, 16)
+
+    image = im.MatrixColor(im.Recolor(im.MatrixColor(src, im.matrix.desaturate()), 255, 128, 0, 255), im.matrix.tint(.5, .8, 1))
+    check(image)
+
+    if numpy is not None:
+        ops = [ ("matrix", im.matrix.desaturate()), ("linear", (256, 129, 1, 256)), ("matrix", im.matrix.tint(.5, .8, 1)) ]
+        assert len(imarray.combine(ops)) == 1
+
+        ops = [ ("matrix", im.matrix.brightness(.6)), ("matrix", im.matrix.brightness(-.6)) ]
+        assert len(imarray.combine(ops)) == 2
+
+def test_full_matrix():
+    src = Source(4, 16, 16)
+
+    # Only the first four rows of a 25-element matrix are used, without
+    # NumPy, so a fifth row that isn't the identity is ignored.
+    m = tuple(im.matrix.brightness(.25))[:20] + (.5, 0, 0, 0, 2)
+
+    image = im.MatrixColor(im.MatrixColor(src, m), im.matrix.desaturate())
+    check(image)
+
+    if numpy is not None:
+        ops = imarray.combine([ ("matrix", m) ])
+        assert (ops[0][1][4] == [ 0, 0, 0, 0, 1 ]).all()
+
+def test_maps():
+    src = Source(3, 16, 16)
+
+    image = im.Map(im.MatrixColor(im.Map(src, rmap=im.ramp(255, 0)), im.matrix.invert()), gmap=im.ramp(64, 192))
+    check(image)
+
+if __name__ == "__main__":
+    support.main(globals())
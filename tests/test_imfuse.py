@@ -0,0 +1,238 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Checks that loading a chain of image manipulators as one operation gives
+# the same result as loading each manipulator in turn.
+
+import gc
+import random
+
+import support
+
+renpy = support.fake_display(image_cache_size=1000)
+im = renpy.display.im
+imfuse = renpy.display.imfuse
+
+class Source(im.ImageBase):
+
+    loads = 0
+
+    def __init__(self, n, width, height):
+        super(Source, self).__init__(n, width, height)
+        self.n = n
+        self.size = (width, height)
+
+    def load(self):
+        Source.loads += 1
+        return support.pattern(self.size, self.n)
+
+def load(image, fuse):
+    """
+    Returns the pixels of `image`, loaded with or without fusing.
+    """
+
+    renpy.config.fuse_image_operations = fuse
+    im.cache.clear()
+
+    try:
+        return im.cache.get(image).pixels
+    finally:
+        renpy.config.fuse_image_operations = True
+        im.cache.clear()
+
+def check(image):
+    assert load(image, True) == load(image, False), "%r differs when fused." % (image, )
+
+def fused(image):
+    """
+    Returns True if `image` is loaded as a single operation.
+    """
+
+    im.cache.clear()
+    return imfuse.load(image) is not None
+
+def test_orderings():
+    src = Source(1, 12, 8)
+
+    crop = lambda i : im.Crop(i, (2, 2, 6, 4))
+    scale = lambda i : im.Scale(i, 24, 16, bilinear=False)
+    flip = lambda i : im.Flip(i, horizontal=True)
+    vflip = lambda i : im.Flip(i, vertical=True)
+    smooth = lambda i : im.Scale(i, 18, 12, bilinear=True)
+    recolor = lambda i : im.Recolor(i, 255, 128, 0, 255)
+
+    for ops in [
+        (crop, scale),
+        (scale, crop),
+        (crop, flip),
+        (flip, crop),
+        (scale, flip),
+        (flip, scale),
+        (crop, flip, scale),
+        (flip, crop, scale),
+        (scale, vflip, crop),
+        (vflip, scale, flip, crop),
+        (crop, smooth),
+        (smooth, crop),
+        (smooth, flip),
+        (flip, smooth),
+        (crop, flip, smooth),
+        (smooth, vflip, crop),
+        (recolor, smooth),
+        (smooth, recolor, crop),
+        ]:
+
+        image = src
+
+        for op in ops:
+            image = op(image)
+
+        check(image)
+
+def test_scale_twice():
+    src = Source(2, 12, 8)
+
+    # The intermediate size changes the result, so two scales can't be
+    # combined into one.
+    image = im.Scale(im.Scale(src, 3, 2, bilinear=False), 12, 8, bilinear=False)
+    check(image)
+    assert not fused(image)
+
+    image = im.FactorScale(im.Scale(src, 3, 2, bilinear=False), 4, bilinear=False)
+    check(image)
+    assert not fused(image)
+
+    # The inner chain is still fused.
+    image = im.Scale(im.Crop(im.Scale(src, 24, 16, bilinear=False), (0, 0, 20, 10)), 5, 5, bilinear=False)
+    check(image)
+    assert fused(image.image)
+
+def test_bilinear():
+    src = Source(5, 12, 8)
+
+    # Bilinear scaling blends in pixels from outside of the crop.
+    image = im.Crop(im.Scale(src, 24, 16, bilinear=True), (2, 2, 6, 4))
+    check(image)
+    assert not fused(image)
+
+    image = im.Scale(im.Crop(src, (2, 2, 6, 4)), 24, 16, bilinear=True)
+    check(image)
+    assert fused(image)
+
+    # Blending colors that have been rounded isn't the same as rounding
+    # blended colors.
+    image = im.Scale(im.Recolor(src, 200, 100, 50, 255), 24, 16, bilinear=True)
+    check(image)
+    assert not fused(image)
+
+def test_colors():
+    src = Source(3, 10, 6)
+
+    image = im.MatrixColor(im.Crop(src, (1, 1, 8, 4)), im.matrix.desaturate())
+    check(image)
+    assert fused(image)
+
+    image = im.Flip(im.Recolor(im.Scale(src, 20, 12, bilinear=False), 255, 128, 0, 255), vertical=True)
+    check(image)
+    assert fused(image)
+
+    image = im.Crop(im.Map(src, bmap=im.ramp(255, 0)), (0, 0, 5, 5))
+    check(image)
+    assert fused(image)
+
+    # A matrix that can clamp colors isn't moved after a scale.
+    image = im.Scale(im.MatrixColor(src, im.matrix.brightness(.5)), 20, 12, bilinear=False)
+    check(image)
+    assert not fused(image)
+
+    image = im.Scale(im.MatrixColor(src, im.matrix.desaturate()), 20, 12, bilinear=False)
+    check(image)
+    assert fused(image) == (renpy.display.imarray.numpy is not None)
+
+def test_random_chains():
+    rng = random.Random(0)
+
+    for n in range(100):
+        w, h = rng.randint(4, 12), rng.randint(4, 12)
+        image = Source(n, w, h)
+
+        for _i in range(rng.randint(2, 5)):
+            kind = rng.choice([ "crop", "flip", "scale", "factorscale", "color", "matrix" ])
+            bilinear = rng.random() < .5
+
+            if kind == "crop":
+                cw, ch = rng.randint(1, w), rng.randint(1, h)
+                image = im.Crop(image, (rng.randint(0, w - cw), rng.randint(0, h - ch), cw, ch))
+                w, h = cw, ch
+
+            elif kind == "flip":
+                image = im.Flip(image, horizontal=rng.random() < .5, vertical=True)
+
+            elif kind == "scale":
+                w, h = rng.randint(1, 24), rng.randint(1, 24)
+                image = im.Scale(image, w, h, bilinear=bilinear)
+
+            elif kind == "factorscale":
+                image = im.FactorScale(image, 2, bilinear=bilinear)
+                w, h = w * 2, h * 2
+
+            elif kind == "matrix":
+                image = im.MatrixColor(image, rng.choice([ im.matrix.desaturate(), im.matrix.brightness(.25) ]))
+
+            else:
+                image = im.Recolor(image, 200, 100, 50, 255)
+
+        check(image)
+
+def test_shared():
+    renpy.config.cache_shared_image_operations = True
+
+    try:
+        src = Source(4, 8, 8)
+        middle = im.Flip(im.Crop(src, (0, 0, 4, 4)), horizontal=True)
+
+        a = im.Crop(middle, (1, 1, 2, 2))
+        b = im.Recolor(middle, 255, 0, 0, 255)
+
+        im.cache.clear()
+
+        with im.cache.lock:
+            im.cache.get(a)
+            assert middle not in im.cache.cache
+
+            # The second chain finds that middle is shared, so it's
+            # loaded, and cached for the next chain that uses it.
+            im.cache.get(b)
+            assert middle in im.cache.cache
+
+    finally:
+        renpy.config.cache_shared_image_operations = False
+
+    del src, middle, a, b
+    im.cache.clear()
+    gc.collect()
+
+    # Images that aren't used any more aren't kept alive.
+    assert len(imfuse.parents) == 0
+    assert len(imfuse.shared) == 0
+
+if __name__ == "__main__":
+    support.main(globals())
@@ -0,0 +1,290 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Checks that files are found on disk and in archives.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import cPickle
+
+import support
+
+renpy = support.package("renpy")
+
+renpy.config = support.Namespace(
+    archive_file_pool=4,
+    archives=[ ],
+    basedir=tempfile.mkdtemp(),
+    debug=True,
+    developer=False,
+    dump_file_index=False,
+    file_open_callback=None,
+    force_archives=False,
+    reject_backslash=True,
+    searchpath=[ ],
+    )
+
+GAME = os.path.join(renpy.config.basedir, "game")
+renpy.config.searchpath = [ GAME ]
+
+with support.emulate_runtime():
+    loader = support.load("renpy.loader")
+
+# RenpyImporter shouldn't be used to import the modules the checks use.
+sys.meta_path = [ i for i in sys.meta_path if not isinstance(i, loader.RenpyImporter) ]
+
+def write(name, data):
+    fn = os.path.join(GAME, name)
+
+    if not os.path.isdir(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+
+    f = open(fn, "wb")
+    f.write(data)
+    f.close()
+
+def write_archive(prefix, files):
+    """
+    Writes an RPA-3.0 archive containing `files`, a map from filename to
+    data.
+    """
+
+    key = 0x42424242
+    data = [ ]
+    index = { }
+
+    offset = 34
+
+    for name, contents in sorted(files.items()):
+        index[name] = [ (offset ^ key, len(contents) ^ key) ]
+        data.append(contents)
+        offset += len(contents)
+
+    write(prefix + ".rpa", "RPA-3.0 %016x %08x\n" % (offset, key) + "".join(data) + cPickle.dumps(index).encode("zlib"))
+
+def read(name):
+    f = loader.load(name)
+    rv = f.read()
+    f.close()
+    return rv
+
+def setup():
+    if os.path.exists(GAME):
+        shutil.rmtree(GAME)
+
+    os.makedirs(GAME)
+
+    write_archive("data", { "a.txt" : "archive a", "b.txt" : "archive b", "sub/c.txt" : "archive c" })
+    write("b.txt", "disk b")
+
+    renpy.config.archives = [ "data" ]
+
+    loader.index_archives()
+
+def test_index():
+    setup()
+
+    assert read("a.txt") == "archive a"
+    assert read("sub/c.txt") == "archive c"
+
+    # Files on disk take precedence over archives.
+    assert read("b.txt") == "disk b"
+    assert loader.transfn("b.txt") == os.path.join(GAME, "b.txt")
+
+    assert loader.loadable("a.txt")
+    assert not loader.loadable("missing.txt")
+
+def test_created_after_index():
+    setup()
+
+    write("a.txt", "disk a")
+    write("new.txt", "disk new")
+
+    # Files created after the index was built are still found, but the
+    # disk is only checked when a file isn't in the index, so the
+    # archive is used for a file it contains until the next reindex.
+    assert read("new.txt") == "disk new"
+    assert loader.transfn("new.txt") == os.path.join(GAME, "new.txt")
+    assert read("a.txt") == "archive a"
+
+    loader.index_archives()
+
+    assert read("a.txt") == "disk a"
+    assert loader.transfn("a.txt") == os.path.join(GAME, "a.txt")
+
+    try:
+        loader.transfn("sub/c.txt")
+    except Exception:
+        pass
+    else:
+        assert False, "transfn should fail for a file that's only in an archive"
+
+def test_pooled_archive_files():
+    setup()
+
+    # Files open at the same time get their own file objects.
+    a = loader.load("a.txt")
+    c = loader.load("sub/c.txt")
+
+    assert a.read(3) == "arc"
+    assert c.read(3) == "arc"
+    assert a.read() == "hive a"
+    assert c.read() == "hive c"
+
+    a.close()
+    c.close()
+
+    # Closed files are kept, and reused.
+    pool = loader.archive_pools["data"]
+    assert len(pool) == 2
+
+    f = pool[-1]
+    a = loader.load("a.txt")
+    assert a.f is f
+    assert a.read() == "archive a"
+    a.close()
+
+    # A closed file can't be used, as its file may be reused by another
+    # file, and closing it again doesn't put it in the pool twice.
+    assert a.f is None
+    a.close()
+    assert len(pool) == 2
+
+    for fn, args in [ (a.read, ()), (a.readline, ()), (a.seek, (0,)), (a.tell, ()) ]:
+        try:
+            fn(*args)
+        except ValueError:
+            pass
+        else:
+            assert False, "%s should fail on a closed file" % fn.__name__
+
+    loader.close_archive_files()
+    assert f.closed
+
+def test_force_archives():
+    setup()
+
+    renpy.config.force_archives = True
+
+    try:
+        assert read("b.txt") == "archive b"
+    finally:
+        renpy.config.force_archives = False
+
+def test_reindex_from_threads():
+    setup()
+
+    errors = [ ]
+
+    def worker():
+        try:
+            for _i in range(200):
+                assert read("a.txt") == "archive a"
+                assert read("b.txt") == "disk b"
+        except:
+            errors.append(sys.exc_info()[1])
+
+    threads = [ threading.Thread(target=worker) for _i in range(4) ]
+
+    for t in threads:
+        t.start()
+
+    # Changing the search path makes the next lookup rebuild the index.
+    for i in range(50):
+        if i % 2:
+            renpy.config.searchpath = [ GAME ]
+        else:
+            renpy.config.searchpath = [ GAME, GAME + "/sub" ]
+
+        loader.locate("a.txt")
+
+    for t in threads:
+        t.join()
+
+    renpy.config.searchpath = [ GAME ]
+
+    assert not errors, errors
+
+def launch():
+    """
+    Simulates starting Ren'Py, by loading the scan cache and indexing the
+    files. Returns the number of directories that were listed.
+    """
+
+    listed = [ ]
+    listdir = os.listdir
+
+    def counting_listdir(dn):
+        listed.append(dn)
+        return listdir(dn)
+
+    loader.scan_cache = None
+    os.listdir = counting_listdir
+
+    try:
+        loader.index_archives()
+    finally:
+        os.listdir = listdir
+
+    return len(listed)
+
+def test_scan_cache():
+    setup()
+
+    write("sub/d.txt", "disk d")
+
+    if os.path.exists(os.path.join(GAME, "dirscan.rpyb")):
+        os.unlink(os.path.join(GAME, "dirscan.rpyb"))
+
+    old = int(time.time()) - 100
+
+    def age_directories():
+        os.utime(GAME, (old, old))
+        os.utime(GAME + "/sub", (old, old))
+
+    age_directories()
+    assert launch() == 2
+
+    # The cache file was created, and the directory that was just
+    # changed can't be trusted, so it's scanned once more.
+    age_directories()
+    mtime = os.stat(GAME).st_mtime
+    assert launch() == 1
+
+    # Saving the cache doesn't change the mtime of the directory it's
+    # in, so nothing needs to be scanned.
+    assert os.stat(GAME).st_mtime == mtime
+    assert launch() == 0
+    assert loader.transfn("sub/d.txt") == GAME + "/sub/d.txt"
+
+    write("sub/e.txt", "disk e")
+    assert launch() == 1
+    assert loader.locate("sub/e.txt")[0] == "dir"
+
+if __name__ == "__main__":
+    try:
+        support.main(globals())
+    finally:
+        shutil.rmtree(renpy.config.basedir)
@@ -0,0 +1,410 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Checks how saves are written.
+
+import os
+import cPickle
+import shutil
+import tempfile
+import threading
+
+import support
+
+with support.emulate_runtime():
+    renpy = support.fake_python(
+        auto_save_extra_info=None,
+        autosave_slots=2,
+        savedir=tempfile.mkdtemp(),
+        save_deltas=False,
+        save_delta_limit=10,
+        save_dump=False,
+        thumbnail_width=10,
+        thumbnail_height=10,
+        use_cpickle=True,
+        )
+
+renpy.savegame_suffix = "-test.save"
+renpy.version = "test"
+
+class Log(object):
+
+    def __init__(self):
+        self.messages = [ ]
+
+    def write(self, s, *args):
+        self.messages.append(s % args)
+
+    def exception(self):
+        self.messages.append("exception")
+
+class Screenshot(object):
+
+    def __init__(self, surf):
+        return
+
+    def get(self):
+        return "screenshot"
+
+display = support.package("renpy.display")
+display.log = Log()
+display.core = support.Namespace(Screenshot=Screenshot, cpu_idle=threading.Event())
+display.core.cpu_idle.set()
+
+renpy.game.interface = support.Namespace(screenshot=None, capture_screenshot=lambda scale : None)
+
+with support.emulate_runtime():
+    loadsave = support.load("renpy.loadsave")
+
+class FakeLog(object):
+    """
+    Stands in for the rollback log, recording the threads it's frozen
+    and pickled on.
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+        self.frozen = [ ]
+        self.pickled = [ ]
+
+    def freeze(self, wait=None):
+        if self.error is not None:
+            raise self.error
+
+        self.frozen.append(threading.currentThread())
+        return { "roots" : 1 }
+
+    def __getstate__(self):
+        self.pickled.append(threading.currentThread())
+
+        # The game may be changed while this is being pickled.
+        if self.error is not None:
+            renpy.python.mutate_flag = True
+
+        return { }
+
+def autosave(log):
+    renpy.game.log = log
+
+    written = [ ]
+    old_write_save = loadsave.write_save
+    old_cycle_saves = loadsave.cycle_saves
+
+    loadsave.write_save = lambda name, log_name, log_data, screenshot, extra_info : written.append((name, log_name, screenshot))
+    loadsave.cycle_saves = lambda name, count : None
+
+    try:
+        loadsave.force_autosave(True)
+        loadsave.autosave_not_running.wait()
+    finally:
+        loadsave.write_save = old_write_save
+        loadsave.cycle_saves = old_cycle_saves
+
+    return written
+
+def test_autosave_pickles_in_thread():
+    log = FakeLog()
+
+    assert autosave(log) == [ ("auto-1", "log", "screenshot") ]
+
+    assert log.frozen == [ threading.currentThread() ]
+    assert len(log.pickled) == 1 and log.pickled[0] is not threading.currentThread()
+
+    assert [ i for i, _t in loadsave.autosave_timings ] == [ "freeze", "pickle", "screenshot", "cycle", "write" ]
+    assert not display.log.messages
+
+def test_autosave_abandoned_on_change():
+    log = FakeLog(error=Exception("unused"))
+    log.freeze = lambda wait=None : { }
+
+    assert autosave(log) == [ ]
+    assert not display.log.messages
+
+def test_autosave_errors():
+    log = FakeLog(error=Exception("freeze failed"))
+
+    # In developer mode, the error is reported.
+    renpy.config.debug = True
+
+    try:
+        autosave(log)
+    except Exception, e:
+        assert str(e) == "freeze failed"
+    else:
+        assert False, "The error should have been raised."
+
+    # Otherwise, it's logged.
+    renpy.config.debug = False
+
+    assert autosave(log) == [ ]
+    assert display.log.messages == [ "While starting an autosave:", "exception" ]
+    assert loadsave.autosave_not_running.isSet()
+
+class Persistent(object):
+
+    def __getattr__(self, attr):
+        return None
+
+def seen_file():
+    f = open(os.path.join(renpy.config.savedir, "persistent.seen"), "rb")
+    rv = f.read()
+    f.close()
+
+    return rv
+
+def test_seen_read_on_first_use():
+    p = Persistent()
+    loadsave.load_seen(p)
+    p._seen_ever["start"] = True
+    p._chosen[("menu", "yes")] = True
+    loadsave.save_seen(p)
+
+    data = seen_file()
+
+    # An older persistent file, with seen data in it.
+    p = Persistent()
+    p._seen_images = { ("bg", "room") : True }
+
+    loadsave.load_seen(p)
+    seen_ever = p._seen_ever
+
+    assert loadsave.seen_unread is not None
+    assert dict.get(seen_ever, "start") is None
+
+    # Saving without using the seen data doesn't need to read it.
+    loadsave.save_seen(p)
+    assert loadsave.seen_unread is not None
+
+    assert "start" in seen_ever
+    assert loadsave.seen_unread is None
+
+    assert p._chosen == { ("menu", "yes") : True }
+    assert p._seen_images == { ("bg", "room") : True }
+    assert len(p._seen_audio) == 0
+
+    # The old data means the file is rewritten.
+    loadsave.save_seen(p)
+    assert seen_file() != data
+
+    p = Persistent()
+    loadsave.load_seen(p)
+
+    # Adding an item reads the file first, so the item is appended.
+    p._seen_audio["music.ogg"] = True
+    assert p._seen_audio.added == [ ("music.ogg", True) ]
+    assert not p._seen_audio.rewrite
+
+    data = seen_file()
+    loadsave.save_seen(p)
+    assert seen_file().startswith(data)
+
+    p = Persistent()
+    loadsave.load_seen(p)
+
+    assert sorted(p._seen_ever.items()) == [ ("start", True) ]
+    assert p._seen_images == { ("bg", "room") : True }
+    assert p._seen_audio == { "music.ogg" : True }
+
+def test_chosen_changed_in_place():
+    os.unlink(os.path.join(renpy.config.savedir, "persistent.seen"))
+
+    # The menu code stores a set once, and adds to it in place.
+    p = Persistent()
+    loadsave.load_seen(p)
+
+    chosen = set()
+    p._chosen[("game/script.rpy", 10)] = chosen
+    chosen.add("Yes")
+    loadsave.save_seen(p)
+
+    chosen.add("No")
+    loadsave.save_seen(p)
+
+    p._chosen[("game/script.rpy", 10)].add("Maybe")
+    loadsave.save_seen(p)
+
+    p = Persistent()
+    loadsave.load_seen(p)
+
+    assert p._chosen == { ("game/script.rpy", 10) : set([ "Yes", "No", "Maybe" ]) }
+
+    # Sets that were read from the file are found when changed, too.
+    p._chosen[("game/script.rpy", 10)].add("Later")
+    loadsave.save_seen(p)
+
+    p = Persistent()
+    loadsave.load_seen(p)
+
+    assert p._chosen[("game/script.rpy", 10)] == set([ "Yes", "No", "Maybe", "Later" ])
+
+def test_seen_replaced_field():
+    p = Persistent()
+    loadsave.load_seen(p)
+    p._seen_ever["start"] = True
+    loadsave.save_seen(p)
+
+    p = Persistent()
+    loadsave.load_seen(p)
+
+    # A field that's replaced is written out, along with the others.
+    p._chosen = { "choice" : True }
+    loadsave.save_seen(p)
+
+    p = Persistent()
+    loadsave.load_seen(p)
+
+    assert p._seen_ever == { "start" : True }
+    assert p._chosen == { "choice" : True }
+
+class SceneLists(object):
+
+    def transient_is_empty(self):
+        return True
+
+    def get_all_displayables(self):
+        return [ ]
+
+class Context(object):
+    """
+    Stands in for renpy.execution.Context.
+    """
+
+    def __init__(self):
+        self.info = renpy.python.RevertableObject()
+        self.music = { }
+        self.dynamic_stack = [ { } ]
+        self.scene_lists = SceneLists()
+
+    def rollback_copy(self):
+        return Context()
+
+def plain(o, path=()):
+    """
+    Returns `o` as a structure of tuples and sorted lists, that can be
+    compared with another such structure.
+    """
+
+    if id(o) in path:
+        return "<cycle>"
+
+    path += (id(o), )
+
+    if isinstance(o, (list, tuple)):
+        return (type(o).__name__, [ plain(i, path) for i in o ])
+
+    if isinstance(o, dict):
+        return (type(o).__name__, sorted((plain(k, path), plain(v, path)) for k, v in o.iteritems()))
+
+    if hasattr(o, "__dict__"):
+        nosave = getattr(o, "nosave", [ ])
+        return (type(o).__name__, plain(dict((k, v) for k, v in vars(o).iteritems() if k not in nosave), path))
+
+    return o
+
+class Thing(renpy.object.Object):
+
+    def __init__(self):
+        self.name = "thing"
+        self.items = [ "a" ]
+
+def test_save_dump_paths():
+    cwd = os.getcwd()
+    os.chdir(renpy.config.savedir)
+
+    try:
+        loadsave.save_dump({ "thing" : Thing() }, None)
+        dump = file("save_dump.txt").read()
+    finally:
+        os.chdir(cwd)
+
+    # Objects are dumped with the names of their fields in the path.
+    assert "roots['thing'].name = 'thing'" in dump
+    assert "roots['thing'].items[0] = 'a'" in dump
+    assert "__getstate__" not in dump
+
+def test_delta_round_trip():
+    python = renpy.python
+    store = renpy.store
+
+    renpy.config.save_deltas = True
+    renpy.game.contexts = [ Context() ]
+
+    log = python.RollbackLog()
+    renpy.game.log = log
+
+    store.counter = 0
+    store.items = python.RevertableList()
+    store.flags = python.RevertableDict()
+
+    deltas = 0
+
+    try:
+        for step in range(40):
+
+            with support.emulate_runtime():
+                log.begin()
+
+                # Every statement changes the store, and some change
+                # objects, or make new ones.
+                store.counter = step * 1000
+                store.numbers = tuple(range(step))
+
+                if step % 4 == 1:
+                    store.items = python.RevertableList(store.items)
+                    store.items.append(step)
+
+                if step % 7 == 3:
+                    store.flags["step%d" % step] = True
+
+                if step % 5 == 0:
+                    store.now = python.RevertableObject()
+                    store.now.step = step
+
+                roots = log.freeze()
+
+                data = loadsave.dump_delta(roots, log)
+
+            if loadsave.delta_session.pieces[1:]:
+                deltas += 1
+
+            full = cPickle.dumps((roots, log), cPickle.HIGHEST_PROTOCOL)
+
+            delta_roots, delta_log = loadsave.load_delta(data)
+            full_roots, full_log = cPickle.loads(full)
+
+            assert plain(delta_roots) == plain(full_roots) == plain(roots)
+            assert plain(delta_log) == plain(full_log)
+            assert delta_log.current is delta_log.log[-1]
+
+            log.discard_freeze()
+
+    finally:
+        renpy.config.save_deltas = False
+        loadsave.reset_delta_session()
+
+    # Some of the saves were written as deltas.
+    assert deltas > 10
+
+if __name__ == "__main__":
+    try:
+        support.main(globals())
+    finally:
+        shutil.rmtree(renpy.config.savedir)
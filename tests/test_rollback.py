@@ -0,0 +1,88 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Checks that the rollback log finds the changes made to the store.
+
+import support
+
+with support.emulate_runtime():
+    renpy = support.fake_python()
+
+def make_log():
+    store = vars(renpy.store)
+
+    for i in range(100):
+        store["var%d" % i] = i * 1000
+
+    log = renpy.python.RollbackLog()
+    renpy.game.log = log
+
+    with support.emulate_runtime():
+        log.begin()
+
+    return log
+
+def complete(log):
+    with support.emulate_runtime():
+        log.complete()
+
+    return sorted(log.current.store)
+
+def test_no_changes():
+    log = make_log()
+    assert complete(log) == [ ]
+
+def test_changed_values():
+    log = make_log()
+
+    renpy.store.var3 = "three"
+    renpy.store.var97 = "ninety-seven"
+
+    # Assigning an equal, but different, object is a change.
+    renpy.store.var50 = int("50000")
+
+    assert complete(log) == [ ("var3", 3000), ("var50", 50000), ("var97", 97000) ]
+
+    for k in ("var3", "var50", "var97"):
+        assert k in log.ever_been_changed
+
+def test_added_and_removed():
+    log = make_log()
+
+    renpy.store.new_var = 1
+    del renpy.store.var10
+    renpy.store.var11 = "eleven"
+
+    assert complete(log) == [ ("new_var", ), ("var10", 10000), ("var11", 11000) ]
+
+    del renpy.store.new_var
+
+def test_complete_twice():
+    log = make_log()
+
+    renpy.store.var1 = "one"
+    complete(log)
+
+    renpy.store.var2 = "two"
+    assert complete(log) == [ ("var1", 1000), ("var2", 2000) ]
+
+if __name__ == "__main__":
+    support.main(globals())
@@ -0,0 +1,236 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Checks the bytecode cache, and how it's saved.
+
+import os
+import md5
+import time
+import shutil
+import tempfile
+import threading
+
+# This python's difflib needs collections.OrderedDict, which the runtime
+# is emulated without.
+import difflib #@UnusedImport
+
+import support
+
+renpy = support.package("renpy")
+renpy.script_version = 0
+
+renpy.config = support.Namespace(
+    debug=False,
+    searchpath=[ tempfile.mkdtemp() ],
+    )
+
+class Log(object):
+
+    def __init__(self):
+        self.messages = [ ]
+
+    def write(self, s, *args):
+        self.messages.append(s % args)
+
+    def exception(self):
+        self.messages.append("exception")
+
+class Node(object):
+    __slots__ = [ "filename", "linenumber", "name", "next" ]
+
+renpy.ast = support.Namespace(Node=Node)
+
+renpy.display = support.package("renpy.display")
+renpy.display.log = Log()
+
+with support.emulate_runtime():
+    script = support.load("renpy.script")
+
+CACHE = os.path.join(renpy.config.searchpath[0], "bytecode.rpyb")
+
+def key(name):
+    return name + script.MAGIC
+
+def make_script(chunks, used, new):
+    """
+    Returns a Script with just enough set up to save the bytecode cache.
+    """
+
+    rv = script.Script.__new__(script.Script)
+
+    rv.bytecode_cache = script.BytecodeCache(CACHE)
+    rv.bytecode_cache.load()
+
+    def load_all_chunks():
+        raise Exception("Saving the bytecode cache shouldn't load chunks.")
+
+    rv.load_all_chunks = load_all_chunks
+    rv.chunks = chunks
+    rv.bytecode_used = set(used)
+    rv.bytecode_newcache = dict(new)
+
+    return rv
+
+def contents():
+    cache = script.BytecodeCache(CACHE)
+    cache.load()
+
+    rv = dict((k, cache.get(k)) for k in cache.index)
+    cache.close()
+
+    return rv
+
+def test_append():
+    if os.path.exists(CACHE):
+        os.unlink(CACHE)
+
+    # With no file, the cache is written from scratch.
+    s = make_script([ ], [ key("a") ], { key("a") : "code a" })
+    s.save_bytecode()
+
+    s = make_script([ ], [ key("a"), key("b") ], { key("b") : "code b" })
+    assert not s.bytecode_cache.needs_rewrite(s.bytecode_newcache)
+    s.save_bytecode()
+
+    assert contents() == { key("a") : "code a", key("b") : "code b" }
+    assert not renpy.display.log.messages
+
+def test_rewrite_keeps_code():
+    old_size = script.BYTECODE_COMPACT_SIZE
+    script.BYTECODE_COMPACT_SIZE = 0
+
+    try:
+        # Code compiled by another version of python.
+        s = make_script([ ], [ ], { "old" : "old code" })
+        s.save_bytecode()
+
+        # A chunk hasn't been loaded, so it isn't known what code is
+        # used, and the code for this python is kept.
+        s = make_script([ "chunk" ], [ key("a") ], { key("c") : "code c" })
+        assert s.bytecode_cache.needs_rewrite(s.bytecode_newcache)
+        s.save_bytecode()
+
+        assert contents() == { key("a") : "code a", key("b") : "code b", key("c") : "code c" }
+
+        # Once every chunk is loaded, only the code that's used is kept.
+        s = make_script([ None ], [ key("a"), key("d") ], { key("d") : "code d" })
+        s.bytecode_cache.compacted = 0
+        assert s.bytecode_cache.needs_rewrite(s.bytecode_newcache)
+        s.save_bytecode()
+
+        assert contents() == { key("a") : "code a", key("d") : "code d" }
+
+    finally:
+        script.BYTECODE_COMPACT_SIZE = old_size
+
+    assert not os.path.exists(CACHE + ".new")
+    assert not renpy.display.log.messages
+
+def test_errors_are_logged():
+    s = make_script([ ], [ ], { key("e") : "code e" })
+    s.bytecode_cache.fn = os.path.join(renpy.config.searchpath[0], "missing", "bytecode.rpyb")
+    s.save_bytecode()
+
+    assert renpy.display.log.messages == [ "While saving the bytecode cache:", "exception" ]
+
+def test_prefetch_ahead():
+    s = script.Script.__new__(script.Script)
+
+    lock = threading.Lock()
+    started = [ ]
+
+    def prefetch_file(*item):
+        with lock:
+            started.append(item)
+
+        return item
+
+    s.prefetch_file = prefetch_file
+
+    items = [ (".rpyc", ".rpy", "dir", str(i)) for i in range(script.PREFETCH_AHEAD * 3) ]
+    prefetcher = script.ScriptPrefetcher(s, items, 4)
+
+    try:
+        for i, item in enumerate(items):
+
+            # Give the workers a chance to get ahead.
+            time.sleep(.01)
+
+            with lock:
+                assert len(started) <= i + script.PREFETCH_AHEAD
+
+            assert prefetcher.get(item) == item
+
+    finally:
+        prefetcher.close()
+
+    # The workers may start the items they take in any order.
+    assert sorted(started) == sorted(items)
+    assert not [ t for t in prefetcher.threads if t.isAlive() ]
+
+def test_current_written_later():
+    renpy.game = support.Namespace(options=support.Namespace(verify_scripts=False))
+
+    s = script.Script.__new__(script.Script)
+    s.source_digests = { }
+
+    rpyfn = os.path.join(renpy.config.searchpath[0], "test.rpy")
+    rpycfn = rpyfn + "c"
+
+    source = "label start:\n    return\n"
+
+    f = open(rpyfn, "wb")
+    f.write(source)
+    f.close()
+
+    # The compiled file was made from this source, at a different mtime.
+    compiled = "compiled" + md5.md5(source).digest() + script.RPYC_INFO.pack(len(source), 0, script.RPYC_INFO_MAGIC)
+
+    f = open(rpycfn, "wb")
+    f.write(compiled)
+    f.close()
+
+    result = s.check_current(rpyfn, rpycfn)
+    assert result[0]
+
+    # Checking doesn't write anything, as it may be run in a thread.
+    assert open(rpycfn, "rb").read() == compiled
+
+    assert s.record_current(rpyfn, rpycfn, result)
+    assert open(rpycfn, "rb").read() != compiled
+    assert s.check_current(rpyfn, rpycfn) == (True, None, None)
+
+    # A changed source isn't current, and its digest is kept for when
+    # it's compiled.
+    f = open(rpyfn, "ab")
+    f.write("\n")
+    f.close()
+
+    result = s.check_current(rpyfn, rpycfn)
+    assert not s.source_digests
+    assert not s.record_current(rpyfn, rpycfn, result)
+    assert s.source_digests == { rpyfn : md5.md5(source + "\n").digest() }
+
+if __name__ == "__main__":
+    try:
+        support.main(globals())
+    finally:
+        shutil.rmtree(renpy.config.searchpath[0])
@@ -0,0 +1,206 @@
+# Copyright 2004-2012 Tom Rothamel <pytom@bishoujo.us>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Checks the python files in the renpy package for syntax and library
+# features that were added in Python 2.7, and for imports of modules
+# that don't ship with Ren'Py, since Ren'Py runs on Python 2.6.
+
+import os
+import ast
+
+import support
+
+# Top-level modules that are part of Ren'Py, or that are only available
+# on some platforms, and only imported there.
+EXTRA_MODULES = [ "renpy", "store", "__main__", "EasyDialogs", "android" ]
+
+# Kinds of node that are new in 2.7. (On 2.6, the code they come from
+# can't be parsed at all.)
+NEW_NODES = tuple(getattr(ast, i) for i in ("Set", "SetComp", "DictComp") if hasattr(ast, i))
+
+def python_files():
+    """
+    Returns a list of the python files in the renpy package.
+    """
+
+    rv = [ ]
+
+    for dirpath, dirnames, filenames in os.walk(os.path.join(support.ROOT, "renpy")):
+        dirnames.sort()
+
+        for fn in sorted(filenames):
+            if fn.endswith(".py"):
+                rv.append(os.path.join(dirpath, fn))
+
+    return rv
+
+def guarded_imports(tree):
+    """
+    Returns the set of import statements in `tree` that are inside a
+    try block that catches ImportError (or everything).
+    """
+
+    rv = set()
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.TryExcept):
+            continue
+
+        for handler in node.handlers:
+            names = [ ]
+
+            if handler.type is None:
+                names.append("ImportError")
+            elif isinstance(handler.type, ast.Name):
+                names.append(handler.type.id)
+            elif isinstance(handler.type, ast.Tuple):
+                names.extend(i.id for i in handler.type.elts if isinstance(i, ast.Name))
+
+            if "ImportError" in names:
+                break
+        else:
+            continue
+
+        for stmt in node.body:
+            for i in ast.walk(stmt):
+                if isinstance(i, (ast.Import, ast.ImportFrom)):
+                    rv.add(i)
+
+    return rv
+
+def check_tree(tree, modules):
+    """
+    Returns a list of (lineno, message) tuples, giving the problems
+    found in `tree`.
+    """
+
+    rv = [ ]
+
+    guarded = guarded_imports(tree)
+
+    # Names that refer to a module in NEW_IN_27.
+    aliases = { }
+
+    for node in ast.walk(tree):
+
+        if isinstance(node, NEW_NODES):
+            rv.append((node.lineno, "%s is new in python 2.7" % type(node).__name__))
+
+        elif isinstance(node, ast.With):
+            if len(node.body) == 1 and isinstance(node.body[0], ast.With) and node.body[0].lineno == node.lineno:
+                rv.append((node.lineno, "with statements with more than one context manager are new in python 2.7"))
+
+        elif isinstance(node, ast.Call):
+            func = node.func
+
+            if isinstance(func, ast.Attribute) and func.attr == "format" and isinstance(func.value, ast.Str):
+                if "{}" in func.value.s or "{:" in func.value.s or "{!" in func.value.s:
+                    rv.append((node.lineno, "automatic field numbering in str.format is new in python 2.7"))
+
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                top = alias.name.split(".")[0]
+
+                if alias.name in support.NEW_IN_27:
+                    aliases[alias.asname or alias.name] = alias.name
+
+                if top not in modules and node not in guarded:
+                    rv.append((node.lineno, "%s doesn't ship with Ren'Py" % alias.name))
+
+        elif isinstance(node, ast.ImportFrom):
+            if node.level or node.module is None:
+                continue
+
+            top = node.module.split(".")[0]
+
+            if top not in modules and node not in guarded:
+                rv.append((node.lineno, "%s doesn't ship with Ren'Py" % node.module))
+
+            for alias in node.names:
+                if alias.name in support.NEW_IN_27.get(node.module, [ ]):
+                    rv.append((node.lineno, "%s.%s is new in python 2.7" % (node.module, alias.name)))
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            module = aliases.get(node.value.id, None)
+
+            if module is not None and node.attr in support.NEW_IN_27[module]:
+                rv.append((node.lineno, "%s.%s is new in python 2.7" % (module, node.attr)))
+
+    rv.sort()
+    return rv
+
+def check_source(source):
+    modules = support.runtime_modules() | set(EXTRA_MODULES)
+    return check_tree(ast.parse(source), modules)
+
+def test_checks():
+
+    if not NEW_NODES:
+        return
+
+    # Make sure the checks themselves find what they should.
+    source = """\
+import collections
+import itertools as it
+import yaml
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from functools import total_ordering
+
+s = { 1, 2 }
+d = { i : i for i in s }
+od = collections.OrderedDict()
+c = it.compress(s, s)
+t = "{} {}".format(1, 2)
+
+with open("a") as a, open("b") as b:
+    pass
+
+with open("a") as a:
+    with open("b") as b:
+        pass
+"""
+
+    assert [ i for i, _msg in check_source(source) ] == [ 3, 10, 12, 13, 14, 15, 16, 18 ]
+
+def test_renpy():
+
+    modules = support.runtime_modules() | set(EXTRA_MODULES)
+
+    problems = [ ]
+
+    for fn in python_files():
+        f = open(fn, "rU")
+        source = f.read()
+        f.close()
+
+        for lineno, msg in check_tree(ast.parse(source, fn), modules):
+            problems.append("%s:%d: %s" % (os.path.relpath(fn, support.ROOT), lineno, msg))
+
+    assert not problems, "\n".join(problems)
+
+if __name__ == "__main__":
+    support.main(globals())